@@ -13,8 +13,12 @@ import LoadingIcons from 'react-loading-icons'
 import './styles.css';
 
 export const WebSocketDemo = () => {
-//   Python server running on localhost
-  const [socketUrl, setSocketUrl] = useState('ws://127.0.0.1:8765');
+//   Python server running on localhost. ?session=booth2 picks the booth when the server hosts several
+  const session = new URLSearchParams(window.location.search).get('session');
+  const [socketUrl, setSocketUrl] = useState('ws://127.0.0.1:8765' + (session ? '/' + encodeURIComponent(session) : ''));
+  // Images are sent over the socket as content hashes and fetched from the server's HTTP endpoint
+  const imageUrl = (hash) => `http://127.0.0.1:8766/images/${hash}.png`;
+  const thumbUrl = (hash) => `http://127.0.0.1:8766/thumbs/${hash}`;
   const didUnmount = useRef(false);
 
   const [websocketOpen, setWebsocketOpen] = useState(false)
@@ -28,11 +32,37 @@ export const WebSocketDemo = () => {
   const [mySelectedImage, setMySelectedImage ] = useState("")
   const [myResultA, setMyResultA ] = useState("")
   const [myResultB, setMyResultB ] = useState("")
+  const [myProgressA, setMyProgressA ] = useState("Progress.IDLE")
+  const [myProgressB, setMyProgressB ] = useState("Progress.IDLE")
 
   const [myError, setMyError ] = useState("")
 
   const [micOn, setMicOn] = useState(false)
 
+  // Last applied server version, so deltas already covered by a snapshot are skipped
+  const versionRef = useRef(0);
+  const setters = {
+    model: setMyModel,
+    instruction: setMyInstruction,
+    prompt: setMyPrompt,
+    image_result_a: setMyImageResultA,
+    image_result_b: setMyImageResultB,
+    selected_image: setMySelectedImage,
+    result_a: setMyResultA,
+    result_b: setMyResultB,
+    state: setMyState,
+    progress_a: setMyProgressA,
+    progress_b: setMyProgressB,
+    error: setMyError,
+  };
+
+  const setField = (key, value) => {
+    setters[key]?.(value ?? "")
+    if (key === 'state') {
+      setMicOn(value === "State.TRANSCRIBING")
+    }
+  };
+
   const targetSubstr = '_';
   const startIndex = myPrompt.indexOf(targetSubstr);
   const endIndex = startIndex + targetSubstr.length;
@@ -76,30 +106,18 @@ export const WebSocketDemo = () => {
         setWebsocketOpen(false)
         console.log("Disconnected!")
       },
-      // New onMessage handler
+      // Server sends a full snapshot on connect, then only the fields that changed
       onMessage: (e) => {
-          const data = JSON.parse(e.data)
-          setMyModel(data.model)
-          setMyInstruction(data.instruction)
-          setMyPrompt(data.prompt)
-          setMyImageResultA(data.image_result_a)
-          setMyImageResultB(data.image_result_b)
-          setMySelectedImage(data.selected_image)
-          setMyResultA(data.result_a)
-          setMyResultB(data.result_b)
-          setMyState(data.state)
-
-
-          if (data.state == 'State.ERROR') {
-            setMyError(data.error)
+          const message = JSON.parse(e.data)
+          if (message.type === 'snapshot') {
+            versionRef.current = message.version
+            Object.entries(message.data).forEach(([key, value]) => setField(key, value))
+          } else if (message.type === 'delta' && message.version > versionRef.current) {
+            versionRef.current = message.version
+            Object.entries(message.set).forEach(([key, value]) => setField(key, value))
+            Object.entries(message.append).forEach(([key, text]) => setters[key]?.((prev) => (prev ?? "") + text))
           }
-
-          if (myState == "State.TRANSCRIBING") {
-            setMicOn(true)
-          } else {
-            setMicOn(false)
-          }          
-          // console.log(data)
+          // console.log(message)
       },
       retryOnError: true,
       shouldReconnect: (closeEvent) => {
@@ -232,7 +250,7 @@ export const WebSocketDemo = () => {
             {
               mySelectedImage && (
                 <img 
-                  src={`data:image/png;base64,${mySelectedImage}`} 
+                  src={imageUrl(mySelectedImage)} 
                   style={{ 
                     maxWidth: '100%', 
                     maxHeight: '100%', 
@@ -298,20 +316,19 @@ export const WebSocketDemo = () => {
     'State.TRANSCRIBING': <div style={{ ...commonStyles, backgroundColor: 'red', color: 'white', opacity: 0.8 }}>{myResultA}</div>,
     'State.REVIEW_TXT': <div onClick={handleSelectA} style={{ ...commonStyles, backgroundColor: 'red', color: 'white', opacity: 0.8 }}>{myResultA}</div>,
     'State.REVIEW_IMG': <div onClick={handleSelectA} style={{ ...commonStyles, backgroundColor: 'red', color: 'white', opacity: 0.8 }}>
-      <img src={`data:image/png;base64,${myImageResultA}`} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>,
-    'State.INFERENCE_TXT_A': <div style={{ ...commonStyles, backgroundColor: 'red', color: 'white', opacity: 0.8 }}>{myResultA}</div>,
-    'State.INFERENCE_TXT_B': <div style={{ ...commonStyles, backgroundColor: 'red', color: 'white', opacity: 0.8 }}>{myResultA}</div>,
-    'State.INFERENCE_IMG_A': <LoadingIcons.BallTriangle fill="red" stroke="red" />,
-    'State.INFERENCE_IMG_B': <div style={{ ...commonStyles, backgroundColor: 'red', color: 'white', opacity: 0.8 }}>
-      <img src={`data:image/png;base64,${myImageResultA}`} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>,
+      <img src={thumbUrl(myImageResultA)} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>,
+    'State.INFERENCE_TXT': <div style={{ ...commonStyles, backgroundColor: 'red', color: 'white', opacity: 0.8 }}>{myResultA}</div>,
+    'State.INFERENCE_IMG': myImageResultA ? <div style={{ ...commonStyles, backgroundColor: 'red', color: 'white', opacity: 0.8 }}>
+      <img src={thumbUrl(myImageResultA)} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>
+      : <LoadingIcons.BallTriangle fill="red" stroke="red" />,
     'State.SELECT_A_IMG': 
     <div style={wrapperStyle}>
       <div style={{ ...commonStyles, backgroundColor: 'red', color: 'white', opacity: 0.8 }}>
-      <img src={`data:image/png;base64,${myImageResultA}`} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>
+      <img src={thumbUrl(myImageResultA)} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>
       <div style={centerIconStyle}><LoadingIcons.Puff height={400} width={400} fill="white" stroke="white" speed={0.3} /></div>
     </div>,
     'State.SELECT_B_IMG':  <div style={{ ...commonStyles, backgroundColor: 'red', color: 'white', opacity: 0.8 }}>
-      <img src={`data:image/png;base64,${myImageResultA}`} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>,
+      <img src={thumbUrl(myImageResultA)} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>,
     'State.SELECT_A_TXT': 
     <div style={wrapperStyle}>
       <div style={{ ...commonStyles, backgroundColor: 'red', color: 'white' }}>{myResultA}</div>
@@ -320,6 +337,13 @@ export const WebSocketDemo = () => {
     'State.SELECT_B_TXT': <div style={{ ...commonStyles, backgroundColor: 'red', color: 'white', opacity: 0.3 }}>{myResultA}</div>,
   };
 
+  if (myProgressA === 'Progress.FAILED' && myState !== 'State.ERROR') {
+    return <div style={{ ...commonStyles, color: 'red' }}>Response A failed, please pick B.</div>;
+  }
+  // Review starts when the other side fails, but this one can only be picked once it's done
+  if ((myState === 'State.REVIEW_TXT' || myState === 'State.REVIEW_IMG') && myProgressA !== 'Progress.DONE') {
+    return styles[myState === 'State.REVIEW_TXT' ? 'State.INFERENCE_TXT' : 'State.INFERENCE_IMG'];
+  }
   return styles[myState];
 })()}
 
@@ -333,18 +357,18 @@ export const WebSocketDemo = () => {
     'State.INITIALIZING': <div style={{ ...commonStyles, backgroundColor: 'blue', color: 'white', opacity: 0.8 }}>{myResultB}</div>,
     'State.TRANSCRIBING': <div style={{ ...commonStyles, backgroundColor: 'blue', color: 'white', opacity: 0.8 }}>{myResultB}</div>,
     'State.REVIEW_IMG': <div onClick={handleSelectB} style={{ ...commonStyles, backgroundColor: 'blue', color: 'white', opacity: 0.8 }}>
-      <img src={`data:image/png;base64,${myImageResultB}`} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>,
+      <img src={thumbUrl(myImageResultB)} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>,
     'State.REVIEW_TXT': <div onClick={handleSelectB} style={{ ...commonStyles, backgroundColor: 'blue', color: 'white', opacity: 0.8 }}>{myResultB}</div>,
-    'State.INFERENCE_TXT_A': <div style={{ ...commonStyles, backgroundColor: 'blue', color: 'white', opacity: 0.8 }}>{myResultB}</div>,
-    'State.INFERENCE_TXT_B': <div style={{ ...commonStyles, backgroundColor: 'blue', color: 'white', opacity: 0.8 }}>{myResultB}</div>,
-    'State.INFERENCE_IMG_A': <div style={{ ...commonStyles, backgroundColor: 'blue', color: 'white', opacity: 0.8 }}>{myResultB}</div>,
-    'State.INFERENCE_IMG_B': <LoadingIcons.BallTriangle fill="blue" stroke="blue" />,
+    'State.INFERENCE_TXT': <div style={{ ...commonStyles, backgroundColor: 'blue', color: 'white', opacity: 0.8 }}>{myResultB}</div>,
+    'State.INFERENCE_IMG': myImageResultB ? <div style={{ ...commonStyles, backgroundColor: 'blue', color: 'white', opacity: 0.8 }}>
+      <img src={thumbUrl(myImageResultB)} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>
+      : <LoadingIcons.BallTriangle fill="blue" stroke="blue" />,
     'State.SELECT_A_IMG': <div style={{ ...commonStyles, backgroundColor: 'blue', color: 'white', opacity: 0.8 }}>
-      <img src={`data:image/png;base64,${myImageResultB}`} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>,
+      <img src={thumbUrl(myImageResultB)} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>,
     'State.SELECT_B_IMG': 
     <div style={wrapperStyle}>
       <div style={{ ...commonStyles, backgroundColor: 'blue', color: 'white', opacity: 0.8 }}>
-      <img src={`data:image/png;base64,${myImageResultB}`} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>
+      <img src={thumbUrl(myImageResultB)} style={{ maxWidth: '100%', maxHeight: '100%' }} alt="description" /></div>
       <div style={centerIconStyle}><LoadingIcons.Puff height={400} width={400} fill="white" stroke="white" speed={0.3} /></div>
     </div>,
     'State.SELECT_A_TXT': <div style={{ ...commonStyles, backgroundColor: 'blue', color: 'white', opacity: 0.3 }}>{myResultB}</div>,
@@ -355,6 +379,13 @@ export const WebSocketDemo = () => {
     </div>,
   };
 
+  if (myProgressB === 'Progress.FAILED' && myState !== 'State.ERROR') {
+    return <div style={{ ...commonStyles, color: 'red' }}>Response B failed, please pick A.</div>;
+  }
+  // Review starts when the other side fails, but this one can only be picked once it's done
+  if ((myState === 'State.REVIEW_TXT' || myState === 'State.REVIEW_IMG') && myProgressB !== 'Progress.DONE') {
+    return styles[myState === 'State.REVIEW_TXT' ? 'State.INFERENCE_TXT' : 'State.INFERENCE_IMG'];
+  }
   return styles[myState];
 })()}
 </Grid>
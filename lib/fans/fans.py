@@ -1,18 +1,54 @@
-from RPi import GPIO
-import time
+"""Fan controller for the kiosk box.
+
+Reads the SoC temperature from sysfs and sets the PWM duty of the fans,
+either stepping through FAN_SPEEDS with hysteresis (FAN_CONTROL=curve) or
+holding FAN_TARGET_TEMP with a PID loop (FAN_CONTROL=pid). Temperature,
+duty and the firmware's throttling flags are logged as JSON lines every
+TELEMETRY_INTERVAL_S.
+
+Off the Pi, --simulate runs the controller against a thermal model of the
+box with mock fans, faster than real time, to try out settings:
+
+    python3 fans.py --simulate --minutes 120 --control pid
+"""
+
+import argparse
+import json
+import os
 import subprocess
+import time
+
+try:
+    from RPi import GPIO
+except ImportError:
+    GPIO = None
 
 # Constants
 FAN_PINS = [14, 26]
 PWM_FREQUENCY = 100
 TEMP_THRESHOLDS = [75, 70, 60, 50, 40, 30]
 FAN_SPEEDS = [100, 85, 70, 50, 25, 15, 0]
-SLEEP_TIME = 5
+SLEEP_TIME = float(os.getenv("FAN_INTERVAL_S", "2"))
+
+FAN_CONTROL = os.getenv("FAN_CONTROL", "curve")                 # "curve" or "pid"
+FAN_HYSTERESIS = float(os.getenv("FAN_HYSTERESIS", "3"))        # Degrees below a threshold before stepping down
+FAN_TARGET_TEMP = float(os.getenv("FAN_TARGET_TEMP", "60"))     # What the PID loop holds
+FAN_PID = [float(k) for k in os.getenv("FAN_PID", "6,0.05,20").split(",")]  # Kp, Ki, Kd in % duty per degree
+FAN_MIN_DUTY = float(os.getenv("FAN_MIN_DUTY", "15"))           # Below this the fans stall, so they are stopped
+FAN_DEADBAND = float(os.getenv("FAN_DEADBAND", "3"))            # Smallest duty change worth making
+FAN_MAX_TEMP = TEMP_THRESHOLDS[0]                               # Full speed from here whatever the controller says
+TELEMETRY_INTERVAL_S = float(os.getenv("TELEMETRY_INTERVAL_S", "30"))
+
+THERMAL_ZONE = "/sys/class/thermal/thermal_zone0/temp"
+THROTTLED_PATH = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+# Bits of the firmware's throttled value. The same bits 16 higher mean it has happened since boot.
+THROTTLE_FLAGS = {0: "under-voltage", 1: "arm-frequency-capped", 2: "throttled", 3: "soft-temperature-limit"}
 
 def get_temp():
     """
-    Retrieves the CPU temperature of the Raspberry Pi.
-    
+    Retrieves the CPU temperature of the Raspberry Pi with vcgencmd, for when
+    the thermal zone isn't available.
+
     :return: CPU temperature as float
     :raises RuntimeError: if temperature retrieval fails
     """
@@ -23,39 +59,290 @@ def get_temp():
     except (IndexError, ValueError):
         raise RuntimeError('Could not parse temperature. Output: {}'.format(temp_str))
 
+def get_throttled():
+    """
+    Retrieves the firmware's throttled bits, from sysfs or vcgencmd.
+
+    :return: throttled value as int, or None if it can't be read
+    """
+    try:
+        with open(THROTTLED_PATH) as f:
+            return int(f.read().strip(), 16)
+    except (OSError, ValueError):
+        pass
+    try:
+        output = subprocess.run(['vcgencmd', 'get_throttled'], capture_output=True)
+        return int(output.stdout.decode().split('=')[1], 16)
+    except (OSError, IndexError, ValueError):
+        return None
+
+def decode_throttled(value):
+    """
+    Splits a throttled value into the flags active now and those seen since boot.
+
+    :param value: throttled value from get_throttled
+    :return: (list of active flag names, list of flag names seen since boot)
+    """
+    if value is None:
+        return None, None
+    active = [name for bit, name in THROTTLE_FLAGS.items() if value & (1 << bit)]
+    occurred = [name for bit, name in THROTTLE_FLAGS.items() if value & (1 << (bit + 16))]
+    return active, occurred
+
 def set_fan_speed(fans, speed):
     """
     Sets the duty cycle for all fan PWM channels.
-    
+
     :param fans: List of fan PWM channels
     :param speed: Duty cycle to set for the fans
     """
     for fan in fans:
         fan.ChangeDutyCycle(speed)
 
-def main():
-    GPIO.setwarnings(False)
-    GPIO.setmode(GPIO.BCM)
-    
-    fans = []
-    for pin in FAN_PINS:
-        GPIO.setup(pin, GPIO.OUT)
-        fans.append(GPIO.PWM(pin, PWM_FREQUENCY))
-    
-    for fan in fans:
-        fan.start(100)
+class SysfsSensor:
+    """Reads the SoC temperature from the kernel thermal zone.
 
-    try:
-        print("Starting fan control loop")
+    The file stays open and is re-read in place, which costs a syscall
+    rather than the fork and exec of running vcgencmd every time.
+    """
+
+    def __init__(self, path=THERMAL_ZONE):
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def temperature(self):
+        return int(os.pread(self.fd, 16, 0)) / 1000
+
+    def throttled(self):
+        return get_throttled()
+
+class VcgencmdSensor:
+    def temperature(self):
+        return get_temp()
+
+    def throttled(self):
+        return get_throttled()
+
+class GpioFans:
+    """The PWM fans on FAN_PINS."""
+
+    def __init__(self, pins=FAN_PINS):
+        GPIO.setwarnings(False)
+        GPIO.setmode(GPIO.BCM)
+        self.fans = []
+        for pin in pins:
+            GPIO.setup(pin, GPIO.OUT)
+            self.fans.append(GPIO.PWM(pin, PWM_FREQUENCY))
+        # Spin up at full speed, the controller brings them down from there
+        for fan in self.fans:
+            fan.start(100)
+
+    def set(self, duty):
+        set_fan_speed(self.fans, duty)
+
+    def close(self):
+        for fan in self.fans:
+            fan.stop()
+        GPIO.cleanup()
+
+class MockFans:
+    """Stands in for GpioFans off the Pi, remembering the duty it was given."""
+
+    def __init__(self):
+        self.duty = 100
+        self.changes = 0
+
+    def set(self, duty):
+        self.duty = duty
+        self.changes += 1
+
+    def close(self):
+        pass
+
+class CurveController:
+    """Steps through FAN_SPEEDS as the temperature crosses TEMP_THRESHOLDS.
+
+    Speeding up happens as soon as a threshold is reached. Slowing down waits
+    until the temperature is FAN_HYSTERESIS below it, so the fans don't flap
+    between two speeds around a threshold.
+    """
+
+    def __init__(self, thresholds=TEMP_THRESHOLDS, speeds=FAN_SPEEDS, hysteresis=FAN_HYSTERESIS):
+        self.thresholds = thresholds
+        self.speeds = speeds
+        self.hysteresis = hysteresis
+        self.level = 0          # Index into speeds, starting at full speed
+
+    def level_for(self, temp):
+        return next((i for i, threshold in enumerate(self.thresholds) if temp >= threshold), len(self.thresholds))
+
+    def update(self, temp, dt):
+        hotter = self.level_for(temp)
+        if hotter < self.level:
+            self.level = hotter
+        else:
+            self.level = max(self.level, self.level_for(temp + self.hysteresis))
+        return self.speeds[self.level]
+
+class PidController:
+    """Holds the temperature at FAN_TARGET_TEMP.
+
+    The derivative is taken on the temperature rather than the error, and
+    the integral stops growing while the output is pinned at 0 or 100%, so
+    it doesn't wind up during a long busy or idle spell.
+    """
+
+    def __init__(self, target=FAN_TARGET_TEMP, gains=FAN_PID, min_duty=FAN_MIN_DUTY):
+        self.target = target
+        self.kp, self.ki, self.kd = gains
+        self.min_duty = min_duty
+        self.integral = 0
+        self.previous = None
+
+    def update(self, temp, dt):
+        error = temp - self.target
+        derivative = (temp - self.previous) / dt if self.previous is not None and dt > 0 else 0
+        self.previous = temp
+        integral = self.integral + error * dt
+        duty = self.kp * error + self.ki * integral + self.kd * derivative
+        if 0 <= duty <= 100 or (duty > 100) == (error < 0):
+            self.integral = integral
+        duty = min(100, max(0, duty))
+        return round(duty) if duty >= self.min_duty else 0
+
+class FanController:
+    """Reads the sensor, sets the fans and logs telemetry."""
+
+    def __init__(self, sensor, fans, control, telemetry_interval=TELEMETRY_INTERVAL_S):
+        self.sensor = sensor
+        self.fans = fans
+        self.control = control
+        self.telemetry_interval = telemetry_interval
+        self.duty = None
+        self.last_step = None
+        self.last_telemetry = None
+        self.temps = []
+        self.duties = []
+
+    def step(self, now):
+        temp = self.sensor.temperature()
+        dt = now - self.last_step if self.last_step is not None else 0
+        self.last_step = now
+        duty = self.control.update(temp, dt)
+        if temp >= FAN_MAX_TEMP:
+            duty = 100
+        if self.duty is None or abs(duty - self.duty) >= FAN_DEADBAND or (duty != self.duty and duty in (0, 100)):
+            self.fans.set(duty)
+            self.duty = duty
+        self.temps.append(temp)
+        self.duties.append(duty)
+        if self.last_telemetry is None:
+            self.last_telemetry = now
+        elif now - self.last_telemetry >= self.telemetry_interval:
+            self.telemetry(now)
+        return temp, duty
+
+    def telemetry(self, now):
+        throttled = self.sensor.throttled()
+        active, occurred = decode_throttled(throttled)
+        print(json.dumps({
+            "metric": "fans",
+            "temp": self.temps[-1],
+            "temp_max": max(self.temps),
+            "duty": self.duty,
+            "duty_mean": round(sum(self.duties) / len(self.duties), 1),
+            "throttled": active,
+            "throttled_since_boot": occurred,
+        }))
+        self.temps = []
+        self.duties = []
+        self.last_telemetry = now
+
+    def run(self):
+        print(f"Starting fan control loop ({FAN_CONTROL})")
         while True:
-            set_fan_speed(fans, 10)
+            self.step(time.monotonic())
             time.sleep(SLEEP_TIME)
+
+class SimulatedPi:
+    """Thermal model of the Pi in the kiosk box, for trying the controller off-device.
+
+    The SoC and heatsink are one heat capacity, warmed by the board's power
+    draw and cooled towards ambient by passive conduction plus airflow in
+    proportion to fan duty. Load alternates between busy and idle spells like
+    an event, and above 80C the firmware throttling flags are set.
+    """
+
+    def __init__(self, fans, ambient=25, idle_watts=3, busy_watts=7, busy_s=600, idle_s=300,
+                 heat_capacity=60, passive=0.1, active=0.25):
+        self.fans = fans
+        self.ambient = ambient
+        self.idle_watts = idle_watts
+        self.busy_watts = busy_watts
+        self.busy_s = busy_s
+        self.idle_s = idle_s
+        self.heat_capacity = heat_capacity
+        self.passive = passive
+        self.active = active
+        self.temp = ambient + 20
+        self.now = 0
+        self.throttled_bits = 0
+        self.throttled_s = 0
+
+    def advance(self, dt):
+        busy = self.now % (self.busy_s + self.idle_s) < self.busy_s
+        power = self.busy_watts if busy else self.idle_watts
+        cooling = (self.passive + self.active * self.fans.duty / 100) * (self.temp - self.ambient)
+        self.temp += (power - cooling) * dt / self.heat_capacity
+        self.now += dt
+        if self.temp >= 80:
+            self.throttled_bits = 0x4 | 0x8 | ((0x4 | 0x8) << 16)
+            self.throttled_s += dt
+        else:
+            self.throttled_bits &= ~0xf
+
+    def temperature(self):
+        return round(self.temp, 1)
+
+    def throttled(self):
+        return self.throttled_bits
+
+def simulate(control, minutes):
+    fans = MockFans()
+    pi = SimulatedPi(fans)
+    controller = FanController(pi, fans, control, telemetry_interval=max(TELEMETRY_INTERVAL_S, 300))
+    temps = []
+    while pi.now < minutes * 60:
+        temp, duty = controller.step(pi.now)
+        temps.append(temp)
+        pi.advance(SLEEP_TIME)
+    print(f"Simulated {minutes} minutes with {type(control).__name__}: "
+          f"temperature {min(temps):.1f}-{max(temps):.1f}C, "
+          f"throttled for {pi.throttled_s:.0f}s, {fans.changes} duty changes")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--control", choices=("curve", "pid"), default=FAN_CONTROL)
+    parser.add_argument("--simulate", action="store_true", help="Run against a thermal model with mock fans")
+    parser.add_argument("--minutes", type=float, default=60, help="Simulated time")
+    args = parser.parse_args()
+    control = PidController() if args.control == "pid" else CurveController()
+
+    if args.simulate:
+        simulate(control, args.minutes)
+        return
+
+    sensor = SysfsSensor() if os.path.exists(THERMAL_ZONE) else VcgencmdSensor()
+    if GPIO is not None:
+        fans = GpioFans()
+    else:
+        print("GPIO is not available. Fans will not be driven.")
+        fans = MockFans()
+    try:
+        FanController(sensor, fans, control).run()
     except KeyboardInterrupt:
         pass
     finally:
-        for fan in fans:
-            fan.stop()
-        GPIO.cleanup()
+        fans.close()
 
 if __name__ == "__main__":
     main()
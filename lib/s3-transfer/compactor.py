@@ -0,0 +1,152 @@
+# Compact the server's preference segments into batches partitioned by date and model.
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+COMPACTION_ENABLED = os.getenv("COMPACTION_ENABLED", "true").lower() == "true"
+COMPACTION_FORMAT = os.getenv("COMPACTION_FORMAT", "jsonl.gz")                 # Or parquet, which needs pyarrow
+COMPACTION_BATCH_RECORDS = int(os.getenv("COMPACTION_BATCH_RECORDS", "1000"))  # Flush once this many records are waiting...
+COMPACTION_MAX_AGE_S = int(os.getenv("COMPACTION_MAX_AGE_S", "3600"))          # ...or the oldest has waited this long
+
+PREFERENCES_DIR = "preferences"     # Written by the server's ResultsWriter
+ANALYTICS_DIR = "analytics"
+MANIFEST_NAME = ".compacting.json"  # Batch id and segments of an interrupted compaction
+
+def partition(record):
+    date = str(record.get("timestamp", ""))[:10] or "unknown"
+    return f"date={date}", f"model={record.get('model') or 'unknown'}"
+
+def batch_id_of(segments):
+    return hashlib.sha256("\n".join(segments).encode()).hexdigest()[:16]
+
+class Compactor:
+    """Turns many small preference segments into few large analytics files.
+
+    Sealed segments are left where they are until there are
+    COMPACTION_BATCH_RECORDS records or the oldest segment is
+    COMPACTION_MAX_AGE_S old. Their records are then written to
+    analytics/date=<day>/model=<model>/batch-<id>.<format> and the segments
+    are deleted. The batch id and segment list are saved to a manifest
+    first. If the process dies before the deletes start, the next run
+    rewrites the same files under the same id rather than duplicating
+    records. If it dies partway through them, every batch was already
+    written, so the next run only deletes the rest of the segments. Images
+    are not copied: records keep referring to images/<sha256>.png, which the
+    uploader ships as is.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.preferences_dir = os.path.join(root, PREFERENCES_DIR)
+        self.analytics_dir = os.path.join(root, ANALYTICS_DIR)
+        self.manifest_path = os.path.join(self.preferences_dir, MANIFEST_NAME)
+        self.format = COMPACTION_FORMAT
+        if self.format == "parquet" and pyarrow is None:
+            print("pyarrow not installed, compacting to jsonl.gz instead")
+            self.format = "jsonl.gz"
+
+    def segments(self):
+        if not os.path.isdir(self.preferences_dir):
+            return []
+        return sorted(name for name in os.listdir(self.preferences_dir) if name.endswith(".jsonl"))
+
+    def compact(self, force=False):
+        if os.path.exists(self.manifest_path):
+            self.resume()
+            return
+        segments = self.segments()
+        if not segments:
+            return
+        partitions, count, oldest = self.read(segments)
+        if not force and count < COMPACTION_BATCH_RECORDS and time.time() - oldest < COMPACTION_MAX_AGE_S:
+            return
+
+        batch_id = batch_id_of(segments)
+        with open(self.manifest_path + ".tmp", "w") as f:
+            json.dump({"batch_id": batch_id, "segments": segments}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+        written = self.write_batches(batch_id, partitions)
+        self.delete(segments)
+        print(f"Compacted {count} records from {len(segments)} segments into {written} batches")
+
+    def resume(self):
+        """Finish the compaction recorded in the manifest."""
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        if isinstance(manifest, list):      # Written before the manifest held the batch id
+            manifest = {"batch_id": batch_id_of(manifest), "segments": manifest}
+        segments = manifest["segments"]
+        present = set(self.segments())
+        if all(name in present for name in segments):
+            # Stopped before the deletes, maybe partway through the batches. Writing them
+            # again under the same id replaces any that were already written or uploaded
+            partitions, count, _ = self.read(segments)
+            written = self.write_batches(manifest["batch_id"], partitions)
+            print(f"Resumed compaction of {count} records from {len(segments)} segments into {written} batches")
+        else:
+            # Stopped partway through the deletes, so every batch had been written
+            print(f"Resumed deleting {len([name for name in segments if name in present])} compacted segments")
+        self.delete([name for name in segments if name in present])
+
+    def read(self, segments):
+        """Return the segments' records by partition, their count and the oldest segment's mtime."""
+        partitions = {}
+        oldest = time.time()
+        for name in segments:
+            path = os.path.join(self.preferences_dir, name)
+            oldest = min(oldest, os.path.getmtime(path))
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        partitions.setdefault(partition(record), []).append(record)
+        return partitions, sum(len(records) for records in partitions.values()), oldest
+
+    def write_batches(self, batch_id, partitions):
+        written = 0
+        for parts, records in sorted(partitions.items()):
+            directory = os.path.join(self.analytics_dir, *parts)
+            os.makedirs(directory, exist_ok=True)
+            for i in range(0, len(records), COMPACTION_BATCH_RECORDS):
+                path = os.path.join(directory, f"batch-{batch_id}-{i // COMPACTION_BATCH_RECORDS:03d}.{self.format}")
+                self.write_batch(path, records[i:i + COMPACTION_BATCH_RECORDS])
+                written += 1
+        return written
+
+    def delete(self, segments):
+        for name in segments:
+            os.remove(os.path.join(self.preferences_dir, name))
+        os.remove(self.manifest_path)
+
+    def write_batch(self, path, records):
+        if self.format == "parquet":
+            buffer = pyarrow.BufferOutputStream()
+            pyarrow.parquet.write_table(pyarrow.Table.from_pylist(records), buffer, compression="zstd")
+            data = buffer.getvalue().to_pybytes()
+        else:
+            buffer = io.BytesIO()
+            # mtime=0 so a rewrite after a crash produces an identical object
+            with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as f:
+                for record in records:
+                    f.write(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+            data = buffer.getvalue()
+
+        # Write under .tmp, which the uploader skips, and rename when complete
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
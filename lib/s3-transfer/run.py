@@ -1,29 +1,44 @@
-
 # Copy all files in dir to s3 bucket and delete them from local dir.
 
 import boto3
+import datetime
 import os
 from apscheduler.schedulers.blocking import BlockingScheduler
 
+from uploader import Uploader, ResultsEventHandler
+from compactor import Compactor, COMPACTION_ENABLED, PREFERENCES_DIR
 
-def main():
-    print("Starting scheduled run of main function")
-    s3=boto3.resource('s3')
-
-    bucket_name=os.getenv('BUCKET_NAME')
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
 
-    for subdir, dirs, files in os.walk("/results"):
+RESULTS_DIR = os.getenv("RESULTS_DIR", "/results")
+SCAN_INTERVAL_S = int(os.getenv("SCAN_INTERVAL_S", "600" if Observer else "60"))   # Catches anything notifications missed
+REPORT_INTERVAL_S = int(os.getenv("REPORT_INTERVAL_S", "300"))
+COMPACTION_INTERVAL_S = int(os.getenv("COMPACTION_INTERVAL_S", "60"))
 
-        for file in files:
-            full_path=os.path.join(subdir, file)
-            print(full_path)
-            s3.Bucket(bucket_name).upload_file(full_path, full_path)
-            print("Uploaded " + full_path)
-            os.remove(full_path)
 
-    print("Done")
-
-print("Process starting")
-scheduler=BlockingScheduler()
-scheduler.add_job(main, 'interval', hours = 1)
-scheduler.start()
+def main():
+    print("Process starting")
+    bucket_name=os.getenv('BUCKET_NAME')
+    # Preference segments are uploaded as compacted batches instead of one by one
+    exclude=[PREFERENCES_DIR] if COMPACTION_ENABLED else []
+    uploader=Uploader(boto3.client('s3'), bucket_name, RESULTS_DIR, exclude)
+
+    if Observer:
+        observer=Observer()
+        observer.schedule(ResultsEventHandler(uploader), RESULTS_DIR, recursive=True)
+        observer.start()
+        print("Watching " + RESULTS_DIR)
+    else:
+        print("watchdog not installed, falling back to scanning every %ds" % SCAN_INTERVAL_S)
+
+    scheduler=BlockingScheduler()
+    scheduler.add_job(uploader.scan, 'interval', seconds = SCAN_INTERVAL_S, next_run_time = datetime.datetime.now())
+    scheduler.add_job(uploader.report, 'interval', seconds = REPORT_INTERVAL_S)
+    if COMPACTION_ENABLED:
+        scheduler.add_job(Compactor(RESULTS_DIR).compact, 'interval', seconds = COMPACTION_INTERVAL_S)
+    scheduler.start()
+
+main()
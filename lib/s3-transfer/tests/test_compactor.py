@@ -0,0 +1,72 @@
+import gzip
+import json
+import os
+
+import pytest
+
+import compactor
+from compactor import Compactor, PREFERENCES_DIR, ANALYTICS_DIR
+
+def write_segments(root, ids_per_segment):
+    directory = os.path.join(root, PREFERENCES_DIR)
+    os.makedirs(directory)
+    for n, ids in enumerate(ids_per_segment):
+        with open(os.path.join(directory, f"segment-{n:04d}.jsonl"), "w") as f:
+            for id in ids:
+                f.write(json.dumps({"id": id, "timestamp": "2024-06-01 10:00:00", "model": "claude"}) + "\n")
+
+def upload(root, bucket):
+    """Do what the uploader does with finished batches: copy them by key, then delete them."""
+    analytics = os.path.join(root, ANALYTICS_DIR)
+    for directory, _, files in os.walk(analytics):
+        for name in files:
+            path = os.path.join(directory, name)
+            with gzip.open(path) as f:
+                bucket[os.path.relpath(path, root)] = [json.loads(line)["id"] for line in f]
+            os.remove(path)
+
+def test_crash_while_deleting_segments_does_not_duplicate_records(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    write_segments(root, [["r1"], ["r2"], ["r3"]])
+    real_remove = os.remove
+    removed = []
+
+    def crash_after_first_segment(path):
+        if path.endswith(".jsonl") and removed:
+            raise KeyboardInterrupt("power cut")
+        removed.append(path)
+        real_remove(path)
+
+    monkeypatch.setattr(compactor.os, "remove", crash_after_first_segment)
+    with pytest.raises(KeyboardInterrupt):
+        Compactor(root).compact(force=True)
+    monkeypatch.setattr(compactor.os, "remove", real_remove)
+
+    bucket = {}
+    upload(root, bucket)
+    Compactor(root).compact(force=True)
+    upload(root, bucket)
+
+    assert sorted(id for ids in bucket.values() for id in ids) == ["r1", "r2", "r3"]
+    assert os.listdir(os.path.join(root, PREFERENCES_DIR)) == []
+
+def test_crash_before_deleting_rewrites_the_same_batches(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    write_segments(root, [["r1", "r2"], ["r3"]])
+
+    def crash(self, segments):
+        raise KeyboardInterrupt("power cut")
+
+    monkeypatch.setattr(Compactor, "delete", crash)
+    with pytest.raises(KeyboardInterrupt):
+        Compactor(root).compact(force=True)
+    monkeypatch.undo()
+
+    bucket = {}
+    upload(root, bucket)
+    Compactor(root).compact(force=True)
+    upload(root, bucket)
+
+    assert len(bucket) == 1
+    assert sorted(next(iter(bucket.values()))) == ["r1", "r2", "r3"]
+    assert os.listdir(os.path.join(root, PREFERENCES_DIR)) == []
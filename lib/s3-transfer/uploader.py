@@ -0,0 +1,186 @@
+# Upload finished files under the results dir to S3, deleting them once S3 has a verified copy.
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.s3.transfer import TransferConfig
+
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+MULTIPART_THRESHOLD = int(os.getenv("MULTIPART_THRESHOLD", str(8 * 2**20)))
+MULTIPART_CHUNKSIZE = int(os.getenv("MULTIPART_CHUNKSIZE", str(8 * 2**20)))
+JOURNAL_NAME = ".upload-journal.jsonl"      # Lives in the results dir so it survives container restarts
+
+SKIP_SUFFIXES = (".open", ".tmp")           # Still being written by the server
+
+def should_upload(path):
+    name = os.path.basename(path)
+    return not name.startswith(".") and not name.endswith(SKIP_SUFFIXES)
+
+def expected_etag(path):
+    """The ETag S3 will report for path when uploaded with TransferConfig below.
+
+    With SSE-S3 (the bucket default) a single PUT has the MD5 of the object
+    as its ETag and a multipart upload has the MD5 of the part MD5s followed
+    by -<parts>.
+    """
+    size = os.path.getsize(path)
+    digests = []
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(MULTIPART_CHUNKSIZE), b""):
+            digests.append(hashlib.md5(chunk))
+    if size < MULTIPART_THRESHOLD:
+        return digests[0].hexdigest() if digests else hashlib.md5().hexdigest()
+    return hashlib.md5(b"".join(d.digest() for d in digests)).hexdigest() + f"-{len(digests)}"
+
+class Journal:
+    """Append-only record of verified uploads that haven't been deleted yet.
+
+    If the process dies between the upload and the delete, the next run
+    finds the path here with the same ETag and only has to delete it rather
+    than upload it again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.uploaded = {}      # path -> etag
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue        # Torn last line
+                    if entry["event"] == "uploaded":
+                        self.uploaded[entry["path"]] = entry["etag"]
+                    else:
+                        self.uploaded.pop(entry["path"], None)
+        # Rewrite with only the entries that still matter
+        self.uploaded = {p: etag for p, etag in self.uploaded.items() if os.path.exists(p)}
+        with open(path + ".tmp", "w") as f:
+            for p, etag in self.uploaded.items():
+                f.write(json.dumps({"event": "uploaded", "path": p, "etag": etag}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self.file = open(path, "a")
+
+    def append(self, event, path, etag=None):
+        with self.lock:
+            if event == "uploaded":
+                self.uploaded[path] = etag
+            else:
+                self.uploaded.pop(path, None)
+            self.file.write(json.dumps({"event": event, "path": path, "etag": etag}) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def etag(self, path):
+        with self.lock:
+            return self.uploaded.get(path)
+
+class Uploader:
+    """Uploads files through a bounded pool of workers sharing one S3 client.
+
+    Each path is queued at most once however often it is seen by scans and
+    filesystem events. A file is deleted only after S3 reports the ETag
+    computed locally, and only if it hasn't changed since it was hashed.
+    """
+
+    def __init__(self, client, bucket_name, root, exclude=()):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.root = root
+        self.exclude = [os.path.join(root, directory) + os.sep for directory in exclude]
+        self.journal = Journal(os.path.join(root, JOURNAL_NAME))
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=MULTIPART_CHUNKSIZE,
+            use_threads=False,      # Concurrency comes from the pool below
+        )
+        self.executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+        self.lock = threading.Lock()
+        self.pending = {}           # path -> size
+        self.uploaded_files = 0
+        self.uploaded_bytes = 0
+        self.failures = 0
+        self.last_report = (time.monotonic(), 0)
+
+    def submit(self, path):
+        if not should_upload(path) or path.startswith(tuple(self.exclude)):
+            return
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self.lock:
+            if path in self.pending:
+                return
+            self.pending[path] = size
+        self.executor.submit(self.upload, path)
+
+    def scan(self):
+        for subdir, dirs, files in os.walk(self.root):
+            for file in files:
+                self.submit(os.path.join(subdir, file))
+
+    def upload(self, path):
+        # Keys keep the /results/... layout the bucket already uses
+        key = path
+        try:
+            stat = os.stat(path)
+            etag = expected_etag(path)
+            if self.journal.etag(path) != etag:
+                self.client.upload_file(path, self.bucket_name, key, Config=self.transfer_config)
+            remote_etag = self.client.head_object(Bucket=self.bucket_name, Key=key)["ETag"].strip('"')
+            if remote_etag != etag:
+                raise ValueError(f"ETag mismatch for {key}: expected {etag}, S3 has {remote_etag}")
+            self.journal.append("uploaded", path, etag)
+
+            after = os.stat(path)
+            if (after.st_size, after.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                print(f"{path} changed during upload, will upload again")
+                return
+            os.remove(path)
+            self.journal.append("deleted", path)
+            with self.lock:
+                self.uploaded_files += 1
+                self.uploaded_bytes += stat.st_size
+            print("Uploaded " + path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            with self.lock:
+                self.failures += 1
+            print(f"Failed to upload {path}: {e}")
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+
+    def report(self):
+        now = time.monotonic()
+        with self.lock:
+            since, uploaded_bytes = self.last_report
+            self.last_report = (now, self.uploaded_bytes)
+            rate = (self.uploaded_bytes - uploaded_bytes) / max(now - since, 1e-6)
+            print(f"Uploaded {self.uploaded_files} files ({self.uploaded_bytes / 2**20:.1f} MB), "
+                  f"{rate / 2**10:.1f} KB/s, backlog {len(self.pending)} files "
+                  f"({sum(self.pending.values()) / 2**20:.1f} MB), {self.failures} failures")
+
+class ResultsEventHandler:
+    """watchdog handler that queues files once the server has finished writing them."""
+
+    def __init__(self, uploader):
+        self.uploader = uploader
+
+    def dispatch(self, event):
+        if event.is_directory:
+            return
+        if event.event_type == "moved":
+            self.uploader.submit(event.dest_path)
+        elif event.event_type == "closed":
+            self.uploader.submit(event.src_path)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+TRANSCRIBE_SAMPLE_RATE_HZ = int(os.getenv("TRANSCRIBE_SAMPLE_RATE_HZ", "16000"))  # Plenty for speech
+AUDIO_FRAME_MS = int(os.getenv("AUDIO_FRAME_MS", "100"))      # Audio coalesced into each Transcribe audio event
+AUDIO_BUFFER_MS = int(os.getenv("AUDIO_BUFFER_MS", "4000"))   # Ring capacity before new audio is dropped
+AUDIO_RESAMPLER_TAPS = 48
+
+def output_sample_rate(mic_rate, target_rate=TRANSCRIBE_SAMPLE_RATE_HZ):
+    """Rate audio is sent to Transcribe at: target_rate if the mic rate is a multiple of it, otherwise the mic rate."""
+    return target_rate if mic_rate % target_rate == 0 else mic_rate
+
+class AudioRingBuffer:
+    """Preallocated single-producer, single-consumer ring of int16 samples.
+
+    write() is called from the sounddevice callback thread and only copies
+    into the preallocated array. When the ring is full the newest samples
+    are dropped and counted in self.dropped.
+    """
+
+    def __init__(self, capacity, frame_len):
+        self.buffer = np.zeros(capacity, dtype=np.int16)
+        self.capacity = capacity
+        self.frame_len = frame_len
+        self.frame = np.zeros(frame_len, dtype=np.int16)
+        # Total samples written and read, only ever increased by their own thread
+        self.write_pos = 0
+        self.read_pos = 0
+        self.dropped = 0
+
+    def write(self, indata):
+        """Copy a block of raw int16 audio in. Returns True if a new full frame became available."""
+        samples = np.frombuffer(indata, dtype=np.int16)
+        free = self.capacity - (self.write_pos - self.read_pos)
+        if len(samples) > free:
+            self.dropped += len(samples) - free
+            samples = samples[:free]
+
+        n = len(samples)
+        start = self.write_pos % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:n - first] = samples[first:]
+
+        previous = self.write_pos
+        self.write_pos += n
+        return self.write_pos // self.frame_len != previous // self.frame_len
+
+    def read(self):
+        """Return the next full frame (a reused array), or None if there isn't one yet."""
+        if self.write_pos - self.read_pos < self.frame_len:
+            return None
+        start = self.read_pos % self.capacity
+        first = min(self.frame_len, self.capacity - start)
+        self.frame[:first] = self.buffer[start:start + first]
+        self.frame[first:] = self.buffer[:self.frame_len - first]
+        self.read_pos += self.frame_len
+        return self.frame
+
+class Resampler:
+    """Integer-factor decimating low-pass FIR resampler for int16 audio.
+
+    Filter history is carried between calls so consecutive frames join up
+    without clicks. Input lengths must be a multiple of the factor.
+    """
+
+    def __init__(self, in_rate, out_rate, taps=AUDIO_RESAMPLER_TAPS):
+        self.factor = in_rate // out_rate
+        n = np.arange(taps) - (taps - 1) / 2
+        cutoff = 0.45 / self.factor     # Just under the output Nyquist, relative to the input rate
+        h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+        self.taps = (h / h.sum())[::-1].astype(np.float32)
+        self.history = np.zeros(taps - 1, dtype=np.float32)
+
+    def process(self, samples):
+        if self.factor == 1:
+            return samples.copy()
+        x = np.concatenate((self.history, samples.astype(np.float32)))
+        y = sliding_window_view(x, len(self.taps))[::self.factor] @ self.taps
+        self.history = x[len(x) - len(self.history):]
+        return np.clip(np.rint(y), -32768, 32767).astype(np.int16)
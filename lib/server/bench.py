@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""End-to-end latency benchmark for server.py using the stand-ins in fakes.py.
+
+Runs the real server (WebSocket broadcast, transcription handling, A/B
+generation) in-process against fake Bedrock, Transcribe and microphone
+backends, connects N simulated kiosk clients and drives full rounds by
+pressing A/B over the socket. Client CPU is included in the per-round CPU
+figure as everything shares one process. With --sessions the server hosts
+several booths, each driven by its own clients, to measure throughput as
+booths are added.
+
+    python3 bench.py --rounds 20 --clients 4 --tokens-per-second 80
+    python3 bench.py --rounds 10 --sessions 4
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import tempfile
+import time
+
+from websockets import connect
+
+import server
+import server_state as server_state_module
+from fakes import FakeBedrock, FakeBedrockRuntime, FakeTranscribeStreamingClient, fake_mic_stream
+from region_pool import RegionPool
+from server_state import ServerState, SharedServices
+from session_recorder import SessionRecorder
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class BenchClient:
+    """A kiosk client that applies snapshot/delta messages and timestamps what it sees."""
+
+    def __init__(self, bench, session_id, driver):
+        self.bench = bench
+        self.session_id = session_id
+        self.driver = driver
+        self.data = {}
+        self.version = 0
+        self.first_output_seen = False
+        self.rounds = 0         # Rounds the session's driver has finished
+        self.round_start = time.monotonic()
+        self.inference_start = None
+        self.first_image_seen = False
+        self.pressed = False    # The driver has picked a side this round
+
+    async def run(self, url):
+        async with connect(url, max_size=None) as websocket:
+            self.websocket = websocket
+            async for raw in websocket:
+                now = time.monotonic()
+                message = json.loads(raw)
+                if message["type"] == "snapshot":
+                    self.version = message["version"]
+                    self.data = message["data"]
+                    continue
+                if message["version"] <= self.version:
+                    continue
+                self.version = message["version"]
+                self.data.update(message["set"])
+                for key, text in message["append"].items():
+                    self.data[key] = self.data.get(key, "") + text
+                    self.record_tokens(text, now)
+                for key, text in message["set"].items():
+                    if key in ("result_a", "result_b"):
+                        self.record_tokens(text, now)
+                await self.on_change(message, now)
+
+    def record_tokens(self, text, now):
+        for token in text.split():
+            produced = self.bench.bedrock.token_times.get(token)
+            if produced is not None:
+                self.bench.token_to_screen.append(now - produced)
+
+    async def on_change(self, message, now):
+        changed = {**message["set"], **message["append"]}
+        state = self.data.get("state")
+
+        output_keys = ("result_a", "result_b", "image_result_a", "image_result_b")
+        if not self.first_output_seen and any(changed.get(key) for key in output_keys):
+            self.first_output_seen = True
+            # The fake's speech end times can't be told apart between sessions
+            if self.bench.transcribe.speech_end_times and self.bench.args.sessions == 1:
+                self.bench.speech_end_to_first_output.append(now - self.bench.transcribe.speech_end_times[-1])
+
+        # Previews (PROGRESSIVE_IMAGES) show up during INFERENCE_IMG, the final images by REVIEW_IMG
+        if "state" in changed and state == "State.INFERENCE_IMG":
+            self.inference_start = now
+            self.first_image_seen = False
+        if self.inference_start is not None:
+            if not self.first_image_seen and (changed.get("image_result_a") or changed.get("image_result_b")):
+                self.first_image_seen = True
+                self.bench.image_first_pixel.append(now - self.inference_start)
+            if "state" in changed and state == "State.REVIEW_IMG":
+                self.bench.image_final.append(now - self.inference_start)
+                self.inference_start = None
+
+        if "state" in changed and state == "State.TRANSCRIBING":
+            self.first_output_seen = False
+            self.pressed = False
+            self.round_start = now
+            pressed_at = self.bench.pressed_at.get(self.session_id)
+            if pressed_at is not None:
+                self.bench.button_to_prompt.append(now - pressed_at)
+
+        reviewing = state in ("State.REVIEW_TXT", "State.REVIEW_IMG")
+        if self.driver and "state" in changed and reviewing:
+            self.bench.round_to_review.append(now - self.round_start)
+        # A side still generating after the other failed can't be picked until it's done
+        done = [side for side in ("a", "b") if self.data.get(f"progress_{side}") == "Progress.DONE"]
+        if self.driver and reviewing and done and not self.pressed:
+            self.pressed = True
+            await self.press(done[0])
+
+    async def press(self, side):
+        await asyncio.sleep(self.bench.args.review_delay)
+        self.rounds += 1
+        self.bench.round_finished()
+        if self.rounds >= self.bench.args.rounds:
+            self.bench.session_finished()
+            return
+        self.bench.pressed_at[self.session_id] = time.monotonic()
+        await self.websocket.send(side.upper())
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        # One fake region per latency multiplier
+        runtimes = {
+            f"fake-{i + 1}": FakeBedrockRuntime(
+                first_token_latency=args.first_token * scale,
+                tokens_per_second=args.tokens_per_second,
+                completion_tokens=args.completion_tokens,
+                image_latency=args.image_latency * scale,
+                image_size=args.image_size,
+                slow_fraction=args.slow_fraction,
+                slow_factor=args.slow_factor,
+            )
+            for i, scale in enumerate(float(scale) for scale in args.region_latency.split(","))
+        }
+        self.bedrock = next(iter(runtimes.values()))
+        self.region_pool = RegionPool(runtimes, {name: FakeBedrock() for name in runtimes})
+        self.transcribe = FakeTranscribeStreamingClient(
+            handshake_latency=args.handshake,
+            speech_duration=args.speech,
+            endpoint_delay=args.endpoint_delay,
+        )
+        self.rounds = 0
+        self.sessions_running = args.sessions
+        self.pressed_at = {}    # session -> when its driver last pressed A
+        self.done = asyncio.Event()
+        self.round_to_review = []
+        self.image_first_pixel = []
+        self.image_final = []
+        self.button_to_prompt = []
+        self.speech_end_to_first_output = []
+        self.token_to_screen = []
+        self.round_cpu = []
+        self.round_rss = []
+        self.round_started = (time.process_time(), rss_mb())
+
+    def round_finished(self):
+        # CPU and RSS are for the whole process, so per round only means something with one session
+        cpu, _ = self.round_started
+        self.round_cpu.append(time.process_time() - cpu)
+        self.round_rss.append(rss_mb())
+        self.round_started = (time.process_time(), rss_mb())
+        self.rounds += 1
+
+    def session_finished(self):
+        self.sessions_running -= 1
+        if not self.sessions_running:
+            self.done.set()
+
+    async def run(self):
+        shared = SharedServices(region_pool=self.region_pool, sessions=self.args.sessions)
+        sessions = [ServerState(shared=shared, session_id=f"booth{i + 1}",
+                                recorder=SessionRecorder.from_env() if i == 0 else None)
+                    for i in range(self.args.sessions)]
+        server_task = asyncio.create_task(server.main(
+            sessions=sessions,
+            transcribe_client=self.transcribe,
+            audio_source=fake_mic_stream(self.args.speech, server.TRANSCRIBE_RATE_HZ),
+        ))
+        await asyncio.sleep(0.5)
+
+        url = f"ws://{server.WEBSOCKET_IP}:{server.WEBSOCKET_PORT}"
+        clients = [BenchClient(self, session.session_id, driver=(i == 0))
+                   for session in sessions for i in range(self.args.clients)]
+        started = time.monotonic()
+        client_tasks = [asyncio.create_task(client.run(f"{url}/{client.session_id}")) for client in clients]
+        await self.done.wait()
+        elapsed = time.monotonic() - started
+
+        for task in client_tasks + [server_task]:
+            task.cancel()
+        self.report(elapsed)
+
+    def report(self, elapsed):
+        print(f"\n{self.rounds} rounds, {self.args.sessions} sessions, {self.args.clients} clients each, "
+              f"{self.rounds / elapsed * 60:.1f} rounds/min")
+        print(f"{'metric':<32}{'p50':>10}{'p95':>10}{'p99':>10}{'n':>8}")
+        for name, values, scale, unit in (
+            ("round-to-review", self.round_to_review, 1000, "ms"),
+            ("button-to-prompt", self.button_to_prompt, 1000, "ms"),
+            ("speech-end-to-first-output", self.speech_end_to_first_output, 1000, "ms"),
+            ("token-to-screen", self.token_to_screen, 1000, "ms"),
+            ("image time-to-first-pixel", self.image_first_pixel, 1000, "ms"),
+            ("image time-to-final", self.image_final, 1000, "ms"),
+            ("cpu per round", self.round_cpu, 1000, "ms"),
+            ("rss after round", self.round_rss, 1, "MB"),
+        ):
+            row = "".join(f"{percentile(values, p) * scale:>8.1f}{unit}" for p in (50, 95, 99))
+            print(f"{name:<32}{row}{len(values):>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--clients", type=int, default=1, help="Kiosk clients per session")
+    parser.add_argument("--sessions", type=int, default=1, help="Booths hosted by the server")
+    parser.add_argument("--first-token", type=float, default=0.4, help="Claude time to first token (s)")
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--completion-tokens", type=int, default=60)
+    parser.add_argument("--image-latency", type=float, default=3.0, help="SDXL latency at 50 steps (s)")
+    parser.add_argument("--image-size", type=int, default=1024, help="SDXL image edge (px)")
+    parser.add_argument("--slow-fraction", type=float, default=0.0, help="Share of Bedrock calls with a latency spike")
+    parser.add_argument("--slow-factor", type=float, default=10, help="How much slower a spiked call is")
+    parser.add_argument("--region-latency", default="1", help="Comma separated latency multipliers, one fake region each")
+    parser.add_argument("--handshake", type=float, default=0.3, help="Transcribe stream setup latency (s)")
+    parser.add_argument("--speech", type=float, default=1.5, help="How long the simulated guest talks (s)")
+    parser.add_argument("--endpoint-delay", type=float, default=0.8, help="Transcribe endpointing delay (s)")
+    parser.add_argument("--review-delay", type=float, default=0.2, help="Time before the simulated guest presses A (s)")
+    args = parser.parse_args()
+
+    server_state_module.results_dir = tempfile.mkdtemp(prefix="bench-results-")
+    asyncio.run(Bench(args).run())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""Local stand-ins for Bedrock runtime, Transcribe streaming and the microphone.
+
+They mimic just enough of the real APIs for ServerState and server.py to run
+full rounds offline, with configurable latencies, token rates and image
+sizes. Timestamps of what they produce are kept so bench.py can measure
+end-to-end latency against them.
+"""
+
+import asyncio
+import base64
+import io
+import itertools
+import json
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from amazon_transcribe.model import Alternative, Result, Transcript, TranscriptEvent
+
+def make_png(size):
+    """Build a size x size RGB PNG of random pixels, roughly as large as an SDXL output."""
+    rows = np.frombuffer(os.urandom(size * size * 3), dtype=np.uint8).reshape(size, size * 3)
+    raw = np.hstack((np.zeros((size, 1), dtype=np.uint8), rows)).tobytes()  # Filter type 0 per row
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 1))
+            + chunk(b"IEND", b""))
+
+class FakeValidationException(Exception):
+    """What botocore raises for a request Bedrock rejects, with the service's response attached."""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.response = {"Error": {"Code": "ValidationException", "Message": message}}
+
+class FakeBedrockRuntime:
+    """Stand-in for the boto3 bedrock-runtime client.
+
+    Token ids and times are shared by all instances, so several of them can
+    stand in for different regions.
+    """
+
+    token_ids = itertools.count()
+    token_times = {}            # token text -> time.monotonic() it was produced
+    lock = threading.Lock()
+
+    def __init__(self, first_token_latency=0.4, tokens_per_second=50, completion_tokens=60,
+                 image_latency=3.0, image_size=1024, slow_fraction=0.0, slow_factor=10):
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.image_latency = image_latency
+        self.image_size = image_size
+        self.slow_fraction = slow_fraction      # Share of calls that hit a latency spike
+        self.slow_factor = slow_factor
+
+    def latency(self, latency):
+        return latency * self.slow_factor if random.random() < self.slow_fraction else latency
+
+    def invoke_model(self, **kwargs):
+        body = json.loads(kwargs.get("body") or "{}")
+        if "text_prompts" not in body:
+            raise FakeValidationException("Malformed input request")
+        # Render time is proportional to the diffusion steps, image_latency being for 50
+        steps = body.get("steps", 50)
+        time.sleep(self.latency(self.image_latency * steps / 50))
+        image = base64.b64encode(make_png(self.image_size)).decode()
+        body = json.dumps({"artifacts": [{"base64": image, "finishReason": "SUCCESS"}]}).encode()
+        return {"body": io.BytesIO(body), "contentType": "application/json"}
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        return {"body": self.stream_tokens(), "contentType": "application/json"}
+
+    def stream_tokens(self):
+        time.sleep(self.latency(self.first_token_latency))
+        for i in range(self.completion_tokens):
+            if i:
+                time.sleep(1 / self.tokens_per_second)
+            with self.lock:
+                token = f"t{next(self.token_ids)} "
+                self.token_times[token.strip()] = time.monotonic()
+            delta = {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": token}}
+            yield {"chunk": {"bytes": json.dumps(delta).encode()}}
+
+class FakeBedrock:
+    """Stand-in for the boto3 bedrock (control plane) client, for region probes."""
+
+    def __init__(self, latency=0.05, fail=False):
+        self.latency = latency
+        self.fail = fail
+
+    def list_foundation_models(self, **kwargs):
+        time.sleep(self.latency)
+        if self.fail:
+            raise ConnectionError("Fake region is down")
+        return {"modelSummaries": []}
+
+class FakeInputStream:
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def send_audio_event(self, audio_chunk):
+        self.stream.on_audio(audio_chunk)
+
+    async def end_stream(self):
+        self.stream.ended.set()
+
+class FakeTranscribeStream:
+    """Emits partial transcripts while the guest 'speaks', then a final one.
+
+    Speech starts with the first non-silent audio event and lasts
+    speech_duration. The final transcript follows endpoint_delay later, or
+    shortly after the input stream is ended, whichever comes first.
+    """
+
+    def __init__(self, client, transcript):
+        self.client = client
+        self.transcript = transcript
+        self.speech_started = asyncio.Event()
+        self.ended = asyncio.Event()
+        self.input_stream = FakeInputStream(self)
+        self.output_stream = self.events()
+
+    def on_audio(self, audio_chunk):
+        if not self.speech_started.is_set() and any(audio_chunk):
+            self.speech_start = time.monotonic()
+            self.speech_started.set()
+
+    def event(self, text, is_partial):
+        result = Result(result_id="fake", is_partial=is_partial,
+                        alternatives=[Alternative(transcript=text, items=[], entities=[])])
+        return TranscriptEvent(transcript=Transcript(results=[result]))
+
+    async def events(self):
+        await self.speech_started.wait()
+        words = self.transcript.split()
+        step = self.client.speech_duration / len(words)
+        for i in range(1, len(words) + 1):
+            await asyncio.sleep(step)
+            yield self.event(" ".join(words[:i]), True)
+
+        self.client.speech_end_times.append(time.monotonic())
+        try:
+            await asyncio.wait_for(self.ended.wait(), self.client.endpoint_delay)
+        except asyncio.TimeoutError:
+            pass
+        yield self.event(self.transcript[0].upper() + self.transcript[1:] + ".", False)
+        await self.ended.wait()
+
+class FakeTranscribeStreamingClient:
+    """Stand-in for amazon_transcribe's TranscribeStreamingClient."""
+
+    def __init__(self, handshake_latency=0.3, speech_duration=1.5, endpoint_delay=0.8,
+                 transcripts=("a cat in space wearing a suit", "what colour is the suit")):
+        self.handshake_latency = handshake_latency
+        self.speech_duration = speech_duration
+        self.endpoint_delay = endpoint_delay
+        self.transcripts = itertools.cycle(transcripts)
+        self.speech_end_times = []
+
+    async def start_stream_transcription(self, **kwargs):
+        await asyncio.sleep(self.handshake_latency)
+        return FakeTranscribeStream(self, next(self.transcripts))
+
+def fake_mic_stream(speech_duration=1.5, sample_rate=16000, frame_ms=100):
+    """Return a replacement for server.mic_stream that 'speaks' a tone, then stays silent."""
+    frame_len = sample_rate * frame_ms // 1000
+    t = np.arange(frame_len) / sample_rate
+    tone = (6000 * np.sin(2 * np.pi * 220 * t)).astype(np.int16).tobytes()
+    silence = bytes(2 * frame_len)
+
+    async def mic_stream(server_state):
+        start = time.monotonic()
+        while True:
+            await asyncio.sleep(frame_ms / 1000)
+            yield tone if time.monotonic() - start < speech_duration else silence
+
+    return mic_stream
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import threading
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+
+from states import Progress
+from tracing import tracer
+
+class GenerationCancelled(Exception):
+    """Raised inside a generation thread once its Generation has been cancelled."""
+
+class GenerationTimeout(TimeoutError):
+    """Raised inside a generation thread when a side misses the deadline of a stage."""
+
+class Generation:
+    """One A/B generation for a prompt.
+
+    All output of the Bedrock calls goes through this object. While it is
+    attached (the normal case) writes go straight to the ServerState and so
+    to the UI. A speculative generation starts detached: its output is
+    buffered until attach() copies it over, or it is thrown away by cancel().
+
+    A generation belongs to the round it was started in. Once the round is
+    over it is stale, and whatever it still produces is dropped. Each side's
+    Bedrock calls are waited on with wait_for() inside deadline() blocks, so
+    a cancelled or timed out side stops waiting straight away and the call
+    is left to finish on its own.
+    """
+
+    def __init__(self, server_state, prompt, model, attached=True):
+        self.server_state = server_state
+        self.prompt = prompt
+        self.model = model
+        self.round_number = server_state.round_number
+        self.attached = attached
+        self.cancelled = False
+        self.lock = threading.Lock()
+        # Resolved when a side should stop waiting on Bedrock, by cancel() or a missed deadline
+        self.stopped = {'a': Future(), 'b': Future()}
+        self.timed_out = {}     # side -> GenerationTimeout
+        # Buffered output while detached
+        self.state = None
+        self.results = {'a': "", 'b': ""}
+        self.images = {'a': "", 'b': ""}
+        self.regions = {'a': "", 'b': ""}
+        self.progress = {'a': Progress.IDLE, 'b': Progress.IDLE}
+        # Generation cache variants already used by a side, so A and B differ
+        self.cache_used = set()
+
+    @property
+    def stale(self):
+        """True once the ServerState has moved on to another round."""
+        return self.round_number != self.server_state.round_number
+
+    def check(self, side=None):
+        """Raise GenerationCancelled if this generation should stop, or
+        GenerationTimeout if the given side missed a deadline."""
+        if self.cancelled or self.stale:
+            raise GenerationCancelled(f"Generation for '{self.prompt}' was cancelled")
+        if side in self.timed_out:
+            raise self.timed_out[side]
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for stopped in self.stopped.values():
+                if not stopped.done():
+                    stopped.set_result(None)
+
+    @contextmanager
+    def deadline(self, side, stage, seconds):
+        """Time out side if the with block takes longer than seconds. No deadline if seconds is 0."""
+        if not seconds:
+            yield
+            return
+        timer = threading.Timer(seconds, self.expire, (side, stage, seconds))
+        timer.daemon = True
+        timer.start()
+        try:
+            yield
+        finally:
+            timer.cancel()
+
+    def expire(self, side, stage, seconds):
+        with self.lock:
+            if self.stopped[side].done():
+                return
+            self.timed_out[side] = GenerationTimeout(f"Response {side.upper()} took longer than {seconds:g}s to {stage}")
+            self.stopped[side].set_result(None)
+        tracer.record("generation_timeout", seconds, {"model": self.model, "stage": stage}, trace=False)
+
+    def wait_for(self, side, future, release=None):
+        """Return the result of a Bedrock call running in future, unless side is
+        stopped first. Then the call is abandoned, with release(result) called
+        once it finishes, and GenerationCancelled or GenerationTimeout raised."""
+        wait([future, self.stopped[side]], return_when=FIRST_COMPLETED)
+        try:
+            self.check(side)
+        except (GenerationCancelled, GenerationTimeout):
+            if release:
+                future.add_done_callback(lambda f: f.exception() is None and release(f.result()))
+            raise
+        return future.result()
+
+    def iterate(self, side, events, executor, release=None):
+        """Yield from the iterable events, reading each one on executor with wait_for()."""
+        events = iter(events)
+        while (event := self.wait_for(side, executor.submit(next, events, None), release)) is not None:
+            yield event
+
+    def attach(self):
+        """Copy anything buffered so far to the ServerState and write through from now on."""
+        with self.lock:
+            if self.attached:
+                return
+            self.attached = True
+            for side in ('a', 'b'):
+                self.server_state.set_progress(side, self.progress[side])
+                self.server_state.append_result(side, self.results[side])
+                if self.images[side]:
+                    self.server_state.set_image_result(side, self.images[side])
+                self.server_state.set_region(side, self.regions[side])
+            if self.state is not None:
+                self.server_state.my_state = self.state
+
+    def set_state(self, state):
+        with self.lock:
+            self.check()
+            self.state = state
+            if self.attached:
+                self.server_state.my_state = state
+
+    def set_progress(self, side, progress):
+        with self.lock:
+            self.progress[side] = progress
+            if self.attached and not self.stale:
+                self.server_state.set_progress(side, progress)
+
+    def append_result(self, side, text):
+        with self.lock:
+            self.check(side)
+            self.results[side] += text
+            if self.attached:
+                self.server_state.append_result(side, text)
+
+    def set_image_result(self, side, image):
+        with self.lock:
+            self.check(side)
+            self.images[side] = image
+            if self.attached:
+                self.server_state.set_image_result(side, image)
+
+    def set_region(self, side, region):
+        with self.lock:
+            self.regions[side] = region
+            if self.attached and not self.stale:
+                self.server_state.set_region(side, region)
+
+    def result(self, side):
+        return self.results[side]
+
+    def image(self, side):
+        return self.images[side]
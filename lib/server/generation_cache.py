@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from tracing import tracer
+
+GENERATION_CACHE = os.getenv("GENERATION_CACHE", "false").lower() == "true"
+# Not under /results, which gets shipped to S3, or the working directory, which is the source tree in local dev
+GENERATION_CACHE_DIR = os.getenv("GENERATION_CACHE_DIR", os.path.join(tempfile.gettempdir(), "karaoke-generation-cache"))
+GENERATION_CACHE_MAX_BYTES = int(os.getenv("GENERATION_CACHE_MAX_BYTES", str(500 * 2**20)))
+GENERATION_CACHE_VARIANTS = int(os.getenv("GENERATION_CACHE_VARIANTS", "4"))  # Variants kept per key
+GENERATION_CACHE_REFRESH = float(os.getenv("GENERATION_CACHE_REFRESH", "0.5"))  # Chance of a fresh variant while the pool isn't full
+
+def normalize_prompt(prompt):
+    """Lower case, drop punctuation and collapse whitespace so "A dragon." and "a dragon" share a key."""
+    return " ".join(re.sub(r"[^\w\s]", " ", prompt.lower()).split())
+
+def cache_key(prompt, model_id, params, image_hash=""):
+    data = json.dumps([normalize_prompt(prompt), model_id, params, image_hash], sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+class GenerationCache:
+    """Disk-backed cache of previous generations, with a pool of variants per key.
+
+    Each key keeps up to GENERATION_CACHE_VARIANTS different outputs so the
+    A and B sides can still be served two different results. The index of
+    keys and variants is kept in memory in LRU order and rebuilt from the
+    files on startup. The least recently used keys are evicted once the files
+    exceed max_bytes.
+    """
+
+    def __init__(self, directory=GENERATION_CACHE_DIR, max_bytes=GENERATION_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index = OrderedDict()      # key -> {variant name: size}, names are "<content hash>-<latency>"
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+        os.makedirs(directory, exist_ok=True)
+        self.load_index()
+
+    def path(self, key, variant_id=None):
+        return os.path.join(self.directory, key, variant_id) if variant_id else os.path.join(self.directory, key)
+
+    def load_index(self):
+        entries = []
+        for key in os.listdir(self.directory):
+            key_dir = self.path(key)
+            if not os.path.isdir(key_dir):
+                continue
+            for name in os.listdir(key_dir):
+                if name.endswith(".tmp"):
+                    continue
+                stat = os.stat(os.path.join(key_dir, name))
+                entries.append((stat.st_mtime, key, name, stat.st_size))
+        for _, key, name, size in sorted(entries):
+            self.index.setdefault(key, {})[name] = size
+            self.index.move_to_end(key)
+            self.total_bytes += size
+        print(f"Generation cache has {len(self.index)} keys, {self.total_bytes / 2**20:.1f} MB")
+
+    def take(self, key, used):
+        """Return cached bytes for key that aren't in used (variant names already
+        shown this round), or None if a fresh generation is needed. The chosen
+        variant is added to used."""
+        start = time.monotonic()
+        with self.lock:
+            variants = self.index.get(key, {})
+            available = [name for name in variants if name not in used]
+            # Keep generating until the pool is full, so repeats still get some variety
+            if not available or (len(variants) < GENERATION_CACHE_VARIANTS and random.random() < GENERATION_CACHE_REFRESH):
+                self.misses += 1
+                tracer.record("generation_cache_lookup", time.monotonic() - start, {"result": "miss"}, trace=False)
+                return None
+            name = random.choice(available)
+            used.add(name)
+            self.index.move_to_end(key)
+
+        try:
+            with open(self.path(key, name), "rb") as f:
+                data = f.read()
+            os.utime(self.path(key, name))
+        except OSError:
+            with self.lock:
+                self.forget(key, name)
+            return None
+
+        latency = float(name.partition("-")[2] or 0)
+        with self.lock:
+            self.hits += 1
+            self.latency_saved += latency
+        tracer.record("generation_cache_lookup", time.monotonic() - start, {"result": "hit"}, trace=False)
+        tracer.record("generation_cache_saved", latency, trace=False)
+        print(f"Generation cache hit ({self.hits / (self.hits + self.misses):.0%} hit ratio, {self.latency_saved:.1f}s saved)")
+        return data
+
+    def put(self, key, data, latency, used):
+        """Store a freshly generated variant along with how long it took to produce."""
+        name = f"{hashlib.sha256(data).hexdigest()[:16]}-{latency:.3f}"
+        os.makedirs(self.path(key), exist_ok=True)
+        temp_path = self.path(key, name) + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, self.path(key, name))
+
+        with self.lock:
+            used.add(name)
+            variants = self.index.setdefault(key, {})
+            if name not in variants:
+                variants[name] = len(data)
+                self.total_bytes += len(data)
+            self.index.move_to_end(key)
+            # Cap the pool per key, then the whole cache
+            while len(variants) > GENERATION_CACHE_VARIANTS:
+                self.forget(key, next(iter(variants)))
+            while self.total_bytes > self.max_bytes and len(self.index) > 1:
+                oldest = next(iter(self.index))
+                for variant in list(self.index[oldest]):
+                    self.forget(oldest, variant)
+
+    def forget(self, key, name):
+        """Drop a variant from the index and disk. Call with self.lock held."""
+        variants = self.index.get(key, {})
+        size = variants.pop(name, 0)
+        self.total_bytes -= size
+        if not variants:
+            self.index.pop(key, None)
+        try:
+            os.remove(self.path(key, name))
+            if not variants:
+                os.rmdir(self.path(key))
+        except OSError:
+            pass
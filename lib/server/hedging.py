@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from tracing import tracer
+
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))       # Hedge calls slower than this percentile
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))       # Don't hedge until the percentile means something
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))                # Latencies kept per model
+HEDGE_BUDGET_RATIO = float(os.getenv("HEDGE_BUDGET_RATIO", "0.1"))  # Hedges earned per request
+HEDGE_BUDGET_MAX = float(os.getenv("HEDGE_BUDGET_MAX", "5"))        # Most hedges that can be saved up
+
+class LatencyTracker:
+    """Rolling window of call latencies per model ID."""
+
+    def __init__(self, window=HEDGE_WINDOW):
+        self.lock = threading.Lock()
+        self.window = window
+        self.latencies = {}     # model_id -> deque of seconds
+
+    def record(self, model_id, latency):
+        with self.lock:
+            self.latencies.setdefault(model_id, deque(maxlen=self.window)).append(latency)
+
+    def percentile(self, model_id, p):
+        """The p-th percentile latency for model_id, or None with fewer than HEDGE_MIN_SAMPLES calls."""
+        with self.lock:
+            values = sorted(self.latencies.get(model_id, ()))
+        if len(values) < HEDGE_MIN_SAMPLES:
+            return None
+        return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+class RetryBudget:
+    """Token bucket shared by all models that limits hedges to a share of requests.
+
+    Each request deposits HEDGE_BUDGET_RATIO tokens and each hedge spends a
+    whole one. During an outage every call is slow, and this stops hedging
+    from doubling the load on Bedrock.
+    """
+
+    def __init__(self, ratio=HEDGE_BUDGET_RATIO, maximum=HEDGE_BUDGET_MAX):
+        self.lock = threading.Lock()
+        self.ratio = ratio
+        self.maximum = maximum
+        self.tokens = maximum
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class Hedger:
+    """Sends a duplicate of a Bedrock call that is slower than usual and uses whichever answers first.
+
+    A call waits for its model's HEDGE_PERCENTILE latency, counted from when
+    the attempt starts running rather than while it waits for a worker. If
+    there's no answer by then, and the retry budget allows it, the same request is sent
+    again. The first successful attempt wins, and release() is called on the
+    loser's result when it arrives so it can close a response stream. A
+    blocking invoke_model can't be interrupted, so a losing one is left to
+    finish and its result dropped.
+    """
+
+    def __init__(self, enabled=HEDGE_ENABLED, tracker=None, budget=None, max_workers=8):
+        self.enabled = enabled
+        self.tracker = tracker or LatencyTracker()
+        self.budget = budget or RetryBudget()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bedrock")
+        self.lock = threading.Lock()
+        self.stats = {}         # model_id -> [requests, hedges, hedge wins]
+
+    def attempt(self, model_id, request, started=None):
+        if started:
+            started.set()
+        start = time.monotonic()
+        result = request()
+        self.tracker.record(model_id, time.monotonic() - start)
+        return result
+
+    def call(self, model_id, request, release=None, labels=None):
+        """Return request() for model_id, hedging it if it's slow."""
+        if not self.enabled:
+            return request()
+
+        self.budget.deposit()
+        start = time.monotonic()
+        started = threading.Event()
+        attempts = [self.executor.submit(self.attempt, model_id, request, started)]
+        threshold = self.tracker.percentile(model_id, HEDGE_PERCENTILE)
+        if threshold is not None:
+            # Time queued for a worker isn't the call being slow
+            started.wait()
+        done, _ = wait(attempts, timeout=threshold)
+        if not done and self.budget.withdraw():
+            print(f"Hedging {model_id} request after {threshold:.2f}s")
+            attempts.append(self.executor.submit(self.attempt, model_id, request))
+
+        winner = None
+        pending = set(attempts)
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((attempt for attempt in attempts if attempt in done and attempt.exception() is None), None)
+
+        hedged = len(attempts) > 1
+        self.record(model_id, hedged, winner is not None and winner is not attempts[0])
+        tracer.record("bedrock_request", time.monotonic() - start,
+                      {**(labels or {}), "hedged": str(hedged).lower()}, trace=False)
+        if winner is None:
+            raise attempts[0].exception()
+
+        for loser in attempts:
+            if loser is not winner and release:
+                loser.add_done_callback(lambda f: f.exception() is None and release(f.result()))
+        return winner.result()
+
+    def record(self, model_id, hedged, hedge_won):
+        with self.lock:
+            stats = self.stats.setdefault(model_id, [0, 0, 0])
+            stats[0] += 1
+            stats[1] += hedged
+            stats[2] += hedge_won
+            requests, hedges, wins = stats
+        if hedged:
+            p50 = self.tracker.percentile(model_id, 50)
+            p99 = self.tracker.percentile(model_id, 99)
+            print(f"Hedged {hedges} of {requests} {model_id} requests ({hedges / requests:.0%}), "
+                  f"hedge won {wins}, p50 {p50:.2f}s p99 {p99:.2f}s")
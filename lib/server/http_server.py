@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import asyncio
+
+REQUEST_TIMEOUT = 30            # Seconds to wait for the next request on a keep-alive connection
+MAX_HEADER_LINES = 100
+
+STATUS_TEXT = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+}
+
+class HttpServer:
+    """Minimal HTTP/1.1 GET server that runs next to the WebSocket server.
+
+    Handlers are registered per path prefix with route() and are called as
+    handler(path, headers) -> (status, headers, body), where headers are a
+    dict with lower-cased names and body is bytes.
+    """
+
+    def __init__(self):
+        self.routes = []
+
+    def route(self, prefix, handler):
+        """Register a handler for every path starting with prefix."""
+        self.routes.append((prefix, handler))
+
+    def dispatch(self, path, headers):
+        for prefix, handler in self.routes:
+            if path.startswith(prefix):
+                return handler(path, headers)
+        return 404, {}, b""
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self.respond(writer, 400, {}, b"", keep_alive=False)
+                    break
+
+                headers = {}
+                for _ in range(MAX_HEADER_LINES):
+                    line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                if method not in ("GET", "HEAD"):
+                    await self.respond(writer, 405, {}, b"", keep_alive)
+                else:
+                    status, response_headers, body = self.dispatch(target.split("?")[0], headers)
+                    await self.respond(writer, status, response_headers, b"" if method == "HEAD" else body, keep_alive, len(body))
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, headers, body, keep_alive, content_length=None):
+        lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}"]
+        headers = {
+            "Content-Length": str(len(body) if content_length is None else content_length),
+            "Connection": "keep-alive" if keep_alive else "close",
+            "Access-Control-Allow-Origin": "*",
+            **headers,
+        }
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def serve(self, host, port):
+        """Serve forever on host:port."""
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"HTTP server listening on {host}:{port}")
+        async with server:
+            await server.serve_forever()
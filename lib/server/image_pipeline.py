@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import base64
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    print("Pillow is not available. Images will be sent at full size.")
+    Image = None
+
+# Image sent to Claude alongside the question
+VISION_MAX_EDGE = int(os.getenv("VISION_MAX_EDGE", "768"))
+VISION_FORMAT = os.getenv("VISION_FORMAT", "JPEG")      # JPEG | WEBP
+VISION_QUALITY = int(os.getenv("VISION_QUALITY", "85"))
+# Image shown in the A/B panes of the kiosk UI
+THUMB_MAX_EDGE = int(os.getenv("THUMB_MAX_EDGE", "512"))
+THUMB_FORMAT = os.getenv("THUMB_FORMAT", "WEBP")        # JPEG | WEBP
+THUMB_QUALITY = int(os.getenv("THUMB_QUALITY", "75"))
+
+THUMB_PATH_PREFIX = "/thumbs/"
+MEDIA_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+class ImagePipeline:
+    """Produces the right-sized variants of each stored image.
+
+    Every image is processed once, on a worker thread, into a downscaled
+    JPEG/WebP for the Claude vision call (already base64 encoded) and a
+    small thumbnail for the UI. Results are memoized per content hash.
+    """
+
+    def __init__(self, image_store, max_images=16):
+        self.image_store = image_store
+        self.max_images = max_images
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image")
+        self.lock = threading.Lock()
+        self.results = OrderedDict()   # hash -> Future of {"vision": (media_type, b64), "thumbnail": (media_type, bytes)}
+
+    def prepare(self, digest):
+        """Start processing an image (once) and return a Future of its variants."""
+        with self.lock:
+            future = self.results.get(digest)
+            if future is None:
+                future = self.executor.submit(self.process, digest)
+                self.results[digest] = future
+                while len(self.results) > self.max_images:
+                    self.results.popitem(last=False)
+            return future
+
+    def vision(self, digest):
+        """Return (media_type, base64 data) of the image to send to Claude. Blocks until ready."""
+        return self.prepare(digest).result()["vision"]
+
+    def thumbnail(self, digest):
+        """Return (media_type, bytes) of the UI thumbnail. Blocks until ready."""
+        return self.prepare(digest).result()["thumbnail"]
+
+    def process(self, digest):
+        data = self.image_store.get(digest)
+        if data is None:
+            raise KeyError(f"Image {digest} is not in the store")
+
+        if Image is None:
+            return {
+                "vision": ("image/png", base64.b64encode(data).decode()),
+                "thumbnail": ("image/png", data),
+            }
+
+        with Image.open(io.BytesIO(data)) as image:
+            image = image.convert("RGB")
+            vision = encode(image, VISION_MAX_EDGE, VISION_FORMAT, VISION_QUALITY)
+            thumbnail = encode(image, THUMB_MAX_EDGE, THUMB_FORMAT, THUMB_QUALITY)
+        return {
+            "vision": (vision[0], base64.b64encode(vision[1]).decode()),
+            "thumbnail": thumbnail,
+        }
+
+    def handle_request(self, path, headers):
+        """HttpServer handler for /thumbs/<hash>"""
+        digest = path[len(THUMB_PATH_PREFIX):].split(".")[0]
+        with self.lock:
+            future = self.results.get(digest)
+        # Never block the event loop waiting for a thumbnail
+        if future is None or not future.done() or future.exception():
+            return 404, {}, b""
+
+        media_type, data = future.result()["thumbnail"]
+        response_headers = {
+            "ETag": f'"{digest}-thumb"',
+            "Cache-Control": "public, max-age=31536000, immutable",
+        }
+        if headers.get("if-none-match") == f'"{digest}-thumb"':
+            return 304, response_headers, b""
+        return 200, {**response_headers, "Content-Type": media_type}, data
+
+def encode(image, max_edge, image_format, quality):
+    """Downscale image to fit max_edge and re-encode it. Returns (media_type, bytes)."""
+    if max(image.size) > max_edge:
+        image = image.copy()
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format=image_format, quality=quality)
+    return MEDIA_TYPES.get(image_format.upper(), "application/octet-stream"), output.getvalue()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+
+IMAGE_STORE_MAX_IMAGES = 16     # Enough for several rounds of A/B images
+IMAGE_PATH_PREFIX = "/images/"
+
+class ImageStore:
+    """In-memory, content-addressed store for generated images.
+
+    Each image is decoded from base64 once and kept as raw bytes under the
+    sha256 of its content, so the rest of the server only passes hashes
+    around. The least recently used images are evicted beyond max_images.
+    """
+
+    def __init__(self, max_images=IMAGE_STORE_MAX_IMAGES):
+        self.max_images = max_images
+        self.lock = threading.Lock()
+        self.images = OrderedDict()
+
+    def put(self, data):
+        """Store raw image bytes and return their content hash."""
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            self.images[digest] = data
+            self.images.move_to_end(digest)
+            while len(self.images) > self.max_images:
+                self.images.popitem(last=False)
+        return digest
+
+    def put_base64(self, data):
+        """Decode a base64 image once, store it and return its content hash."""
+        return self.put(base64.b64decode(data))
+
+    def get(self, digest):
+        """Return the raw bytes for a hash, or None if unknown or evicted."""
+        with self.lock:
+            data = self.images.get(digest)
+            if data is not None:
+                self.images.move_to_end(digest)
+            return data
+
+    def get_base64(self, digest):
+        """Return the image as a base64 string, or "" if unknown."""
+        data = self.get(digest) if digest else None
+        return base64.b64encode(data).decode() if data is not None else ""
+
+    def handle_request(self, path, headers):
+        """HttpServer handler for /images/<hash>.png"""
+        digest = path[len(IMAGE_PATH_PREFIX):].split(".")[0]
+        data = self.get(digest)
+        if data is None:
+            return 404, {}, b""
+
+        # Content never changes for a given hash, so let the browser cache it forever
+        response_headers = {
+            "ETag": f'"{digest}"',
+            "Cache-Control": "public, max-age=31536000, immutable",
+        }
+        if headers.get("if-none-match") == f'"{digest}"':
+            return 304, response_headers, b""
+        return 200, {**response_headers, "Content-Type": "image/png"}, data
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from tracing import tracer
+
+# Most generations of each model running at once across all sessions, e.g. "claude=4,sdxl=2". Unlimited when unset.
+MODEL_CONCURRENCY = {model.strip(): int(limit) for model, limit in
+                     (item.split("=") for item in os.getenv("MODEL_CONCURRENCY", "").split(",") if item.strip())}
+
+class ModelLimiter:
+    """Caps how many generations of each model run at once, shared by every session.
+
+    When a model is at its limit, callers wait in line per session, and
+    the sessions take turns as slots free up. So a booth running many
+    rounds back to back can't starve a quieter one of the model.
+    """
+
+    def __init__(self, limits=MODEL_CONCURRENCY):
+        self.limits = limits
+        self.condition = threading.Condition()
+        self.running = {}       # model -> generations holding a slot
+        self.waiting = {}       # model -> {session: deque of tickets}
+        self.turns = {}         # model -> deque of sessions with someone waiting, next in line first
+
+    @contextmanager
+    def slot(self, model, session, timeout=None):
+        """Hold one of model's slots for the duration of the with block.
+        Raises TimeoutError after waiting timeout seconds for one."""
+        limit = self.limits.get(model)
+        if not limit:
+            yield
+            return
+
+        ticket = object()
+        start = time.monotonic()
+        deadline = start + timeout if timeout else None
+        with self.condition:
+            queue = self.waiting.setdefault(model, {}).setdefault(session, deque())
+            queue.append(ticket)
+            turns = self.turns.setdefault(model, deque())
+            if session not in turns:
+                turns.append(session)
+            while self.running.get(model, 0) >= limit or self.waiting[model][turns[0]][0] is not ticket:
+                remaining = deadline - time.monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    # Give up our place in line, and the session's turn if it was the last one waiting
+                    queue.remove(ticket)
+                    if not queue:
+                        turns.remove(session)
+                    self.condition.notify_all()
+                    raise TimeoutError(f"No {model} slot free after {timeout:g}s")
+                self.condition.wait(remaining)
+            queue.popleft()
+            turns.popleft()
+            if queue:
+                turns.append(session)
+            self.running[model] = self.running.get(model, 0) + 1
+            # The next in line may be able to go too if there's more than one free slot
+            self.condition.notify_all()
+        tracer.record("model_queue", time.monotonic() - start, {"model": model}, trace=False)
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.running[model] -= 1
+                self.condition.notify_all()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""Streaming profanity filter for model output.
+
+Masks whole-word matches of the words in profanity.txt (the same list used
+for Transcribe's vocabulary filter) as text is streamed in. Run it directly
+to measure throughput:
+
+    python3 profanity_filter.py --megabytes 4 --words 1000
+"""
+
+import argparse
+import os
+import random
+import string
+import time
+from collections import deque
+
+PROFANITY_FILTER = os.getenv("PROFANITY_FILTER", "true").lower() == "true"
+PROFANITY_FILE = os.getenv("PROFANITY_FILE", "profanity.txt")
+MASK_CHAR = "*"
+
+def is_word_char(c):
+    return c.isalnum() or c == "_"
+
+class ProfanityAutomaton:
+    """Aho-Corasick automaton over the lower-cased words, built once and shared by all filters."""
+
+    def __init__(self, words):
+        self.goto = [{}]        # state -> {char: state}
+        self.fail = [0]
+        self.depth = [0]        # Length of the text each state stands for
+        self.outputs = [()]     # Lengths of the words that end at each state
+        for word in words:
+            state = 0
+            for c in word.lower():
+                if c not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[state] + 1)
+                    self.outputs.append(())
+                    self.goto[state][c] = len(self.goto) - 1
+                state = self.goto[state][c]
+            if word and len(word) not in self.outputs[state]:
+                self.outputs[state] += (len(word),)
+        self.longest = max(self.depth)
+
+        # Breadth first, so each state's failure link is final before its children need it
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and c not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(c, 0)
+                self.outputs[child] += self.outputs[self.fail[child]]
+
+    def step(self, state, c):
+        while state and c not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(c, 0)
+
+    @classmethod
+    def load(cls, path=PROFANITY_FILE):
+        with open(path) as f:
+            words = [line.strip() for line in f if line.strip()]
+        print(f"Loaded {len(words)} words to filter from {path}")
+        return cls(words)
+
+class StreamingFilter:
+    """Masks listed words in one stream of text, however it is split into chunks.
+
+    feed() returns the text that can be shown so far. Characters that may
+    still turn out to be part of a word are held back, plus one more to see
+    whether the word ends there. That is never more than the longest word
+    plus one. flush() returns the rest once the stream is complete.
+    """
+
+    def __init__(self, automaton):
+        self.automaton = automaton
+        self.state = 0
+        self.buffer = []        # Characters not yet returned
+        self.start = 0          # Stream position of buffer[0]
+        self.previous = ""      # Last character returned, to check where a word starts
+        self.matches = []       # (start, end) of matches still waiting on the character after them
+        self.max_held = 0
+
+    def feed(self, text):
+        automaton = self.automaton
+        buffer = self.buffer
+        for c in text:
+            position = self.start + len(buffer)
+            if self.matches:
+                if not is_word_char(c):
+                    for start, end in self.matches:
+                        buffer[start - self.start:end - self.start] = MASK_CHAR * (end - start)
+                self.matches = []
+            self.state = automaton.step(self.state, c.lower())
+            for length in automaton.outputs[self.state]:
+                start = position - length + 1
+                before = buffer[start - self.start - 1] if start > self.start else self.previous
+                if not is_word_char(before):
+                    self.matches.append((start, position + 1))
+            buffer.append(c)
+
+        # Keep whatever could still be part of a word, or is waiting on a word boundary
+        keep_from = self.start + len(buffer) - automaton.depth[self.state]
+        if self.matches:
+            keep_from = min(keep_from, min(start for start, _ in self.matches))
+        text = self.release(keep_from - self.start)
+        self.max_held = max(self.max_held, len(buffer))
+        return text
+
+    def flush(self):
+        for start, end in self.matches:
+            self.buffer[start - self.start:end - self.start] = MASK_CHAR * (end - start)
+        self.matches = []
+        self.state = 0
+        return self.release(len(self.buffer))
+
+    def release(self, count):
+        if count <= 0:
+            return ""
+        text = "".join(self.buffer[:count])
+        del self.buffer[:count]
+        self.start += count
+        self.previous = text[-1]
+        return text
+
+def load_profanity():
+    """Build the automaton from PROFANITY_FILE, or return None if filtering is off or the file is missing."""
+    if not PROFANITY_FILTER:
+        return None
+    try:
+        return ProfanityAutomaton.load(PROFANITY_FILE)
+    except OSError as e:
+        print(f"Profanity filter disabled: {e}")
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megabytes", type=float, default=2, help="Amount of text to filter")
+    parser.add_argument("--words", type=int, default=0, help="Random words to add to profanity.txt")
+    parser.add_argument("--chunk", type=int, default=4, help="Characters per streamed chunk, about one token")
+    args = parser.parse_args()
+
+    words = [line.strip() for line in open(PROFANITY_FILE) if line.strip()]
+    words += ["".join(random.choices(string.ascii_lowercase, k=random.randint(3, 10))) for _ in range(args.words)]
+    start = time.perf_counter()
+    automaton = ProfanityAutomaton(words)
+    print(f"Built automaton for {len(words)} words, {len(automaton.goto)} states in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    # Text drawn from the word list and filler so there is something to mask
+    vocabulary = words[:50] + ["the", "cat", "in", "space", "wearing", "a", "suit", "and", "peanut-butter"] * 10
+    text = []
+    size = 0
+    while size < args.megabytes * 2**20:
+        word = random.choice(vocabulary) + random.choice(" ,. ")
+        text.append(word)
+        size += len(word)
+    text = "".join(text)
+    chunks = [text[i:i + args.chunk] for i in range(0, len(text), args.chunk)]
+
+    stream = StreamingFilter(automaton)
+    start = time.perf_counter()
+    output = [stream.feed(chunk) for chunk in chunks]
+    output.append(stream.flush())
+    elapsed = time.perf_counter() - start
+    assert len("".join(output)) == len(text)
+    print(f"Filtered {len(text) / 2**20:.1f} MB in {elapsed:.2f}s: {len(text) / 2**20 / elapsed:.2f} MB/s, "
+          f"{len(chunks) / elapsed:,.0f} chunks/s, {elapsed / len(chunks) * 1e6:.2f} us per chunk, "
+          f"at most {stream.max_held} characters held back")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import json
+import threading
+
+class StatePublisher:
+    """Tracks the values shown on the kiosk UI and turns changes to them into
+    versioned messages, so each change is serialized once for all clients.
+
+    Changes can be recorded from any thread (Bedrock worker threads, GPIO
+    callbacks). They are coalesced until the next drain(): a field that was
+    overwritten is sent as a "set", a string that only grew (streamed tokens)
+    is sent as an "append" carrying just the new text.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.values = {}
+        self.pending = {}   # key -> ("set", value) or ("append", text)
+        self.notify = None  # Called (from any thread) when pending goes from empty to non-empty
+
+    def record(self, key, value):
+        """Record the new value of a published field."""
+        with self.lock:
+            old = self.values.get(key)
+            if key in self.values and old == value:
+                return
+            self.values[key] = value
+            self.version += 1
+            was_empty = not self.pending
+
+            kind, pending_value = self.pending.get(key, (None, None))
+            if isinstance(old, str) and old and isinstance(value, str) and value.startswith(old) and kind != "set":
+                text = value[len(old):]
+                self.pending[key] = ("append", pending_value + text if kind == "append" else text)
+            else:
+                self.pending[key] = ("set", value)
+
+        if was_empty and self.notify:
+            self.notify()
+
+    def snapshot(self):
+        """Full state message sent to a client when it connects."""
+        with self.lock:
+            return json.dumps({"type": "snapshot", "version": self.version, "data": self.values})
+
+    def drain(self):
+        """Return the pending changes as one delta message, or None if nothing changed."""
+        with self.lock:
+            return self.drain_locked()
+
+    def snapshot_and_drain(self):
+        """Return drain() and snapshot() taken together, for a client that is connecting.
+
+        Existing clients get the delta, the new one the snapshot. Taking
+        both under one lock means a change recorded meanwhile is in neither,
+        so it reaches every client exactly once with the next delta.
+        """
+        with self.lock:
+            message = self.drain_locked()
+            return message, json.dumps({"type": "snapshot", "version": self.version, "data": self.values})
+
+    def drain_locked(self):
+        if not self.pending:
+            return None
+        message = {"type": "delta", "version": self.version, "set": {}, "append": {}}
+        for key, (kind, value) in self.pending.items():
+            message[kind][key] = value
+        self.pending = {}
+        return json.dumps(message)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+import asyncio
+import os
+import random
+import threading
+import time
+
+from tracing import tracer
+
+# Regions to spread Bedrock calls over, e.g. "us-east-1,us-west-2". Defaults to AWS_DEFAULT_REGION.
+BEDROCK_REGIONS = [r.strip() for r in os.getenv("BEDROCK_REGIONS", os.getenv("AWS_DEFAULT_REGION", "us-east-1")).split(",") if r.strip()]
+REGION_PROBE_INTERVAL_S = float(os.getenv("REGION_PROBE_INTERVAL_S", "30"))
+REGION_FAILURE_THRESHOLD = int(os.getenv("REGION_FAILURE_THRESHOLD", "3"))  # Consecutive failures that open the circuit
+REGION_OPEN_S = float(os.getenv("REGION_OPEN_S", "30"))                     # How long an open circuit skips the region
+REGION_EXPLORE = float(os.getenv("REGION_EXPLORE", "0.05"))                 # Share of calls sent elsewhere to keep scores fresh
+REGION_EWMA_ALPHA = 0.3
+
+def bedrock_client(service_name, region_name):
+    """Create a boto3 client. boto3 takes a while to import, so it's only loaded once a client is needed."""
+    import boto3
+    from botocore.config import Config
+    config = Config(
+        connect_timeout=1, read_timeout=30,
+        retries={'max_attempts': 1})
+    return boto3.client(service_name=service_name, region_name=region_name, config=config)
+
+class Region:
+    """A Bedrock region with its clients, latency scores and circuit breakers.
+
+    Scores and breakers are per model, as not every model is in every region.
+    """
+
+    def __init__(self, name, runtime=None, control=None):
+        self.name = name
+        self._runtime = runtime     # Created on first use if None
+        self.runtime_lock = threading.Lock()
+        self.control = control
+        self.last_used = 0          # time.monotonic() of the last call, for keepalives
+        self.latency = {}       # model_id -> EWMA of call latency
+        self.failures = {}      # model_id -> consecutive failures
+        self.open_until = {}    # model_id -> time.monotonic() the circuit goes half-open
+        self.probing = set()    # model_ids with the one half-open call in flight
+        self.probe_latency = None
+        self.probe_ok = True
+
+    @property
+    def runtime(self):
+        if self._runtime is None:
+            with self.runtime_lock:
+                if self._runtime is None:
+                    self._runtime = bedrock_client("bedrock-runtime", self.name)
+        return self._runtime
+
+    @runtime.setter
+    def runtime(self, runtime):
+        self._runtime = runtime
+
+    def available(self, model_id, now):
+        return self.probe_ok and now >= self.open_until.get(model_id, 0) and model_id not in self.probing
+
+    def score(self, model_id):
+        # Regions without calls yet rank by probe round trip, which puts them ahead so they get measured
+        return self.latency.get(model_id, self.probe_latency or 0)
+
+class RegionPool:
+    """Routes each Bedrock call to the fastest healthy region.
+
+    Regions are scored from the latency of real calls (time to first event
+    for streams), with probes of ListFoundationModels as a health check and
+    a starting score. After REGION_FAILURE_THRESHOLD failures in a row a
+    region's circuit opens for that model for REGION_OPEN_S. After that it
+    is half-open: a single call is let through while the others go
+    elsewhere. If that call succeeds the circuit closes, and if it fails the
+    circuit opens again.
+    """
+
+    def __init__(self, runtimes, controls=None):
+        """runtimes maps region name to a bedrock-runtime client (or a stand-in
+        from fakes.py), or None to create it on first use. controls maps
+        region name to a bedrock client used for probes."""
+        controls = controls or {}
+        self.lock = threading.Lock()
+        self.regions = [Region(name, runtime, controls.get(name)) for name, runtime in runtimes.items()]
+        self.routes = {}        # model_id -> region name last chosen as best, to log changes
+
+    def choose(self, model_id, exclude=()):
+        """Pick the region for a call, skipping regions named in exclude (such as the one being hedged)."""
+        now = time.monotonic()
+        with self.lock:
+            candidates = [r for r in self.regions if r.name not in exclude] or self.regions
+            healthy = [r for r in candidates if r.available(model_id, now)]
+            if not healthy:
+                # Everything is failing, so try whichever circuit closes first rather than give up
+                return min(candidates, key=lambda r: r.open_until.get(model_id, 0))
+            if len(healthy) > 1 and random.random() < REGION_EXPLORE:
+                best = random.choice(healthy)
+            else:
+                best = min(healthy, key=lambda r: r.score(model_id))
+                if not exclude and self.routes.get(model_id) != best.name:
+                    self.routes[model_id] = best.name
+                    if len(self.regions) > 1:
+                        print(f"Routing {model_id} to {best.name}")
+            if model_id in best.open_until:
+                # Half-open, so this is the call that decides whether the circuit closes
+                best.probing.add(model_id)
+            return best
+
+    def run(self, region, model_id, call):
+        """Return call(region.runtime), recording its latency or failure against region."""
+        start = region.last_used = time.monotonic()
+        try:
+            result = call(region.runtime)
+        except Exception as e:
+            self.record_failure(region, model_id, e)
+            tracer.record("bedrock_region_call", time.monotonic() - start,
+                          {"region": region.name, "result": "error"}, trace=False)
+            raise
+        latency = time.monotonic() - start
+        with self.lock:
+            previous = region.latency.get(model_id)
+            region.latency[model_id] = latency if previous is None else previous + REGION_EWMA_ALPHA * (latency - previous)
+            region.failures[model_id] = 0
+            region.open_until.pop(model_id, None)
+            region.probing.discard(model_id)
+        tracer.record("bedrock_region_call", latency, {"region": region.name, "result": "ok"}, trace=False)
+        return result
+
+    def record_failure(self, region, model_id, error):
+        with self.lock:
+            region.probing.discard(model_id)
+            failures = region.failures[model_id] = region.failures.get(model_id, 0) + 1
+            if failures >= REGION_FAILURE_THRESHOLD:
+                region.open_until[model_id] = time.monotonic() + REGION_OPEN_S
+                print(f"Circuit open for {model_id} in {region.name} for {REGION_OPEN_S:.0f}s after {failures} failures: {error}")
+
+    def probe(self):
+        """Check every region with a cheap control plane call."""
+        for region in self.regions:
+            if region.control is None:
+                region.control = bedrock_client("bedrock", region.name)
+            start = time.monotonic()
+            try:
+                region.control.list_foundation_models(byOutputModality="TEXT")
+            except Exception as e:
+                if region.probe_ok:
+                    print(f"Probe of {region.name} failed, skipping it: {e}")
+                region.probe_ok = False
+                continue
+            latency = time.monotonic() - start
+            tracer.record("bedrock_region_probe", latency, {"region": region.name}, trace=False)
+            with self.lock:
+                region.probe_ok = True
+                region.probe_latency = latency if region.probe_latency is None else \
+                    region.probe_latency + REGION_EWMA_ALPHA * (latency - region.probe_latency)
+
+    async def maintain(self):
+        """Probe the regions every REGION_PROBE_INTERVAL_S. Only worth it with more than one region."""
+        while len(self.regions) > 1:
+            await asyncio.to_thread(self.probe)
+            await asyncio.sleep(REGION_PROBE_INTERVAL_S)
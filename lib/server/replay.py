@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+"""Replay a recorded kiosk session through server.py.
+
+Sessions are recorded by running the server with SESSION_RECORD_DIR set.
+The replay feeds the recorded microphone audio and transcript events back in
+and answers Bedrock calls with the recorded responses, at their recorded
+timing, for the same round and side. Button presses are repeated at the same
+point in the same round. The replay is itself recorded to --output, and the
+time each round took is compared with the original, so a change can be
+checked against a real session:
+
+    python3 replay.py sessions/session-20240601T101500.rec.gz --speed 4
+"""
+
+import argparse
+import asyncio
+import io
+import itertools
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+
+from amazon_transcribe.model import Alternative, Result, Transcript, TranscriptEvent
+
+import server
+import server_state as server_state_module
+from region_pool import RegionPool
+from server_state import ServerState
+from session_recorder import SessionRecorder, call_context, read_session
+
+REVIEW_STATES = ("REVIEW_TXT", "REVIEW_IMG")
+BUTTON_CHANNELS = {'a': 16, 'b': 17}
+
+class Session:
+    """A recorded session, split up for the replay stand-ins."""
+
+    def __init__(self, path):
+        self.audio = {}         # transcription stream -> [(seconds from stream start, chunk)]
+        self.transcripts = {}   # transcription stream -> [(seconds from stream start, results)]
+        self.responses = {}     # (round, side, model_id) -> deque of (record, payload)
+        self.inputs = []        # (seconds from round start, record)
+        self.states = []        # (time, round, state name)
+        self.duration = 0
+        stream_start = {}
+        round_start = {}
+        for t, record, payload in read_session(path):
+            self.duration = t
+            kind = record["type"]
+            if kind == "transcription":
+                stream_start[record["stream"]] = t
+            elif kind == "audio":
+                self.audio.setdefault(record["stream"], []).append((t - stream_start[record["stream"]], payload))
+            elif kind == "transcript":
+                self.transcripts.setdefault(record["stream"], []).append((t - stream_start[record["stream"]], record["results"]))
+            elif kind in ("invoke", "response_stream"):
+                # Hedged streams that lost were closed early and never reached the guest
+                if record.get("complete", True):
+                    key = (record["round"], record["side"], record["model_id"])
+                    self.responses.setdefault(key, deque()).append((record, payload))
+            elif kind == "state":
+                self.states.append((t, record["round"], record["state"]))
+                if record["state"] == "TRANSCRIBING":
+                    round_start.setdefault(record["round"], t)
+            elif kind == "input":
+                self.inputs.append((t - round_start.get(record["round"], t), record))
+        print(f"Loaded {path}: {self.duration:.1f}s, {len(round_start)} rounds, {len(self.inputs)} button presses, "
+              f"{sum(len(r) for r in self.responses.values())} Bedrock responses")
+
+class Clock:
+    """Waits out recorded delays, scaled by speed. A speed of 0 doesn't wait at all."""
+
+    def __init__(self, speed):
+        self.speed = speed
+
+    def remaining(self, start, offset):
+        return max(0, start + offset / self.speed - time.monotonic()) if self.speed else 0
+
+    async def wait_until(self, start, offset):
+        await asyncio.sleep(self.remaining(start, offset))
+
+class ReplayBedrockRuntime:
+    """Answers Bedrock calls with the responses recorded for the same round, side and model."""
+
+    def __init__(self, session, clock):
+        self.session = session
+        self.clock = clock
+        self.lock = threading.Lock()
+
+    def take(self, kwargs):
+        key = (getattr(call_context, "round", None), getattr(call_context, "side", None), kwargs.get("modelId"))
+        with self.lock:
+            responses = self.session.responses.get(key)
+            if not responses:
+                raise RuntimeError(f"No recorded response left for round {key[0]} side {key[1]} {key[2]}")
+            return responses.popleft()
+
+    def invoke_model(self, **kwargs):
+        start = time.monotonic()
+        record, payload = self.take(kwargs)
+        time.sleep(self.clock.remaining(start, record["latency"]))
+        return {"body": io.BytesIO(payload)}
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        start = time.monotonic()
+        record, payload = self.take(kwargs)
+        return {"body": self.events(start, record, payload)}
+
+    def events(self, start, record, payload):
+        position = 0
+        for offset, size in zip(record["offsets"], record["sizes"]):
+            time.sleep(self.clock.remaining(start, offset))
+            yield {"chunk": {"bytes": payload[position:position + size]}}
+            position += size
+
+class ReplayInputStream:
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def send_audio_event(self, audio_chunk):
+        pass
+
+    async def end_stream(self):
+        self.stream.ended.set()
+
+class ReplayTranscribeStream:
+    """Emits the transcript events of the next recorded transcription stream once it is read."""
+
+    def __init__(self, client):
+        self.client = client
+        self.ended = asyncio.Event()
+        self.input_stream = ReplayInputStream(self)
+        self.output_stream = self.events()
+
+    async def events(self):
+        # Pre-warmed streams that are never used don't take a recording
+        stream = next(self.client.streams)
+        start = time.monotonic()
+        for offset, results in self.client.session.transcripts.get(stream, ()):
+            await self.client.clock.wait_until(start, offset)
+            yield TranscriptEvent(transcript=Transcript(results=[
+                Result(result_id="replay", is_partial=result["partial"],
+                       alternatives=[Alternative(transcript=text, items=[], entities=[]) for text in result["text"]])
+                for result in results]))
+        await self.ended.wait()
+
+class ReplayTranscribeStreamingClient:
+    """Stand-in for TranscribeStreamingClient that plays back recorded streams in order."""
+
+    def __init__(self, session, clock):
+        self.session = session
+        self.clock = clock
+        self.streams = itertools.count(1)
+
+    async def start_stream_transcription(self, **kwargs):
+        return ReplayTranscribeStream(self)
+
+def replay_mic_stream(session, clock):
+    """Return a replacement for server.mic_stream that plays back each stream's recorded audio."""
+    streams = itertools.count(1)
+
+    async def mic_stream(server_state):
+        stream = next(streams)
+        start = time.monotonic()
+        for offset, chunk in session.audio.get(stream, ()):
+            await clock.wait_until(start, offset)
+            yield chunk
+        # The guest has finished talking, keep the stream open until transcription ends
+        await asyncio.Event().wait()
+
+    return mic_stream
+
+def round_timings(states):
+    """Return {round: (seconds to the first review state, seconds for the whole round)} from state records."""
+    starts = {}
+    reviews = {}
+    for t, round_number, state in states:
+        if not round_number:
+            continue    # Starting up, before the first round
+        starts.setdefault(round_number, t)
+        if state in REVIEW_STATES:
+            reviews.setdefault(round_number, t - starts[round_number])
+    rounds = sorted(starts)
+    return {r: (reviews.get(r), starts[n] - starts[r] if n in starts else None)
+            for r, n in zip(rounds, rounds[1:] + [None])}
+
+class Replay:
+    def __init__(self, args):
+        self.args = args
+        self.session = Session(args.session)
+        self.clock = Clock(args.speed)
+
+    async def drive(self, server_state):
+        """Press the buttons as the guest did, at the same point in the same round."""
+        machine = server_state.machine
+        for since_round, record in self.session.inputs:
+            round_number = record["round"]
+            review = record["state"] in REVIEW_STATES
+            while server_state.round_number < round_number or (
+                    review and server_state.round_number == round_number and server_state.my_state.name != record["state"]):
+                await machine.next_change(timeout=1)
+            if server_state.round_number > round_number:
+                print(f"Skipping press of {record['side'].upper()} in round {round_number}, which has already ended")
+                continue
+            if review:
+                await self.clock.wait_until(server_state.state_entered_at, record["since_state"])
+            else:
+                await self.clock.wait_until(server_state.round_start_time, since_round)
+            channel = None if record["source"] == "websocket" else BUTTON_CHANNELS[record["side"]]
+            if record["side"] == 'a':
+                server_state.red_button_callback(channel)
+            else:
+                server_state.blue_button_callback(channel)
+
+        # Wait for the last round with a press to finish
+        last_round = max((record["round"] for _, record in self.session.inputs), default=0)
+        while server_state.round_number <= last_round:
+            await machine.next_change(timeout=1)
+
+    async def run(self):
+        recorder = SessionRecorder(self.args.output)
+        server_state = ServerState(
+            region_pool=RegionPool({"replay": ReplayBedrockRuntime(self.session, self.clock)}),
+            recorder=recorder,
+        )
+        # A hedge or warm-up ping would take the next recorded response
+        server_state.hedger.enabled = False
+        server.WARMUP_ENABLED = False
+        server_task = asyncio.create_task(server.main(
+            server_state=server_state,
+            transcribe_client=ReplayTranscribeStreamingClient(self.session, self.clock),
+            audio_source=replay_mic_stream(self.session, self.clock),
+        ))
+
+        timeout = self.args.timeout or (self.session.duration / self.args.speed if self.args.speed else 0) + 30
+        started = time.monotonic()
+        await asyncio.sleep(0.5)    # Let the server start
+        try:
+            await asyncio.wait_for(self.drive(server_state), timeout)
+        except asyncio.TimeoutError:
+            print(f"Replay didn't finish within {timeout:.0f}s")
+        elapsed = time.monotonic() - started
+        server_task.cancel()
+        recorder.close()
+        self.report(elapsed)
+
+    def report(self, elapsed):
+        recorded = round_timings(self.session.states)
+        replayed = round_timings(Session(self.args.output).states)
+        scale = self.args.speed or 1
+        print(f"\nReplayed {self.session.duration:.1f}s of session in {elapsed:.1f}s, "
+              f"replay times scaled by {scale:g} to compare")
+        print(f"{'round':<8}{'to review':>12}{'replayed':>12}{'round':>12}{'replayed':>12}")
+
+        def seconds(value, factor=1):
+            return f"{value * factor:>11.2f}s" if value is not None else f"{'-':>12}"
+
+        for round_number, (to_review, length) in recorded.items():
+            replay_review, replay_length = replayed.get(round_number, (None, None))
+            print(f"{round_number:<8}{seconds(to_review)}{seconds(replay_review, scale)}"
+                  f"{seconds(length)}{seconds(replay_length, scale)}")
+        print(f"Replay recorded to {self.args.output}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("session", help="Session file recorded with SESSION_RECORD_DIR")
+    parser.add_argument("--speed", type=float, default=1, help="Playback speed, 0 to not wait at all")
+    parser.add_argument("--output", default=None, help="Where to record the replay (default a temporary file)")
+    parser.add_argument("--timeout", type=float, default=None, help="Give up after this long (s)")
+    args = parser.parse_args()
+    if not args.output:
+        # Created here so no other process can take the name, and overwritten by the recorder
+        fd, args.output = tempfile.mkstemp(prefix="replay-", suffix=".rec.gz")
+        os.close(fd)
+
+    server_state_module.results_dir = tempfile.mkdtemp(prefix="replay-results-")
+    asyncio.run(Replay(args).run())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+"""SQLite index of the preference records, with running totals for the admin stats.
+
+The records themselves go to S3 through ResultsWriter's segments and are
+deleted from the box once uploaded. The index keeps a row per round here,
+and updates per-model totals, hourly counts and timing histograms as each
+round is added. /stats then reads a handful of rows however many rounds
+there have been. Run directly to print the stats from an index:
+
+    python3 results_index.py /results/.results-index.sqlite3
+"""
+
+import argparse
+import bisect
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+RESULTS_INDEX = os.getenv("RESULTS_INDEX", "true").lower() == "true"
+RESULTS_INDEX_NAME = ".results-index.sqlite3"   # Starts with a dot so the S3 uploader leaves it on the box
+STATS_PATH = "/stats"
+STATS_HOURS = 24                # Hours of history in the stats
+TOP_PROMPTS = 10
+TIMINGS = ("generation", "review", "round")
+TIMING_BUCKETS = (0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120, 300)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rounds (
+    id TEXT PRIMARY KEY,
+    session TEXT,
+    timestamp REAL,
+    model TEXT,
+    prompt TEXT,
+    preference TEXT,
+    region_a TEXT,
+    region_b TEXT,
+    image_a TEXT,
+    image_b TEXT,
+    image_selected TEXT,
+    generation_seconds REAL,
+    review_seconds REAL,
+    round_seconds REAL
+);
+CREATE INDEX IF NOT EXISTS rounds_by_time ON rounds (timestamp);
+CREATE TABLE IF NOT EXISTS totals (
+    model TEXT PRIMARY KEY,
+    rounds INTEGER NOT NULL DEFAULT 0,
+    wins_a INTEGER NOT NULL DEFAULT 0,
+    wins_b INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS hourly (
+    hour INTEGER,
+    model TEXT,
+    rounds INTEGER NOT NULL DEFAULT 0,
+    wins_a INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (hour, model)
+);
+CREATE TABLE IF NOT EXISTS timings (
+    model TEXT,
+    timing TEXT,
+    bucket INTEGER,
+    count INTEGER NOT NULL DEFAULT 0,
+    seconds REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (model, timing, bucket)
+);
+CREATE TABLE IF NOT EXISTS prompts (
+    prompt TEXT,
+    model TEXT,
+    rounds INTEGER NOT NULL DEFAULT 0,
+    wins_a INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (prompt, model)
+);
+CREATE INDEX IF NOT EXISTS prompts_by_rounds ON prompts (rounds);
+"""
+
+def record_time(record):
+    """The record's timestamp (str(datetime.now()) from ServerState.save_results) as seconds since the epoch."""
+    try:
+        return datetime.datetime.fromisoformat(record["timestamp"]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return time.time()
+
+def percentile(buckets, count, p):
+    """Upper bound of the TIMING_BUCKETS bucket holding the p-th percentile, None past the last bound."""
+    target = p / 100 * count
+    seen = 0
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if seen >= target:
+            return TIMING_BUCKETS[bucket] if bucket < len(TIMING_BUCKETS) else None
+    return None
+
+class ResultsIndex:
+    """Rounds and their running totals in one SQLite file.
+
+    add_batch() runs on the ResultsWriter thread and stats() on the event
+    loop, so they share a connection under a lock. Each batch is one
+    transaction, and a record already in the index (by id) is skipped so
+    its totals are never counted twice.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")   # The segments are the durable copy until they're uploaded
+        self.db.executescript(SCHEMA)
+
+    @classmethod
+    def open(cls, directory):
+        """The index in the results directory, or None if RESULTS_INDEX is off or it can't be opened."""
+        if not RESULTS_INDEX:
+            return None
+        try:
+            return cls(os.path.join(directory, RESULTS_INDEX_NAME))
+        except sqlite3.Error as e:
+            print(f"Couldn't open the results index, stats are off: {e}")
+            return None
+
+    def add_batch(self, records):
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for record in records:
+                    self.add(record)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def add(self, record):
+        timestamp = record_time(record)
+        model = record.get("model")
+        preference = record.get("human_preference")
+        timings = record.get("timings") or {}
+        inserted = self.db.execute(
+            "INSERT OR IGNORE INTO rounds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (record.get("id"), record.get("session"), timestamp, model, record.get("prompt"), preference,
+             record.get("region_a"), record.get("region_b"), record.get("image_result_a"),
+             record.get("image_result_b"), record.get("human_preference_image"),
+             timings.get("generation"), timings.get("review"), timings.get("round"))).rowcount
+        if not inserted:
+            return
+
+        win_a, win_b = int(preference == "a"), int(preference == "b")
+        self.db.execute(
+            "INSERT INTO totals VALUES (?, 1, ?, ?) ON CONFLICT (model) DO UPDATE SET "
+            "rounds = rounds + 1, wins_a = wins_a + excluded.wins_a, wins_b = wins_b + excluded.wins_b",
+            (model, win_a, win_b))
+        self.db.execute(
+            "INSERT INTO hourly VALUES (?, ?, 1, ?) ON CONFLICT (hour, model) DO UPDATE SET "
+            "rounds = rounds + 1, wins_a = wins_a + excluded.wins_a",
+            (int(timestamp // 3600), model, win_a))
+        self.db.execute(
+            "INSERT INTO prompts VALUES (?, ?, 1, ?) ON CONFLICT (prompt, model) DO UPDATE SET "
+            "rounds = rounds + 1, wins_a = wins_a + excluded.wins_a",
+            (record.get("prompt"), model, win_a))
+        for timing in TIMINGS:
+            seconds = timings.get(timing)
+            if seconds is not None:
+                self.db.execute(
+                    "INSERT INTO timings VALUES (?, ?, ?, 1, ?) ON CONFLICT (model, timing, bucket) DO UPDATE SET "
+                    "count = count + 1, seconds = seconds + excluded.seconds",
+                    (model, timing, bisect.bisect_left(TIMING_BUCKETS, seconds), seconds))
+
+    def stats(self, now=None):
+        """Win rates, rounds per hour and timing summaries per model, from the running totals."""
+        hour = int((now or time.time()) // 3600)
+        with self.lock:
+            totals = self.db.execute("SELECT model, rounds, wins_a, wins_b FROM totals").fetchall()
+            hourly = self.db.execute("SELECT hour, model, rounds, wins_a FROM hourly WHERE hour > ?",
+                                     (hour - STATS_HOURS,)).fetchall()
+            timings = self.db.execute("SELECT model, timing, bucket, count, seconds FROM timings").fetchall()
+            prompts = self.db.execute("SELECT prompt, model, rounds, wins_a FROM prompts ORDER BY rounds DESC LIMIT ?",
+                                      (TOP_PROMPTS,)).fetchall()
+
+        models = {}
+        for model, rounds, wins_a, wins_b in totals:
+            models[model] = {
+                "rounds": rounds,
+                "win_rate_a": wins_a / rounds if rounds else None,
+                "win_rate_b": wins_b / rounds if rounds else None,
+                "rounds_this_hour": 0,
+                "rounds_per_hour": None,
+                "hours": [],
+                "timings": {},
+            }
+        for bucket_hour, model, rounds, wins_a in sorted(hourly):
+            if model not in models:
+                continue
+            models[model]["hours"].append({"hour": bucket_hour * 3600, "rounds": rounds, "wins_a": wins_a})
+            if bucket_hour == hour:
+                models[model]["rounds_this_hour"] = rounds
+        for stats in models.values():
+            # Averaged over the hours the booth was in use, not the ones it was packed away
+            if stats["hours"]:
+                stats["rounds_per_hour"] = sum(h["rounds"] for h in stats["hours"]) / len(stats["hours"])
+
+        histograms = {}
+        for model, timing, bucket, count, seconds in timings:
+            histogram = histograms.setdefault((model, timing), [{}, 0, 0.0])
+            histogram[0][bucket] = count
+            histogram[1] += count
+            histogram[2] += seconds
+        for (model, timing), (buckets, count, seconds) in histograms.items():
+            if model in models and count:
+                models[model]["timings"][timing] = {
+                    "count": count,
+                    "mean": seconds / count,
+                    "p50": percentile(buckets, count, 50),
+                    "p95": percentile(buckets, count, 95),
+                }
+
+        return {
+            "models": models,
+            "top_prompts": [{"prompt": prompt, "model": model, "rounds": rounds, "wins_a": wins_a}
+                            for prompt, model, rounds, wins_a in prompts],
+        }
+
+    def handle_request(self, path, headers):
+        """HttpServer handler for /stats"""
+        return 200, {"Content-Type": "application/json", "Cache-Control": "no-store"}, json.dumps(self.stats()).encode()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", nargs="?", default=os.path.join(os.getenv("RESULTS_DIR", "/results"), RESULTS_INDEX_NAME))
+    args = parser.parse_args()
+    if not os.path.exists(args.path):
+        parser.error(f"No results index at {args.path}")
+    print(json.dumps(ResultsIndex(args.path).stats(), indent=2))
+
+if __name__ == "__main__":
+    main()
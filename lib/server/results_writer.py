@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+import json
+import os
+import queue
+import threading
+import time
+
+from tracing import tracer
+
+RESULTS_SEGMENT_MAX_BYTES = int(os.getenv("RESULTS_SEGMENT_MAX_BYTES", str(2**20)))
+RESULTS_SEGMENT_MAX_AGE_S = float(os.getenv("RESULTS_SEGMENT_MAX_AGE_S", "300"))    # Seal segments so they get uploaded
+RESULTS_FSYNC_INTERVAL_S = float(os.getenv("RESULTS_FSYNC_INTERVAL_S", "1"))       # Batch records between fsyncs
+
+IMAGES_DIR = "images"
+PREFERENCES_DIR = "preferences"
+OPEN_SUFFIX = ".open"           # Segment still being written, skipped by the uploader
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class ResultsWriter:
+    """Writes preference records and their images from a background thread.
+
+    Images are stored once each under images/<sha256>.png, and are not
+    written again after the uploader has moved them to S3. Records refer
+    to them by hash and are appended as compact JSON lines to a segment
+    under preferences/. The segment is named *.jsonl.open while it is being
+    written and is renamed to *.jsonl once it is full or old enough, so
+    readers only ever see complete segments. Writes are batched and fsynced
+    at most every RESULTS_FSYNC_INTERVAL_S. A segment left open by a crash
+    is trimmed to its last complete line and sealed on startup. Once a
+    batch is on disk its records are added to the ResultsIndex, if any.
+    """
+
+    def __init__(self, directory, index=None):
+        self.directory = directory
+        self.index = index
+        self.images_dir = os.path.join(directory, IMAGES_DIR)
+        self.preferences_dir = os.path.join(directory, PREFERENCES_DIR)
+        os.makedirs(self.images_dir, exist_ok=True)
+        os.makedirs(self.preferences_dir, exist_ok=True)
+        self.queue = queue.Queue()
+        self.segment = None
+        self.segment_path = None
+        self.segment_opened = 0
+        self.sequence = 0
+        self.written_images = set()     # Hashes of images already written by this process or found on startup
+        self.recover()
+        self.thread = threading.Thread(target=self.run, name="results-writer", daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def open(cls, directory, index=None):
+        """A writer for directory, or None if it can't be created or written to."""
+        try:
+            return cls(directory, index)
+        except OSError as e:
+            print(f"Can't write results to {directory}, they won't be saved: {e}")
+            return None
+
+    def submit(self, record, images):
+        """Queue a record and the {hash: bytes} images it refers to."""
+        self.queue.put((record, images))
+
+    def close(self):
+        """Flush everything queued so far and seal the current segment."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def recover(self):
+        for name in os.listdir(self.images_dir):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(self.images_dir, name))
+            elif name.endswith(".png"):
+                self.written_images.add(name[:-len(".png")])
+        for name in os.listdir(self.preferences_dir):
+            if not name.endswith(OPEN_SUFFIX):
+                continue
+            path = os.path.join(self.preferences_dir, name)
+            with open(path, "rb+") as f:
+                data = f.read()
+                f.truncate(data.rfind(b"\n") + 1)
+                f.flush()
+                os.fsync(f.fileno())
+            self.seal(path)
+            print(f"Recovered results segment {name}")
+
+    def seal(self, path):
+        if os.path.getsize(path):
+            os.rename(path, path[:-len(OPEN_SUFFIX)])
+        else:
+            os.remove(path)
+        fsync_dir(self.preferences_dir)
+
+    def open_segment(self):
+        self.sequence += 1
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{self.sequence:04d}.jsonl{OPEN_SUFFIX}"
+        self.segment_path = os.path.join(self.preferences_dir, name)
+        self.segment = open(self.segment_path, "ab")
+        self.segment_opened = time.monotonic()
+
+    def close_segment(self):
+        if self.segment is None:
+            return
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.segment.close()
+        self.seal(self.segment_path)
+        self.segment = None
+
+    def write_image(self, digest, data):
+        if digest in self.written_images:
+            return False
+        path = os.path.join(self.images_dir, f"{digest}.png")
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, path)
+        self.written_images.add(digest)
+        return True
+
+    def write_batch(self, batch):
+        with tracer.span("results_write", records=len(batch)):
+            new_images = False
+            for record, images in batch:
+                line = json.dumps(record, separators=(",", ":"), default=str).encode() + b"\n"
+                for digest, data in images.items():
+                    if data:
+                        new_images |= self.write_image(digest, data)
+                if self.segment is None:
+                    self.open_segment()
+                self.segment.write(line)
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            if new_images:
+                fsync_dir(self.images_dir)
+        if self.index is not None:
+            try:
+                with tracer.span("results_index", records=len(batch)):
+                    self.index.add_batch([record for record, _ in batch])
+            except Exception as e:
+                print(f"An error occurred while indexing results: {e}")
+
+    def run(self):
+        while True:
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=RESULTS_FSYNC_INTERVAL_S))
+                # Let records that arrive within the interval share one fsync
+                time.sleep(RESULTS_FSYNC_INTERVAL_S if batch[0] is not None else 0)
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stopping = None in batch
+            batch = [item for item in batch if item is not None]
+
+            try:
+                if batch:
+                    self.write_batch(batch)
+                if self.segment is not None and (
+                        stopping
+                        or self.segment.tell() >= RESULTS_SEGMENT_MAX_BYTES
+                        or time.monotonic() - self.segment_opened >= RESULTS_SEGMENT_MAX_AGE_S):
+                    self.close_segment()
+            except Exception as e:
+                print(f"An error occurred while saving results: {e}")
+            if stopping:
+                return
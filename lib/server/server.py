@@ -1,22 +1,32 @@
 #!/usr/bin/env python
 
+import time
+PROCESS_START = time.monotonic()
+
 import asyncio
+from contextlib import aclosing
 from functools import partial
 import concurrent
 
-import json
 import datetime
-from websockets import serve, exceptions, connect
+from websockets import serve, exceptions, broadcast
 
 import os
-import sounddevice
-
-from amazon_transcribe.client import TranscribeStreamingClient
-from amazon_transcribe.handlers import TranscriptResultStreamHandler
-from amazon_transcribe.model import TranscriptEvent
 
-from states import State
-from server_state import ServerState
+from states import State, Event
+from server_state import ServerState, SharedServices, DEFAULT_SESSION, CLAUDE_MODEL_ID
+from generation import GenerationCancelled
+from http_server import HttpServer
+from image_store import IMAGE_PATH_PREFIX
+from image_pipeline import THUMB_PATH_PREFIX
+from speculation import Speculator, SPECULATIVE_GENERATION
+from vad import VoiceActivityDetector, VAD_ENABLED, VAD_END_STREAM
+from transcribe_pool import TranscribeStreamPool, TRANSCRIBE_PREWARM
+from tracing import tracer, METRICS_PATH
+from results_index import STATS_PATH
+from session_recorder import SessionRecorder
+from warmup import ConnectionWarmer, WARMUP_ENABLED
+from audio_buffer import AudioRingBuffer, Resampler, output_sample_rate, AUDIO_FRAME_MS, AUDIO_BUFFER_MS
 
 try:
     from RPi import GPIO
@@ -33,8 +43,22 @@ except ImportError:
 
 WEBSOCKET_PORT = 8765           # Standard websocket port
 WEBSOCKET_IP = '127.0.0.1'      # Interface for websocket server to listen on
-POLL_DELAY = 0.1                # How long to pause between sending websocket data.
+HTTP_PORT = 8766                # Serves generated images to the kiosk UI
+# Admin stats from the results index. Only reachable from the Pi unless set to e.g. 0.0.0.0, and unauthenticated
+STATS_BIND = os.getenv("STATS_BIND", WEBSOCKET_IP)
+STATS_PORT = int(os.getenv("STATS_PORT", "8767"))
 MIC_SAMPLE_RATE_HZ = 48000      # This may change depending on your microphone
+TRANSCRIBE_RATE_HZ = output_sample_rate(MIC_SAMPLE_RATE_HZ)  # Resampled down to this before streaming
+SELECT_DISPLAY_S = float(os.getenv("SELECT_DISPLAY_S", "0"))  # How long to show the guest's choice before the next round
+ERROR_RECOVERY_S = 5            # How long to show an error before starting a new round
+TRANSCRIBE_RESTART_S = 1        # Pause before restarting a transcription task that died with an exception
+
+# Booths hosted by this process, e.g. "booth1,booth2". Kiosk clients pick one with ws://host:8765/booth2
+SESSIONS = [s.strip() for s in os.getenv("SESSIONS", DEFAULT_SESSION).split(",") if s.strip()]
+# sounddevice input for each session in the same order, by name or index. Empty for the default device
+AUDIO_DEVICES = [int(d) if d.strip().isdigit() else d.strip() or None for d in os.getenv("AUDIO_DEVICES", "").split(",")]
+
+SELECT_STATES = (State.SELECT_A_TXT, State.SELECT_A_IMG, State.SELECT_B_TXT, State.SELECT_B_IMG)
 
 aws_region = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
 language_code = os.getenv("LANGUAGE_CODE", "en-US")
@@ -56,12 +80,17 @@ async def cancel_transcription(server_state):
         except asyncio.CancelledError or concurrent.futures._base.InvalidStateError:
             pass  # Task cancellation is expected
 
-class MyEventHandler(TranscriptResultStreamHandler):
+class MyEventHandler:
+    """Handles the transcript events of one Transcribe stream, the way
+    amazon_transcribe's TranscriptResultStreamHandler does, but without
+    importing amazon_transcribe before a stream is opened."""
 
     def __init__(self, stream, server_state):
-        super().__init__(stream)
+        self.stream = stream
         self.server_state = server_state
         self.cancelling = False
+        self.first_partial = True
+        self.speculator = Speculator(server_state, self.modify_string) if SPECULATIVE_GENERATION else None
 
     async def modify_string(self, s):
         """Remove the capitals and full stop from the punctuated output from Amazon Transcribe"""
@@ -85,8 +114,15 @@ class MyEventHandler(TranscriptResultStreamHandler):
         
         return full_stop_removed
 
-    async def handle_transcript_event(self, transcript_event: TranscriptEvent):
+    async def handle_events(self):
+        async for event in self.stream:
+            if hasattr(event, "transcript"):    # A TranscriptEvent
+                await self.handle_transcript_event(event)
+
+    async def handle_transcript_event(self, transcript_event):
         """Handle transcript events asynchronously."""
+        if self.server_state.recorder:
+            self.server_state.recorder.record_transcript(transcript_event)
         results = transcript_event.transcript.results
         
         for result in results:
@@ -94,30 +130,47 @@ class MyEventHandler(TranscriptResultStreamHandler):
                 self.server_state.my_prompt = alt.transcript
 
                 # print("Prompt:", self.server_state.my_prompt)
+            since_round_start = time.monotonic() - self.server_state.round_start_time
+            if self.first_partial:
+                tracer.record("transcribe_first_partial", since_round_start, round=self.server_state.my_uuid)
+                self.first_partial = False
             if not result.is_partial:
+                tracer.record("transcribe_final", since_round_start, round=self.server_state.my_uuid)
                 print("Prompt:", self.server_state.my_prompt)
-                await asyncio.to_thread(self.server_state.handle_generation)
+                if self.speculator:
+                    await self.speculator.on_final(self.server_state.my_prompt)
+                else:
+                    await asyncio.to_thread(self.server_state.handle_generation)
                 await cancel_transcription(self.server_state)
                 break
+            elif self.speculator:
+                await self.speculator.on_partial(self.server_state.my_prompt)
     
-async def mic_stream(server_state):
-    """This function wraps the raw input stream from the microphone 
-    forwarding the blocks to an asyncio.Queue."""
+async def mic_stream(server_state, device=None):
+    """This function wraps the raw input stream from the microphone, buffering
+    the blocks in a preallocated ring and yielding resampled, Transcribe-sized
+    audio frames as bytes."""
+    import sounddevice  # Only loaded with a real microphone, it takes a while to find the audio devices
     loop = asyncio.get_event_loop()
     # loop.set_debug(True)  # Enable debug
-    input_queue = asyncio.Queue()
+    resampler = Resampler(MIC_SAMPLE_RATE_HZ, TRANSCRIBE_RATE_HZ)
+    frame_len = TRANSCRIBE_RATE_HZ * AUDIO_FRAME_MS // 1000 * resampler.factor
+    ring = AudioRingBuffer(MIC_SAMPLE_RATE_HZ * AUDIO_BUFFER_MS // 1000, frame_len)
+    frame_ready = asyncio.Event()
 
     def callback(indata, frame_count, time_info, status):
-        # Only put audio on queue if state is transcribing - to avoid queuing up chit chat while looking at the image
+        # Only buffer audio if state is transcribing - to avoid queuing up chit chat while looking at the image
         if (server_state.my_state == State.TRANSCRIBING):
-            loop.call_soon_threadsafe(
-                input_queue.put_nowait, (bytes(indata), status))
+            # Wake the event loop once per coalesced frame rather than per block
+            if ring.write(indata):
+                loop.call_soon_threadsafe(frame_ready.set)
 
     # Be sure to use the correct parameters for the audio stream that matches
     # the audio formats described for the source language you'll be using:
     # https://docs.aws.amazon.com/transcribe/latest/dg/streaming.html
     try:
         sd_stream = sounddevice.RawInputStream(
+            device=device,
             channels=1,
             samplerate=MIC_SAMPLE_RATE_HZ,
             callback=callback,
@@ -128,45 +181,70 @@ async def mic_stream(server_state):
         print(f"Error opening sounddevice - exiting now. {e}")
         exit(-1)
 
-    print(f"Transcribing with sample rate {sd_stream.samplerate} device {sd_stream.device}")
+    print(f"Transcribing with sample rate {sd_stream.samplerate} (sent at {TRANSCRIBE_RATE_HZ}) device {sd_stream.device}")
     # Initiate the audio stream and asynchronously yield the audio chunks as they become available.
-    with sd_stream:
-        while True:
-            indata, status = await input_queue.get()
-            yield indata, status
-
-async def write_chunks(stream, server_state):
+    try:
+        with sd_stream:
+            while True:
+                await frame_ready.wait()
+                frame_ready.clear()
+                while (frame := ring.read()) is not None:
+                    yield resampler.process(frame).tobytes()
+    finally:
+        if ring.dropped:
+            print(f"Audio ring buffer overflowed, dropped {ring.dropped} samples ({ring.dropped * 1000 // MIC_SAMPLE_RATE_HZ} ms)")
+
+async def write_chunks(stream, server_state, pool, audio_source):
     """This connects the raw audio chunks generator coming from the microphone 
     and passes them along to the transcription stream."""
-    async for chunk, status in mic_stream(server_state):
-        await stream.input_stream.send_audio_event(audio_chunk=chunk)
+    vad = VoiceActivityDetector(TRANSCRIBE_RATE_HZ) if VAD_ENABLED else None
+    first_audio = True
+
+    async with aclosing(audio_source(server_state)) as chunks:
+        async for chunk in chunks:
+            # Only send speech, and finish the stream ourselves once the guest stops talking
+            audio, end_of_utterance = vad.process(chunk) if vad else (chunk, False)
+            if audio:
+                await stream.input_stream.send_audio_event(audio_chunk=audio)
+                if first_audio:
+                    pool.record_handover(time.monotonic() - server_state.round_start_time)
+                    first_audio = False
+            if end_of_utterance and VAD_END_STREAM:
+                print(f"End of utterance detected, sent {vad.bytes_out} of {vad.bytes_in} audio bytes")
+                break
     await stream.input_stream.end_stream()
 
 
-async def basic_transcribe(server_state):
-    """Setup transcription client."""
-    # Setup up our client with our chosen AWS region
-    client = TranscribeStreamingClient(region=aws_region)
+async def basic_transcribe(server_state, pool, audio_source=mic_stream):
+    """Start transcription, using the pool's pre-warmed stream when there is one."""
+    if server_state.recorder:
+        server_state.recorder.start_stream()
+    server_state.my_transcribe_stream = None
 
-    # Start transcription to generate our async stream
-    server_state.my_transcribe_stream = await client.start_stream_transcription(
-        language_code=language_code,
-        media_sample_rate_hz=MIC_SAMPLE_RATE_HZ,
-        media_encoding="pcm",
-        vocab_filter_name=vocab_filter_name,
-        vocab_filter_method=vocab_filter_method
-    )
-
-    # Instantiate our handler and start processing events
-    handler = MyEventHandler(server_state.my_transcribe_stream.output_stream, server_state)
     try:
-        await asyncio.gather(write_chunks(server_state.my_transcribe_stream, server_state),handler.handle_events())
+        server_state.my_transcribe_stream = await pool.take()
+        # Instantiate our handler and start processing events
+        handler = MyEventHandler(server_state.my_transcribe_stream.output_stream, server_state)
+        await asyncio.gather(write_chunks(server_state.my_transcribe_stream, server_state, pool, audio_source),handler.handle_events())
+    except GenerationCancelled as error:
+        # The round ended while generating for it, so there's nothing to report
+        await end_transcribe_stream(server_state)
+        print(f"Generation stopped: {error}")
     except Exception as error:
-        await server_state.my_transcribe_stream.input_stream.end_stream()
+        # Includes failing to open the stream, which ERROR_RECOVERY_S then paces
         server_state.my_state = State.ERROR
         server_state.my_error = str(error)
         server_state.my_error_time = datetime.datetime.now().timestamp()
         print(f"ERROR: {server_state.my_error}")
+        await end_transcribe_stream(server_state)
+
+async def end_transcribe_stream(server_state):
+    """End the round's transcription stream, if it got as far as opening one."""
+    if server_state.my_transcribe_stream:
+        try:
+            await server_state.my_transcribe_stream.input_stream.end_stream()
+        except Exception as e:
+            print(f"An error occurred while ending transcription stream: {e}")
 
 async def consumer_handler(websocket, server_state):
     async for message in websocket:
@@ -177,90 +255,140 @@ async def consumer_handler(websocket, server_state):
         else:
             print(f'Unknown message {message}')
 
-async def producer_handler(websocket, server_state):
-    previous_data = None
+async def broadcast_handler(server_state, clients):
+    """Wait for state changes, serialize them once and send them to every connected client."""
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    server_state.publisher.notify = lambda: loop.call_soon_threadsafe(changed.set)
+    changed.set()   # Flush anything recorded before we started listening
 
-    while True:        
-        try:
-            data = {
-                "instruction": server_state.my_instruction,
-                "prompt": server_state.my_prompt,
-                "model": server_state.my_model,
-                "result_a": server_state.my_result_a,
-                "result_b": server_state.my_result_b,
-                "image_result_a": server_state.my_image_result_a,
-                "image_result_b": server_state.my_image_result_b,
-                "selected_image": server_state.selected_image,
-                "state": str(server_state.my_state),
-                "error": server_state.my_error
-            }
-            # Only send the message if the data has changed
-            if data != previous_data:
-                await websocket.send(json.dumps(data))
-                previous_data = data
-
-        except exceptions.ConnectionClosed \
-                or exceptions.ConnectionClosedOK \
-                or exceptions.ConnectionClosedError \
-                or KeyboardInterrupt as e:
-            pass
-        await asyncio.sleep(POLL_DELAY)
-
-async def handler(websocket, server_state):
-    await asyncio.gather(
-        consumer_handler(websocket, server_state),
-        producer_handler(websocket, server_state),
-    )
-
-async def manage_transcription(server_state):
-    """Handle the state of the transcription task"""
     while True:
-        time_now = datetime.datetime.now()
-
-        if server_state.my_state == State.TRANSCRIBING:
-            # Check if the task is not running
-            if (server_state.my_task is None or server_state.my_task.done()):
-                await cancel_transcription(server_state)
-                server_state.my_task = asyncio.create_task(basic_transcribe(server_state))
-
-        elif server_state.my_state == State.ERROR and (time_now.timestamp() - server_state.my_error_time) < 10:
-            await asyncio.sleep(5)
-            server_state.get_next_prompt()
-            server_state.my_state == State.TRANSCRIBING
+        await changed.wait()
+        changed.clear()
+        with tracer.span("websocket_broadcast", trace=False):
+            message = server_state.publisher.drain()
+            if message and clients:
+                broadcast(clients, message)
+
+async def handler(websocket, server_state, clients):
+    """Send a new client a full snapshot, then let broadcast_handler send it deltas."""
+    # Flush pending deltas to the existing clients first so they aren't
+    # applied on top of a snapshot that already contains them
+    message, snapshot = server_state.publisher.snapshot_and_drain()
+    if message and clients:
+        broadcast(clients, message)
+    clients.add(websocket)
 
-        # Pause briefly to yield control and prevent a tight loop
-        await asyncio.sleep(1)
-
-async def poll_handler(server_state):
-    """Handle the GPIO button presses and restarting transcription after errors"""
-    while True:
-        try:
-            if server_state.my_state == State.REVIEW_TXT or server_state.my_state == State.REVIEW_IMG:
-                try:
-                    print("Waiting for button press.")
-                    while True:
-                        await asyncio.sleep(1)
-                        if server_state.button_pressed:
-                            server_state.save_results()
-                            break
-
-                except KeyboardInterrupt:
-                    print("Exiting program.")
-
-            await asyncio.sleep(0.01)
-        
-        except Exception as error:
-            print(error)
-            server_state.my_error = str(error)
-            server_state.my_error_time = datetime.datetime.now().timestamp()
-            server_state.my_state = State.ERROR
-            continue
-
-async def main():
-    """Main method to initialize and run the server."""
-    server_state = ServerState()
-    # Create a partial function for producer_handler with server_state
-    handler_with_state = partial(handler, server_state=server_state)
+    try:
+        await websocket.send(snapshot)
+        await consumer_handler(websocket, server_state)
+    except exceptions.ConnectionClosed:
+        pass
+    finally:
+        clients.discard(websocket)
+
+async def route(websocket, sessions, default):
+    """Connect a client to the session named by its path, e.g. ws://host:8765/booth2, or the first session for /."""
+    session_id = websocket.request.path.split("?")[0].strip("/") or default
+    if session_id not in sessions:
+        await websocket.close(4004, f"Unknown session {session_id}")
+        return
+    server_state, clients = sessions[session_id]
+    await handler(websocket, server_state, clients)
+
+async def start_transcription(server_state, pool, audio_source):
+    """Start transcribing the round, unless it has moved on or a transcription is already running."""
+    if server_state.my_state != State.TRANSCRIBING:
+        return
+    if server_state.my_task is None or server_state.my_task.done():
+        await cancel_transcription(server_state)
+        server_state.my_task = asyncio.create_task(basic_transcribe(server_state, pool, audio_source))
+        # Restart it if the stream ends before the round has moved on
+        server_state.my_task.add_done_callback(partial(transcription_ended, server_state))
+
+def transcription_ended(server_state, task):
+    """Done callback of the transcription task, pausing first if it died with an exception."""
+    failed = not task.cancelled() and task.exception() is not None
+    if failed:
+        print(f"Transcription task failed, restarting in {TRANSCRIBE_RESTART_S}s: {task.exception()}")
+    server_state.machine.after(TRANSCRIBE_RESTART_S if failed else 0, Event.TRANSCRIPTION_ENDED)
+
+def next_round(server_state):
+    """Save the guest's choice and start the next round."""
+    if server_state.my_state in SELECT_STATES:
+        server_state.save_results()
+
+def recover(server_state):
+    """Start a new round after an error."""
+    if server_state.my_state == State.ERROR:
+        server_state.get_next_prompt()
+
+def register_handlers(server_state, pool, audio_source):
+    """Wire the round up to the state machine in place of polling loops."""
+    machine = server_state.machine
+    machine.on(Event.BUTTON, server_state.select)
+    machine.on(Event.TRANSCRIPTION_ENDED, partial(start_transcription, server_state, pool, audio_source))
+    machine.on(Event.NEXT_ROUND, partial(next_round, server_state))
+    machine.on(Event.RECOVER, partial(recover, server_state))
+    machine.on_enter(State.TRANSCRIBING, partial(start_transcription, server_state, pool, audio_source))
+    machine.on_enter(State.ERROR, server_state.cancel_generations)
+    machine.on_enter(State.ERROR, partial(machine.after, ERROR_RECOVERY_S, Event.RECOVER))
+    for state in SELECT_STATES:
+        machine.on_enter(state, partial(machine.after, SELECT_DISPLAY_S, Event.NEXT_ROUND))
+
+def create_sessions():
+    """One ServerState per booth in SESSIONS, sharing their clients and caches.
+    Only the first is recorded when SESSION_RECORD_DIR is set."""
+    shared = SharedServices(sessions=len(SESSIONS))
+    if len(SESSIONS) > 1:
+        print(f"Hosting sessions: {', '.join(SESSIONS)}")
+    return [ServerState(shared=shared, session_id=session_id, recorder=SessionRecorder.from_env() if i == 0 else None)
+            for i, session_id in enumerate(SESSIONS)]
+
+async def main(server_state=None, transcribe_client=None, audio_source=mic_stream, sessions=None):
+    """Main method to initialize and run the server. The Bedrock, Transcribe
+    and microphone dependencies can be swapped for the stand-ins in fakes.py.
+    sessions is a list of ServerStates created with the same SharedServices,
+    or server_state a single one. Otherwise they are created from SESSIONS.
+    Set SESSION_RECORD_DIR to record the session for replay.py."""
+    sessions = sessions or ([server_state] if server_state else create_sessions())
+    server_state = sessions[0]
+    routes = {}
+    pools = []
+    tasks = []
+    for i, session in enumerate(sessions):
+        source = audio_source
+        if audio_source is mic_stream and i < len(AUDIO_DEVICES) and AUDIO_DEVICES[i] is not None:
+            source = partial(mic_stream, device=AUDIO_DEVICES[i])
+        if session.recorder:
+            source = session.recorder.wrap_audio(source)
+        clients = set()
+        pool = TranscribeStreamPool(
+            aws_region,
+            TRANSCRIBE_RATE_HZ,
+            client=transcribe_client,
+            language_code=language_code,
+            vocab_filter_name=vocab_filter_name,
+            vocab_filter_method=vocab_filter_method
+        )
+        register_handlers(session, pool, source)
+        routes[session.session_id] = (session, clients)
+        pools.append(pool)
+        tasks += [
+            session.machine.run(),
+            broadcast_handler(session, clients),
+            *([pool.maintain(session)] if TRANSCRIBE_PREWARM else []),
+        ]
+
+    # Images of every session are in the shared store
+    http_server = HttpServer()
+    http_server.route(IMAGE_PATH_PREFIX, server_state.image_store.handle_request)
+    http_server.route(THUMB_PATH_PREFIX, server_state.image_pipeline.handle_request)
+    http_server.route(METRICS_PATH, tracer.handle_request)
+    # On its own server, so it can be exposed without exposing the images
+    stats_server = HttpServer()
+    if server_state.results_index:
+        stats_server.route(STATS_PATH, server_state.results_index.handle_request)
 
     try:
         # Initialize GPIO
@@ -277,7 +405,7 @@ async def main():
             GPIO.setup(red_button_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
             GPIO.setup(blue_button_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 
-            # Register the button press events
+            # Register the button press events, the buttons belong to the first session
             GPIO.add_event_detect(red_button_pin, GPIO.FALLING, callback=server_state.red_button_callback, bouncetime=200)
             GPIO.add_event_detect(blue_button_pin, GPIO.FALLING, callback=server_state.blue_button_callback, bouncetime=200)
         else:
@@ -286,12 +414,21 @@ async def main():
     except Exception as error:
         print(error)
         
+    websocket_server = await serve(partial(route, sessions=routes, default=server_state.session_id),
+                                   WEBSOCKET_IP, WEBSOCKET_PORT, ping_timeout=None)
+    ready = time.monotonic() - PROCESS_START
+    tracer.record("startup", ready, trace=False)
+    print(f"Ready for kiosk clients {ready * 1000:.0f} ms after start")
+
     # Schedule these calls *concurrently*:
     await asyncio.gather(
-        poll_handler(server_state),
-        manage_transcription(server_state),
-        serve(handler_with_state, WEBSOCKET_IP, WEBSOCKET_PORT, ping_timeout=None)
+        *tasks,
+        server_state.region_pool.maintain(),
+        *([ConnectionWarmer(server_state.region_pool, pools, CLAUDE_MODEL_ID).run()] if WARMUP_ENABLED else []),
+        http_server.serve(WEBSOCKET_IP, HTTP_PORT),
+        *([stats_server.serve(STATS_BIND, STATS_PORT)] if server_state.results_index else []),
     )
+    websocket_server.close()
 
     if GPIO is not None:
         GPIO.cleanup()  # Clean up GPIO settings
@@ -2,54 +2,192 @@
 
 import json
 import datetime
+import itertools
+import threading
+import time
 import uuid
 from random import randint
-import boto3
 import os
-import asyncio
-import concurrent
-from botocore.config import Config
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 
-from states import State
+from states import State, Progress, Event
+from state_machine import StateMachine
+from publisher import StatePublisher
+from image_store import ImageStore, IMAGE_STORE_MAX_IMAGES
+from image_pipeline import ImagePipeline
+from generation import Generation, GenerationCancelled, GenerationTimeout
+from tracing import tracer
+from generation_cache import GenerationCache, cache_key, GENERATION_CACHE
+from results_writer import ResultsWriter
+from results_index import ResultsIndex
+from hedging import Hedger
+from region_pool import RegionPool, BEDROCK_REGIONS
+from model_limiter import ModelLimiter
+from profanity_filter import StreamingFilter, load_profanity
+from session_recorder import call_context
 
 aws_region = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
+results_dir = os.getenv("RESULTS_DIR", "/results")
+DEFAULT_SESSION = "default"     # Session id when the server hosts a single booth
+# Generate the A and B candidates in parallel rather than one after the other
+concurrent_generation = os.getenv("CONCURRENT_GENERATION", "true").lower() == "true"
+
+CLAUDE_MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+CLAUDE_PARAMS = {"max_tokens": 200, "temperature": 1}
+SDXL_MODEL_ID = "stability.stable-diffusion-xl-v1"
+SDXL_PARAMS = {"cfg_scale": 10, "steps": 50}
+# Show a quick low-step render of each image while the full one is generated with the same seed.
+# Bedrock bills SDXL per image, so this doubles the image cost.
+PROGRESSIVE_IMAGES = os.getenv("PROGRESSIVE_IMAGES", "false").lower() == "true"
+SDXL_PREVIEW_STEPS = int(os.getenv("SDXL_PREVIEW_STEPS", "10"))
+
+# Deadlines for each stage of a side's generation, after which the side is shown as failed. 0 for none.
+MODEL_QUEUE_TIMEOUT_S = float(os.getenv("MODEL_QUEUE_TIMEOUT_S", "10"))                 # Waiting for a MODEL_CONCURRENCY slot
+CLAUDE_FIRST_TOKEN_TIMEOUT_S = float(os.getenv("CLAUDE_FIRST_TOKEN_TIMEOUT_S", "8"))
+CLAUDE_TIMEOUT_S = float(os.getenv("CLAUDE_TIMEOUT_S", "20"))                           # The whole completion
+SDXL_TIMEOUT_S = float(os.getenv("SDXL_TIMEOUT_S", "20"))
+
+# ServerState attributes mirrored to the kiosk UI, and the key each is sent as
+PUBLISHED_FIELDS = {
+    "my_instruction": "instruction",
+    "my_prompt": "prompt",
+    "my_model": "model",
+    "my_result_a": "result_a",
+    "my_result_b": "result_b",
+    "my_image_result_a": "image_result_a",
+    "my_image_result_b": "image_result_b",
+    "selected_image": "selected_image",
+    "my_state": "state",
+    "my_progress_a": "progress_a",
+    "my_progress_b": "progress_b",
+    "my_error": "error",
+}
+
+class SharedServices:
+    """Clients, caches and workers shared by all the kiosk sessions in a process.
+
+    Images are stored by content hash, so one store (sized for all the
+    sessions) serves every booth's images over HTTP.
+    """
+
+    def __init__(self, bedrock_runtime=None, region_pool=None, sessions=1):
+        """A bedrock_runtime client (or a stand-in from fakes.py) can be
+        passed in instead of creating one, or a RegionPool of them."""
+        self.image_store = ImageStore(IMAGE_STORE_MAX_IMAGES * sessions)
+        self.image_pipeline = ImagePipeline(self.image_store, IMAGE_STORE_MAX_IMAGES * sessions)
+        self.generation_cache = GenerationCache() if GENERATION_CACHE else None
+        # Win rates and timings for /stats, kept up to date by the results writer
+        self.results_index = ResultsIndex.open(results_dir)
+        self.results_writer = ResultsWriter.open(results_dir, self.results_index)
+        self.profanity = load_profanity()
+
+        if region_pool is None:
+            # The boto3 clients are created when first used, usually by the ConnectionWarmer
+            runtimes = {aws_region: bedrock_runtime} if bedrock_runtime else dict.fromkeys(BEDROCK_REGIONS)
+            region_pool = RegionPool(runtimes)
+        self.region_pool = region_pool
+        # Slow calls get a duplicate request, see hedging.py. Room for each session's
+        # two sides and two previews to have a hedge in flight
+        self.hedger = Hedger(max_workers=8 * sessions)
+        # Fair share of each model between sessions
+        self.limiter = ModelLimiter()
+        # Room for a cancelled speculative generation to finish alongside the current one, per session
+        self.generation_executor = ThreadPoolExecutor(max_workers=4 * sessions, thread_name_prefix="generation")
+        # Preview renders run alongside the full ones, one per side
+        self.preview_executor = ThreadPoolExecutor(max_workers=2 * sessions, thread_name_prefix="preview")
+        # Bedrock calls and stream reads, so a generation can stop waiting on them. Abandoned ones finish here too
+        self.call_executor = ThreadPoolExecutor(max_workers=8 * sessions, thread_name_prefix="bedrock-call")
 
 # Encapsulate global state and functionality in a class
 class ServerState:
-    def __init__(self):
-        """Initialize the state variables."""
+    def __init__(self, bedrock_runtime=None, region_pool=None, recorder=None, shared=None, session_id=DEFAULT_SESSION):
+        """Initialize the state variables for one kiosk session. Sessions
+        hosted by the same process pass in the same SharedServices, otherwise
+        one is created from bedrock_runtime or region_pool. A SessionRecorder
+        captures the session for replay.py."""
+        shared = shared or SharedServices(bedrock_runtime, region_pool)
+        self.session_id = session_id
+        self.recorder = recorder
+        self.round_number = 0
+        self.publisher = StatePublisher()
+        self.machine = StateMachine(self)
+        self.image_store = shared.image_store
+        self.image_pipeline = shared.image_pipeline
+        self.generation_cache = shared.generation_cache
+        self.results_writer = shared.results_writer
+        self.results_index = shared.results_index
+        self.profanity = shared.profanity
+        self.region_pool = shared.region_pool
+        self.hedger = shared.hedger
+        self.limiter = shared.limiter
+        self.generation_executor = shared.generation_executor
+        self.preview_executor = shared.preview_executor
+        self.call_executor = shared.call_executor
+        self.my_generations = []    # Generations started this round, cancelled when it ends
         self.my_state = State.INITIALIZING
         self.prompts = []
         self.current_prompt_index = 0
         self.my_instruction = None
         self.my_prompt = None
         self.my_model = None
+        # Images are content hashes into self.image_store
         self.my_image_result_a = ""
         self.my_image_result_b = ""
         self.selected_image = ""
         self.my_result_a = ""
         self.my_result_b = ""
+        self.my_progress_a = Progress.IDLE
+        self.my_progress_b = Progress.IDLE
+        # Bedrock region that produced each side, recorded with the results
+        self.my_region_a = ""
+        self.my_region_b = ""
         self.my_human_preference = None
-        self.button_pressed = False
         self.my_task = None
         self.my_transcribe_stream = None
         self.my_error = None
         self.my_error_time = datetime.datetime.now().timestamp()
+        self.round_start_time = time.monotonic()
+        self.state_times = {}       # State -> time.monotonic() it was first entered this round
         self.my_uuid = uuid.uuid4()
 
-        config = Config(
-            connect_timeout=1, read_timeout=30,
-            retries={'max_attempts': 1})
-
-        self.bedrock_runtime = boto3.client(
-            service_name="bedrock-runtime",
-            region_name=aws_region,
-            config=config
-        )
+        if recorder:
+            recorder.session_id = session_id
+            for region in self.region_pool.regions:
+                region.runtime = recorder.wrap_runtime(region.runtime, region.name)
 
         self.load_prompts("prompts.json")
         self.get_next_prompt()
 
+    def __setattr__(self, name, value):
+        """Publish changes to the fields the kiosk UI displays."""
+        if name == "my_state":
+            # Generation threads and the event loop both change state
+            with self.machine.lock:
+                self.machine.check_transition(self.__dict__.get("my_state"), value)
+                self.trace_transition(value)
+                super().__setattr__(name, value)
+                if self.__dict__.get("recorder"):
+                    self.recorder.record_state(value, self.round_number)
+            self.machine.transitioned(value)
+        else:
+            super().__setattr__(name, value)
+        key = PUBLISHED_FIELDS.get(name)
+        if key:
+            self.publisher.record(key, str(value) if isinstance(value, Enum) else value)
+
+    def trace_transition(self, state):
+        """Record how long was spent in the state being left."""
+        now = time.monotonic()
+        previous = self.__dict__.get("my_state")
+        if previous == state:
+            return
+        if previous is not None:
+            tracer.record("state", now - self.state_entered_at, labels={"state": previous.name},
+                          next=state.name, round=self.__dict__.get("my_uuid"))
+        self.state_entered_at = now
+        self.__dict__.setdefault("state_times", {}).setdefault(state, now)
+
     def load_prompts(self, file_path):
         """Load prompts from a given JSON file."""
         try:
@@ -63,11 +201,18 @@ class ServerState:
     def get_next_prompt(self):
         """Called at the end of a human interaction to get a new prompt and 
         reset the state variables."""
+        self.cancel_generations()
         self.my_result_a = ""
         self.my_result_b = ""
+        self.my_progress_a = Progress.IDLE
+        self.my_progress_b = Progress.IDLE
+        self.my_region_a = ""
+        self.my_region_b = ""
         self.my_human_preference = None
-        self.button_pressed = False
+        self.round_number += 1
+        self.state_times = {}
         self.my_state = State.TRANSCRIBING
+        self.round_start_time = time.monotonic()
         self.my_uuid = uuid.uuid4()
         self.my_instruction = ""
         if self.prompts:
@@ -86,55 +231,97 @@ class ServerState:
             print("No prompts are loaded.")
             return None
     
+    def cancel_generations(self):
+        """Stop the round's generations, so nothing they still produce reaches the UI."""
+        generations, self.my_generations = self.my_generations, []
+        for generation in generations:
+            generation.cancel()
+
     def red_button_callback(self, channel):
-        """Logic for handling a red button press."""
-        if self.my_state == State.REVIEW_TXT or self.my_state == State.REVIEW_IMG: # Ignore all button presses outside of review state
-            self.my_human_preference = 'a'
-            print("Red button pressed!") 
-            self.button_pressed = True
-            if self.my_model == "claude":
-                self.my_state = State.SELECT_A_TXT
-            elif self.my_model == "sdxl":
-                self.selected_image = self.my_image_result_a
-                self.my_state = State.SELECT_A_IMG
-            else:
-                raise ValueError(f"Unknown model specified: {self.my_model}")
-        
+        """Called from the GPIO thread, or for an "A" message from the UI."""
+        self.record_input('a', channel)
+        self.machine.submit(Event.BUTTON, 'a')
+
     def blue_button_callback(self, channel):
-        """Logic for handling a blue button press."""
-        if self.my_state == State.REVIEW_TXT or self.my_state == State.REVIEW_IMG: # Ignore all button presses outside of review state
-            self.my_human_preference = 'b'
-            print("Blue button pressed!")
-            self.button_pressed = True
-            if self.my_model == "claude":
-                self.my_state = State.SELECT_B_TXT
-            elif self.my_model == "sdxl":
-                self.selected_image = self.my_image_result_b
-                self.my_state = State.SELECT_B_IMG
-            else:
-                raise ValueError(f"Unknown model specified: {self.my_model}")
-            
-    def call_claude3(self):
+        """Called from the GPIO thread, or for a "B" message from the UI."""
+        self.record_input('b', channel)
+        self.machine.submit(Event.BUTTON, 'b')
+
+    def record_input(self, side, channel):
+        if self.recorder:
+            self.recorder.record_input(side, "websocket" if channel is None else "gpio", self.my_state,
+                                       time.monotonic() - self.state_entered_at, self.round_number)
+
+    def select(self, side):
+        """Handle a button press for side 'a' (red) or 'b' (blue) on the event loop."""
+        if self.my_state not in (State.REVIEW_TXT, State.REVIEW_IMG): # Ignore all button presses outside of review state
+            return
+        # Review can start with one side still generating after the other failed. Only a finished
+        # response can be picked, so an image round never keeps an empty hash or the preview
+        if (self.my_progress_a if side == 'a' else self.my_progress_b) != Progress.DONE:
+            return
+        self.my_human_preference = side
+        print(f"{'Red' if side == 'a' else 'Blue'} button pressed!")
+        if self.my_model == "claude":
+            self.my_state = State.SELECT_A_TXT if side == 'a' else State.SELECT_B_TXT
+        elif self.my_model == "sdxl":
+            self.selected_image = self.my_image_result_a if side == 'a' else self.my_image_result_b
+            self.my_state = State.SELECT_A_IMG if side == 'a' else State.SELECT_B_IMG
+        else:
+            raise ValueError(f"Unknown model specified: {self.my_model}")
+
+    def append_result(self, side, text):
+        """Append streamed text to the result for side 'a' or 'b'."""
+        if side == 'a':
+            self.my_result_a += text
+        else:
+            self.my_result_b += text
+
+    def set_image_result(self, side, image):
+        """Store the generated image for side 'a' or 'b'."""
+        if side == 'a':
+            self.my_image_result_a = image
+        else:
+            self.my_image_result_b = image
+
+    def set_region(self, side, region):
+        """Record the Bedrock region that answered for side 'a' or 'b'."""
+        if side == 'a':
+            self.my_region_a = region
+        else:
+            self.my_region_b = region
+
+    def set_progress(self, side, progress):
+        """Update the progress flag for side 'a' or 'b'."""
+        if side == 'a':
+            self.my_progress_a = progress
+        else:
+            self.my_progress_b = progress
+
+    def call_claude3(self, generation, side):
+        """Stream a Claude 3 completion about the selected image into the given side."""
+        # Downscaled once per image and shared by both sides
+        media_type, image_data = self.image_pipeline.vision(self.selected_image)
+
         # Construct the body dictionary
         body_dict = {
             "messages": [
                 {"role": "user", 
                  "content": [
                     {   "type": "text",
-                        "text": self.my_prompt 
+                        "text": generation.prompt 
                     },
                     {
                         "type": "image",
                         "source": {
                             "type": "base64",
-                            "media_type": "image/png",
-                            "data": self.selected_image
+                            "media_type": media_type,
+                            "data": image_data
                         }
                     }
                  ]
                  }],
-            "max_tokens": 200,
-            "temperature": 1,
+            **CLAUDE_PARAMS,
             "anthropic_version": "bedrock-2023-05-31"
         }
 
@@ -143,95 +330,266 @@ class ServerState:
 
         # Construct the kwargs dictionary
         kwargs = {
-            "modelId": "anthropic.claude-3-haiku-20240307-v1:0",
+            "modelId": CLAUDE_MODEL_ID,
             "contentType": "application/json",
             "accept": "*/*",
             "body": body_str
         }
 
+        key = None
+        if self.generation_cache:
+            key = cache_key(generation.prompt, CLAUDE_MODEL_ID, CLAUDE_PARAMS, self.selected_image)
+            cached = self.generation_cache.take(key, generation.cache_used)
+            if cached is not None:
+                generation.append_result(side, cached.decode())
+                print(f"Completion {side.upper()} (cached): {generation.result(side)}")
+                return
+
         # Invoke the model
-        response = self.bedrock_runtime.invoke_model_with_response_stream(**kwargs)
-        stream = response.get('body')
-        if stream:
-            for event in stream:
+        labels = {"model": "claude", "side": side}
+        sent = time.monotonic()
+        close = lambda result: result[0].get('body').close()
+        with generation.deadline(side, "finish", CLAUDE_TIMEOUT_S):
+            with generation.deadline(side, "start", CLAUDE_FIRST_TOKEN_TIMEOUT_S):
+                region, (response, stream) = generation.wait_for(side, self.call_executor.submit(
+                    self.invoke_bedrock,
+                    CLAUDE_MODEL_ID,
+                    lambda runtime: self.open_claude_stream(runtime, kwargs),
+                    release=close,
+                    labels={"model": "claude"},
+                    context=(generation.round_number, side),
+                ), release=lambda result: close(result[1]))
+            generation.set_region(side, region)
+            # Mask listed words as they stream in, even when split across chunks
+            profanity = StreamingFilter(self.profanity) if self.profanity else None
+            first_token = True
+            for event in generation.iterate(side, stream or (), self.call_executor, release=lambda _: response.get('body').close()):
                 chunk = event.get('chunk')
                 if chunk:
                     delta = json.loads(chunk.get('bytes').decode()).get("delta")
                     if delta:
                         text = delta.get("text")
                         if text:
-                            self.my_result_a += text
+                            if first_token:
+                                tracer.record("bedrock_first_token", time.monotonic() - sent, labels, round=self.my_uuid)
+                                first_token = False
+                            generation.append_result(side, profanity.feed(text) if profanity else text)
+        if profanity:
+            generation.append_result(side, profanity.flush())
+        tracer.record("bedrock_last_token", time.monotonic() - sent, labels, round=self.my_uuid)
+        if key:
+            self.generation_cache.put(key, generation.result(side).encode(), time.monotonic() - sent, generation.cache_used)
 
-        print(f"Completion A: {self.my_result_a}")
-        self.my_state = State.INFERENCE_TXT_B
+        print(f"Completion {side.upper()}: {generation.result(side)}")
 
-        # Invoke the model
-        response = self.bedrock_runtime.invoke_model_with_response_stream(**kwargs)
-        stream = response['body']
-        if stream:
-            for event in stream:
-                chunk = event.get('chunk')
-                if chunk:
-                    delta = json.loads(chunk.get('bytes').decode()).get("delta")
-                    if delta:
-                        text = delta.get("text")
-                        if text:
-                            self.my_result_b += text
+    def invoke_bedrock(self, model_id, call, release=None, labels=None, context=None):
+        """Run call(bedrock_runtime) in the fastest healthy region, hedging a
+        slow call into the next best one. Returns (region name, result).
+        context is the (round number, side) the call is for, which session
+        recordings key responses by."""
+        tried = []
+
+        def attempt():
+            call_context.session = self.session_id
+            call_context.round, call_context.side = context or (None, None)
+            region = self.region_pool.choose(model_id, exclude=tried)
+            tried.append(region.name)
+            return region.name, self.region_pool.run(region, model_id, call)
+
+        return self.hedger.call(model_id, attempt, release=release and (lambda result: release(result[1])), labels=labels)
 
-        print(f"Completion B: {self.my_result_b}")
+    def open_claude_stream(self, bedrock_runtime, kwargs):
+        """Start a streaming completion and wait for its first event, so that
+        hedging and region scores cover the time to first token. Returns the
+        response and an iterator over all of its events."""
+        response = bedrock_runtime.invoke_model_with_response_stream(**kwargs)
+        events = iter(response.get('body') or ())
+        first = next(events, None)
+        return response, itertools.chain([first] if first else [], events)
 
-    def invoke_sdxl(self):
-        """Specific logic for making a sdxl prediction."""
+    def invoke_sdxl(self, prompt, context=None, seed=None, steps=None):
+        """Specific logic for making a sdxl prediction. Returns the region and the base64 image.
+        steps overrides SDXL_PARAMS for a preview, which is tracked apart from full renders."""
         body_dict = {
-            "text_prompts": [{"text": self.my_prompt}],
-            "cfg_scale": 10,
-            "seed": randint(0, 1000),
-            "steps": 50
+            "text_prompts": [{"text": prompt}],
+            "seed": randint(0, 1000) if seed is None else seed,
+            **SDXL_PARAMS,
+            **({"steps": steps} if steps else {}),
         }
+        phase = "preview" if steps else "final"
         
         # Serialize the dictionary to a JSON string
         body_str = json.dumps(body_dict)
 
         # Construct the outer dictionary
         kwargs = {
-            "modelId": "stability.stable-diffusion-xl-v1",
+            "modelId": SDXL_MODEL_ID,
             "contentType": "application/json",
             "accept": "application/json",
             "body": body_str
         }
 
         # Invoke the model
-        response = self.bedrock_runtime.invoke_model(**kwargs)
-        response_body = json.loads(response.get("body").read())
+        with tracer.span("bedrock_invoke", {"model": "sdxl", "phase": phase}, round=self.my_uuid):
+            region, response_body = self.invoke_bedrock(
+                SDXL_MODEL_ID if not steps else f"{SDXL_MODEL_ID}/{phase}",
+                lambda runtime: json.loads(runtime.invoke_model(**kwargs).get("body").read()),
+                labels={"model": "sdxl", "phase": phase},
+                context=context,
+            )
 
         results = response_body.get("artifacts")[0].get("base64")
-        return results
-
-    def handle_image_gen(self):
-        image = self.invoke_sdxl()
-        self.my_image_result_a = image
-        self.my_state = State.INFERENCE_IMG_B
-        image = self.invoke_sdxl()
-        self.my_image_result_b = image        
-        
-    def handle_generation(self):
+        return region, results
+
+    def handle_image_gen(self, generation, side):
+        key = cache_key(generation.prompt, SDXL_MODEL_ID, SDXL_PARAMS) if self.generation_cache else None
+        cached = self.generation_cache.take(key, generation.cache_used) if key else None
+        sent = time.monotonic()
+        labels = {"model": "sdxl", "side": side}
+        shown = threading.Lock()
+        final_shown = False
+        if cached is not None:
+            digest = self.image_store.put(cached)
+        else:
+            seed = randint(0, 1000)
+
+            def show_preview():
+                try:
+                    _, image = self.invoke_sdxl(generation.prompt, (generation.round_number, f"{side}-preview"),
+                                                seed, SDXL_PREVIEW_STEPS)
+                    preview = self.image_store.put_base64(image)
+                    self.image_pipeline.prepare(preview).result()
+                except Exception as e:
+                    print(f"Preview {side.upper()} failed: {e}")
+                    return
+                with shown:
+                    if final_shown:
+                        return
+                    try:
+                        generation.set_image_result(side, preview)
+                    except (GenerationCancelled, GenerationTimeout):
+                        return
+                    tracer.record("image_first_pixel", time.monotonic() - sent, labels, round=self.my_uuid)
+
+            if PROGRESSIVE_IMAGES:
+                self.preview_executor.submit(show_preview)
+            with generation.deadline(side, "render", SDXL_TIMEOUT_S):
+                region, image = generation.wait_for(side, self.call_executor.submit(
+                    self.invoke_sdxl, generation.prompt, (generation.round_number, side), seed))
+            generation.set_region(side, region)
+            with tracer.span("image_decode", round=self.my_uuid):
+                digest = self.image_store.put_base64(image)
+            if key:
+                self.generation_cache.put(key, self.image_store.get(digest), time.monotonic() - sent, generation.cache_used)
+        # Have the thumbnail and vision variants ready before the UI asks for them
+        self.image_pipeline.prepare(digest).result()
+        # The full render replaces the preview, so it's what the guest picks, Claude sees and results keep
+        with shown:
+            if generation.image(side) == "":
+                tracer.record("image_first_pixel", time.monotonic() - sent, labels, round=self.my_uuid)
+            final_shown = True
+            generation.set_image_result(side, digest)
+        tracer.record("image_final", time.monotonic() - sent, labels, round=self.my_uuid)
+
+    def run_side(self, generation, generate, side):
+        """Run one side's generation, keeping its progress flag up to date."""
+        try:
+            # Waits here while other sessions have the model's slots
+            with self.limiter.slot(generation.model, self.session_id, MODEL_QUEUE_TIMEOUT_S):
+                generation.check()
+                generation.set_progress(side, Progress.RUNNING)
+                generate(generation, side)
+        except GenerationCancelled:
+            generation.set_progress(side, Progress.FAILED)
+            raise
+        except Exception as e:
+            print(f"Generation {side.upper()} failed: {e}")
+            generation.set_progress(side, Progress.FAILED)
+            raise
+        generation.set_progress(side, Progress.DONE)
+
+    def generate_both(self, generation, generate, review_state):
+        """Produce the A and B candidates with generate(generation, side).
+
+        Move to review_state once both sides have finished, or as soon as one
+        side fails so the guest isn't kept waiting on it. Only if both sides
+        fail is the error raised.
+        """
+        generation.set_progress('a', Progress.PENDING)
+        generation.set_progress('b', Progress.PENDING)
+
+        if not concurrent_generation:
+            errors = []
+            for side in ('a', 'b'):
+                try:
+                    self.run_side(generation, generate, side)
+                except Exception as e:
+                    errors.append(e)
+            self.raise_errors(generation, errors)
+            generation.set_state(review_state)
+            return
+
+        futures = [self.generation_executor.submit(self.run_side, generation, generate, side) for side in ('a', 'b')]
+        done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+        if pending:
+            # One side failed - show what we have while the other side carries on streaming
+            generation.set_state(review_state)
+            wait(pending)
+        self.raise_errors(generation, [e for e in (f.exception() for f in futures) if e])
+        if not pending:
+            generation.set_state(review_state)
+
+    def raise_errors(self, generation, errors):
+        """Raise the first error if both sides failed. If the round ended meanwhile
+        (say the guest picked the side still streaming after the other failed),
+        that is GenerationCancelled, so the error doesn't land on the next round."""
+        if len(errors) == 2:
+            generation.check()
+            raise errors[0]
+
+    def start_generation(self, prompt, speculative=False):
+        """Create a Generation for prompt with the current model.
+
+        A speculative generation is detached: its output is buffered until
+        it is attached to this ServerState.
+        """
+        generation = Generation(self, prompt, self.my_model, attached=not speculative)
+        self.my_generations.append(generation)
+        return generation
+
+    def handle_generation(self, generation=None):
         """General method to make a prediction based on the model type."""
-        
-        if self.my_model == "claude":
-            self.my_state = State.INFERENCE_TXT_A
-            self.call_claude3()
-            self.my_state = State.REVIEW_TXT
-        elif self.my_model == "sdxl":
-            self.my_state = State.INFERENCE_IMG_A
-            self.handle_image_gen()
-            self.my_state = State.REVIEW_IMG
+        if generation is None:
+            generation = self.start_generation(self.my_prompt)
+
+        if generation.model == "claude":
+            generation.set_state(State.INFERENCE_TXT)
+            self.generate_both(generation, self.call_claude3, State.REVIEW_TXT)
+        elif generation.model == "sdxl":
+            generation.set_state(State.INFERENCE_IMG)
+            self.generate_both(generation, self.handle_image_gen, State.REVIEW_IMG)
         else:
-            raise ValueError(f"Unknown model specified: {self.my_model}")
+            raise ValueError(f"Unknown model specified: {generation.model}")
         
+    def round_timings(self):
+        """Seconds this round spent generating, in review and in all, for the results record."""
+        now = time.monotonic()
+        generating = min((t for state, t in self.state_times.items() if state != State.TRANSCRIBING), default=now)
+        reviewing = min((t for state, t in self.state_times.items() if state in (State.REVIEW_TXT, State.REVIEW_IMG)), default=now)
+        return {
+            "generation": round(reviewing - generating, 3),
+            "review": round(now - reviewing, 3),
+            "round": round(now - self.round_start_time, 3),
+        }
+
     def save_results(self):
-        """Write to disk so human preferences can be uploaded to S3 later."""
-        if self.my_human_preference:
-            data = {
+        """Queue the round for the results writer so human preferences can be uploaded to S3 later."""
+        if self.my_human_preference and self.results_writer:
+            # Text rounds refer to the image of an earlier round, which was saved with it
+            images = (self.my_image_result_a, self.my_image_result_b) if self.my_model == "sdxl" else ()
+            record = {
+                'id': str(self.my_uuid),
+                'session': self.session_id,
                 'timestamp': str(datetime.datetime.now()),
                 'model': self.my_model,
                 'prompt': self.my_prompt,
@@ -241,12 +599,11 @@ class ServerState:
                 'result_a': self.my_result_a,
                 'result_b': self.my_result_b,
                 'human_preference': self.my_human_preference,
+                'region_a': self.my_region_a,
+                'region_b': self.my_region_b,
+                'timings': self.round_timings(),
             }
-
-            try:
-                with open(f"/results/{self.my_uuid}.json", "w") as f:
-                    json.dump(data, f, indent=4)
-            except Exception as e:
-                print(f"An error occurred while saving results: {e}")
+            with tracer.span("save_results", round=self.my_uuid):
+                self.results_writer.submit(record, {digest: self.image_store.get(digest) for digest in images if digest})
         self.get_next_prompt()
     
\ No newline at end of file
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import gzip
+import io
+import json
+import os
+import struct
+import threading
+import time
+
+SESSION_RECORD_DIR = os.getenv("SESSION_RECORD_DIR", "")    # Record sessions here for replay.py. Off when empty
+
+# Each record is a header (seconds since the recording started, JSON length,
+# payload length), the JSON and then the raw payload, inside one gzip stream
+RECORD = struct.Struct(">dII")
+
+# Which session, round and side the Bedrock call on this thread is for, set
+# by ServerState so recorded and replayed responses line up with the same side
+call_context = threading.local()
+
+class SessionRecorder:
+    """Captures what goes into a kiosk session so replay.py can play it back.
+
+    Records the audio each transcription stream was sent, the transcript
+    events that came back, every Bedrock response with its timing, the
+    guest's button presses and the state changes, all in one compact
+    gzipped file. The file is flushed at the start of every round, so a
+    crash loses at most the round in progress.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, "wb")
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.stream = 0
+        self.calls = 0
+        self.session_id = None  # Set by the ServerState being recorded
+        print(f"Recording session to {path}")
+
+    @classmethod
+    def from_env(cls):
+        if not SESSION_RECORD_DIR:
+            return None
+        os.makedirs(SESSION_RECORD_DIR, exist_ok=True)
+        return cls(os.path.join(SESSION_RECORD_DIR, f"session-{time.strftime('%Y%m%dT%H%M%S')}.rec.gz"))
+
+    def write(self, record, payload=b""):
+        header = json.dumps(record, separators=(",", ":")).encode()
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(RECORD.pack(time.monotonic() - self.start, len(header), len(payload)) + header + payload)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def record_state(self, state, round_number):
+        self.write({"type": "state", "state": state.name, "round": round_number})
+        if state.name == "TRANSCRIBING":
+            with self.lock:
+                if self.file is not None:
+                    self.file.flush()
+
+    def record_input(self, side, source, state, since_state, round_number):
+        self.write({"type": "input", "side": side, "source": source, "state": state.name,
+                    "since_state": since_state, "round": round_number})
+
+    def start_stream(self):
+        """Called when a round starts transcribing. Audio and transcripts are grouped by stream."""
+        self.stream += 1
+        self.write({"type": "transcription", "stream": self.stream})
+
+    def wrap_audio(self, audio_source):
+        """Wrap a mic_stream-like audio source so its chunks are recorded."""
+        async def recorded(server_state):
+            async for chunk in audio_source(server_state):
+                self.write({"type": "audio", "stream": self.stream}, chunk)
+                yield chunk
+        return recorded
+
+    def record_transcript(self, transcript_event):
+        results = [{"partial": result.is_partial, "text": [alt.transcript for alt in result.alternatives]}
+                   for result in transcript_event.transcript.results]
+        self.write({"type": "transcript", "stream": self.stream, "results": results})
+
+    def wrap_runtime(self, runtime, region):
+        return RecordingBedrockRuntime(runtime, self, region)
+
+    def next_call(self):
+        with self.lock:
+            self.calls += 1
+            return self.calls
+
+class RecordingBedrockRuntime:
+    """Passes calls through to a bedrock-runtime client, recording the responses and their timing."""
+
+    def __init__(self, runtime, recorder, region):
+        self.runtime = runtime
+        self.recorder = recorder
+        self.region = region
+
+    def context(self, kwargs):
+        return {"model_id": kwargs.get("modelId"), "region": self.region, "call": self.recorder.next_call(),
+                "round": getattr(call_context, "round", None), "side": getattr(call_context, "side", None)}
+
+    def recording(self):
+        # The clients are shared by every session in the process, only one of which is recorded
+        return getattr(call_context, "session", None) == self.recorder.session_id
+
+    def invoke_model(self, **kwargs):
+        if not self.recording():
+            return self.runtime.invoke_model(**kwargs)
+        record = {"type": "invoke", **self.context(kwargs)}
+        start = time.monotonic()
+        response = self.runtime.invoke_model(**kwargs)
+        body = response.get("body").read()
+        self.recorder.write({**record, "latency": time.monotonic() - start}, body)
+        return {**response, "body": io.BytesIO(body)}
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        if not self.recording():
+            return self.runtime.invoke_model_with_response_stream(**kwargs)
+        record = {"type": "response_stream", **self.context(kwargs)}
+        start = time.monotonic()
+        response = self.runtime.invoke_model_with_response_stream(**kwargs)
+        return {**response, "body": RecordedEventStream(response.get("body"), self.recorder, record, start)}
+
+class RecordedEventStream:
+    """Iterates a response stream, recording each chunk's bytes and arrival time.
+
+    The whole stream is written as one record once it ends or is closed, so
+    a losing hedged stream is marked incomplete and skipped on replay.
+    """
+
+    def __init__(self, body, recorder, record, start):
+        self.body = body
+        self.recorder = recorder
+        self.record = record
+        self.start = start
+        self.offsets = []
+        self.chunks = []
+        self.complete = False
+        self.written = False
+
+    def __iter__(self):
+        try:
+            for event in self.body or ():
+                chunk = event.get("chunk")
+                if chunk:
+                    self.offsets.append(time.monotonic() - self.start)
+                    self.chunks.append(chunk.get("bytes"))
+                yield event
+            self.complete = True
+        finally:
+            self.write()
+
+    def close(self):
+        if hasattr(self.body, "close"):
+            self.body.close()
+        self.write()
+
+    def write(self):
+        if self.written:
+            return
+        self.written = True
+        self.recorder.write({**self.record, "complete": self.complete, "offsets": self.offsets,
+                             "sizes": [len(chunk) for chunk in self.chunks]}, b"".join(self.chunks))
+
+def read_session(path):
+    """Yield (time, record, payload) from a session file, stopping quietly at a truncated end."""
+    with gzip.open(path, "rb") as f:
+        while True:
+            try:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    return
+                t, json_length, payload_length = RECORD.unpack(header)
+                record = json.loads(f.read(json_length))
+                payload = f.read(payload_length)
+            except (EOFError, OSError, ValueError):
+                return
+            yield t, record, payload
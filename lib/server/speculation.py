@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import asyncio
+import os
+
+# Start generating before Transcribe finalizes, once the partial transcript stops changing
+SPECULATIVE_GENERATION = os.getenv("SPECULATIVE_GENERATION", "false").lower() == "true"
+SPECULATIVE_WINDOW = float(os.getenv("SPECULATIVE_WINDOW", "0.8"))    # Seconds a partial must be unchanged
+
+class SpeculationStats:
+    """Hit/miss counts for speculative generation, used to tune SPECULATIVE_WINDOW."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        print(f"Speculation {'hit' if hit else 'miss'}: {self.hits} hits, {self.misses} misses ({self.hit_ratio:.0%})")
+
+stats = SpeculationStats()
+
+class Speculator:
+    """Runs a detached generation on a partial transcript that has been stable
+    for SPECULATIVE_WINDOW seconds.
+
+    If the final transcript matches the speculated one after normalization,
+    the generation is attached and its output kept. Otherwise it is cancelled
+    and generation restarts on the final transcript.
+    """
+
+    def __init__(self, server_state, normalize):
+        self.server_state = server_state
+        self.normalize = normalize      # async callable, e.g. MyEventHandler.modify_string
+        self.text = None                # Normalized text of the latest partial
+        self.timer = None
+        self.speculated_text = None
+        self.generation = None
+        self.task = None
+
+    async def on_partial(self, transcript):
+        text = await self.normalize(transcript)
+        if text == self.text:
+            return
+        self.text = text
+
+        if self.generation and text != self.speculated_text:
+            # The guest kept talking, so this guess can't be right any more
+            self.discard()
+        if self.timer:
+            self.timer.cancel()
+        if text:
+            self.timer = asyncio.create_task(self.start_after_window(transcript, text))
+
+    async def start_after_window(self, transcript, text):
+        await asyncio.sleep(SPECULATIVE_WINDOW)
+        self.speculated_text = text
+        self.generation = self.server_state.start_generation(transcript, speculative=True)
+        self.task = asyncio.create_task(asyncio.to_thread(self.server_state.handle_generation, self.generation))
+        # A discarded generation ends with GenerationCancelled - nobody awaits it
+        self.task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    async def on_final(self, transcript):
+        """Complete the round's generation for the final transcript."""
+        if self.timer:
+            self.timer.cancel()
+
+        text = await self.normalize(transcript)
+        if self.generation and text == self.speculated_text:
+            stats.record(hit=True)
+            self.generation.attach()
+            task, self.generation, self.task = self.task, None, None
+            await task
+            return
+
+        if self.generation:
+            self.discard()
+        await asyncio.to_thread(self.server_state.handle_generation)
+
+    def discard(self):
+        """Cancel the speculative generation and count it as a miss."""
+        stats.record(hit=False)
+        self.generation.cancel()
+        self.generation = None
+        self.task = None
+        self.speculated_text = None
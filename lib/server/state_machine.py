@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import asyncio
+import concurrent.futures
+import datetime
+import inspect
+import threading
+
+from states import State, TRANSITIONS
+
+class InvalidTransition(ValueError):
+    """Raised when a state change isn't in states.TRANSITIONS."""
+
+class StateMachine:
+    """Runs the round from events instead of polling.
+
+    Events (button presses from the GPIO thread or WebSocket clients, the
+    end of a transcription task, timers) can be submitted from any thread
+    and are handled one at a time on the event loop. Entering a state queues
+    that state's on_enter handlers the same way, whichever thread made the
+    change. Coroutines can await a state with wait_for() or the next change
+    with next_change() rather than checking in a loop.
+    """
+
+    def __init__(self, server_state):
+        self.server_state = server_state
+        self.lock = threading.RLock()
+        self.loop = None
+        self.events = None
+        self.handlers = {}          # Event -> handler
+        self.enter_handlers = {}    # State -> [handler]
+        self.waiters = []           # (states or None for any change, asyncio.Future)
+
+    def on(self, event, handler):
+        """Handle event with handler(*args), which may be a coroutine function."""
+        self.handlers[event] = handler
+
+    def on_enter(self, state, handler):
+        """Call handler() whenever state is entered."""
+        self.enter_handlers.setdefault(state, []).append(handler)
+
+    def check_transition(self, previous, state):
+        if previous is None or previous == state or state == State.ERROR:
+            return
+        if state not in TRANSITIONS.get(previous, ()):
+            raise InvalidTransition(f"Can't go from {previous.name} to {state.name}")
+
+    def transitioned(self, state):
+        """Called by ServerState, from any thread, after my_state changed."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.state_changed, state)
+
+    def submit(self, event, *args):
+        """Queue event from any thread. Returns a concurrent.futures.Future
+        that completes once the event has been handled."""
+        future = concurrent.futures.Future()
+        if self.loop is None:
+            future.set_exception(RuntimeError(f"State machine isn't running, dropped {event}"))
+            return future
+        self.loop.call_soon_threadsafe(self.events.put_nowait, (self.handlers[event], args, future))
+        return future
+
+    async def send(self, event, *args):
+        """Submit event and wait for it to be handled."""
+        return await asyncio.wrap_future(self.submit(event, *args))
+
+    def after(self, delay, event, *args):
+        """Submit event after delay seconds. Call on the event loop."""
+        if delay > 0:
+            self.loop.call_later(delay, self.submit, event, *args)
+        else:
+            self.submit(event, *args)
+
+    async def wait_for(self, *states, timeout=None):
+        """Wait until my_state is one of states, returning straight away if it already is."""
+        if self.server_state.my_state in states:
+            return self.server_state.my_state
+        return await self.wait(states, timeout)
+
+    async def next_change(self, timeout=None):
+        """Wait for my_state to change. Returns the new state, or None after timeout."""
+        try:
+            return await self.wait(None, timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def wait(self, states, timeout):
+        future = self.loop.create_future()
+        self.waiters.append((states, future))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if (states, future) in self.waiters:
+                self.waiters.remove((states, future))
+
+    def state_changed(self, state):
+        for states, future in list(self.waiters):
+            if not future.done() and (states is None or state in states):
+                future.set_result(state)
+        for handler in self.enter_handlers.get(state, ()):
+            self.events.put_nowait((handler, (), None))
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue()
+        # Anything entered before we started listening
+        self.state_changed(self.server_state.my_state)
+
+        while True:
+            handler, args, future = await self.events.get()
+            if future is not None and not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = handler(*args)
+                if inspect.isawaitable(result):
+                    result = await result
+                if future is not None:
+                    future.set_result(result)
+            except Exception as error:
+                print(error)
+                if future is not None:
+                    future.set_exception(error)
+                self.server_state.my_error = str(error)
+                self.server_state.my_error_time = datetime.datetime.now().timestamp()
+                self.server_state.my_state = State.ERROR
@@ -5,13 +5,44 @@ class State(Enum):
     ERROR = 0
     INITIALIZING = 1
     TRANSCRIBING = 2
-    INFERENCE_TXT_A = 3
-    INFERENCE_TXT_B = 4
-    INFERENCE_IMG_A = 5
-    INFERENCE_IMG_B = 6
-    REVIEW_TXT = 7
-    REVIEW_IMG = 8
-    SELECT_A_TXT = 9
-    SELECT_A_IMG = 10
-    SELECT_B_TXT = 11
-    SELECT_B_IMG = 12
\ No newline at end of file
+    INFERENCE_TXT = 3
+    INFERENCE_IMG = 4
+    REVIEW_TXT = 5
+    REVIEW_IMG = 6
+    SELECT_A_TXT = 7
+    SELECT_A_IMG = 8
+    SELECT_B_TXT = 9
+    SELECT_B_IMG = 10
+
+@unique
+class Progress(Enum):
+    """Per-side (A/B) generation progress, shown alongside the INFERENCE_* states."""
+    IDLE = 0
+    PENDING = 1
+    RUNNING = 2
+    DONE = 3
+    FAILED = 4
+
+@unique
+class Event(Enum):
+    """Inputs handled by the StateMachine, submitted from any thread."""
+    BUTTON = 0                  # A guest pressed A or B, from GPIO or a WebSocket client
+    TRANSCRIPTION_ENDED = 1     # The transcription task finished
+    NEXT_ROUND = 2              # Move on from the SELECT_* states
+    RECOVER = 3                 # Start a new round after an error
+
+# Allowed transitions. Any state may also stay as it is or go to ERROR.
+TRANSITIONS = {
+    State.ERROR: {State.TRANSCRIBING},
+    State.INITIALIZING: {State.TRANSCRIBING},
+    # A speculative generation can already have reached review by the time the transcript is final
+    State.TRANSCRIBING: {State.INFERENCE_TXT, State.INFERENCE_IMG, State.REVIEW_TXT, State.REVIEW_IMG},
+    State.INFERENCE_TXT: {State.REVIEW_TXT},
+    State.INFERENCE_IMG: {State.REVIEW_IMG},
+    State.REVIEW_TXT: {State.SELECT_A_TXT, State.SELECT_B_TXT},
+    State.REVIEW_IMG: {State.SELECT_A_IMG, State.SELECT_B_IMG},
+    State.SELECT_A_TXT: {State.TRANSCRIBING},
+    State.SELECT_A_IMG: {State.TRANSCRIBING},
+    State.SELECT_B_TXT: {State.TRANSCRIBING},
+    State.SELECT_B_IMG: {State.TRANSCRIBING},
+}
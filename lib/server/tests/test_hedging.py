@@ -0,0 +1,30 @@
+import time
+
+from hedging import Hedger, HEDGE_MIN_SAMPLES
+
+MODEL = "model"
+
+def test_time_queued_for_a_worker_does_not_trigger_a_hedge():
+    hedger = Hedger(enabled=True, max_workers=1)
+    for _ in range(HEDGE_MIN_SAMPLES):
+        hedger.tracker.record(MODEL, 0.05)
+    # Another call holds the only worker for longer than the hedge threshold
+    hedger.executor.submit(time.sleep, 0.3)
+
+    assert hedger.call(MODEL, lambda: time.sleep(0.01) or "ok") == "ok"
+    requests, hedges, _ = hedger.stats[MODEL]
+    assert (requests, hedges) == (1, 0)
+
+def test_slow_call_is_hedged():
+    hedger = Hedger(enabled=True, max_workers=2)
+    for _ in range(HEDGE_MIN_SAMPLES):
+        hedger.tracker.record(MODEL, 0.05)
+    calls = []
+
+    def request():
+        calls.append(time.monotonic())
+        time.sleep(0.3 if len(calls) == 1 else 0.01)
+        return len(calls)
+
+    assert hedger.call(MODEL, request) == 2
+    assert hedger.stats[MODEL] == [1, 1, 1]
@@ -0,0 +1,74 @@
+import json
+import threading
+
+from publisher import StatePublisher
+
+class Client:
+    """Applies messages the way the kiosk UI does."""
+
+    def __init__(self, snapshot):
+        message = json.loads(snapshot)
+        self.version = message["version"]
+        self.data = dict(message["data"])
+
+    def apply(self, raw):
+        message = json.loads(raw)
+        if message["version"] <= self.version:
+            return
+        self.version = message["version"]
+        self.data.update(message["set"])
+        for key, text in message["append"].items():
+            self.data[key] = self.data.get(key, "") + text
+
+def connect(publisher, clients):
+    """What server.handler does for a new connection."""
+    message, snapshot = publisher.snapshot_and_drain()
+    for client in clients:
+        if message:
+            client.apply(message)
+    clients.append(Client(snapshot))
+
+def test_snapshot_and_drain_splits_pending_changes():
+    publisher = StatePublisher()
+    publisher.record("result_a", "hello")
+    clients = [Client(publisher.snapshot_and_drain()[1])]
+    publisher.record("result_a", "hello world")
+    connect(publisher, clients)
+    publisher.record("result_a", "hello world again")
+    message = publisher.drain()
+    for client in clients:
+        client.apply(message)
+    assert [client.data["result_a"] for client in clients] == ["hello world again"] * 2
+
+class InterleavingLock:
+    """Lets another thread record a change every time the test thread is about to take the lock."""
+
+    def __init__(self, record):
+        self.lock = threading.Lock()
+        self.record = record
+
+    def __enter__(self):
+        if threading.current_thread() is threading.main_thread():
+            recorder = threading.Thread(target=self.record)
+            recorder.start()
+            recorder.join()
+        self.lock.acquire()
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+def test_appends_recorded_while_clients_connect_arrive_once():
+    publisher = StatePublisher()
+    publisher.record("result_a", "t0 ")
+    tokens = iter(range(1, 1000))
+    publisher.lock = InterleavingLock(lambda: publisher.record("result_a", publisher.values["result_a"] + f"t{next(tokens)} "))
+
+    clients = []
+    for _ in range(5):
+        connect(publisher, clients)
+    message = publisher.drain()
+    for client in clients:
+        client.apply(message)
+
+    expected = publisher.values["result_a"]
+    assert [client.data["result_a"] for client in clients] == [expected] * len(clients)
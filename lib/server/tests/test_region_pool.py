@@ -0,0 +1,44 @@
+import time
+
+import pytest
+
+import region_pool
+from region_pool import RegionPool, REGION_FAILURE_THRESHOLD
+
+MODEL = "model"
+
+def fail(runtime):
+    raise ConnectionError("Region is down")
+
+def succeed(runtime):
+    return "ok"
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(region_pool, "REGION_EXPLORE", 0)
+    pool = RegionPool({"primary": object(), "secondary": object()})
+    primary, secondary = pool.regions
+    secondary.latency[MODEL] = 1.0      # So primary is preferred while it's healthy
+    for _ in range(REGION_FAILURE_THRESHOLD):
+        with pytest.raises(ConnectionError):
+            pool.run(primary, MODEL, fail)
+    assert pool.choose(MODEL) is secondary
+    primary.open_until[MODEL] = time.monotonic() - 1    # REGION_OPEN_S has passed
+    return pool
+
+def test_half_open_circuit_lets_one_call_through(pool):
+    primary, secondary = pool.regions
+    assert pool.choose(MODEL) is primary
+    assert [pool.choose(MODEL) for _ in range(3)] == [secondary] * 3
+
+def test_half_open_call_that_succeeds_closes_the_circuit(pool):
+    primary, _ = pool.regions
+    pool.run(pool.choose(MODEL), MODEL, succeed)
+    assert [pool.choose(MODEL) for _ in range(3)] == [primary] * 3
+
+def test_half_open_call_that_fails_opens_the_circuit_again(pool):
+    primary, secondary = pool.regions
+    with pytest.raises(ConnectionError):
+        pool.run(pool.choose(MODEL), MODEL, fail)
+    assert primary.open_until[MODEL] > time.monotonic()
+    assert pool.choose(MODEL) is secondary
@@ -0,0 +1,11 @@
+from results_writer import ResultsWriter
+
+def test_writer_is_off_when_the_directory_cant_be_created(tmp_path):
+    blocker = tmp_path / "results"
+    blocker.write_text("")
+    assert ResultsWriter.open(str(blocker / "nested")) is None
+
+def test_writer_opens_a_writable_directory(tmp_path):
+    writer = ResultsWriter.open(str(tmp_path))
+    writer.close()
+    assert (tmp_path / "preferences").is_dir()
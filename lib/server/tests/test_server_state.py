@@ -0,0 +1,65 @@
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+import server_state
+from fakes import FakeBedrockRuntime
+from generation import GenerationCancelled
+from server_state import ServerState
+from states import State, Progress
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    monkeypatch.setattr(server_state, "results_dir", str(tmp_path))
+    state = ServerState(bedrock_runtime=FakeBedrockRuntime())
+    state.my_model = "claude"
+    state.get_next_prompt()
+    return state
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def test_round_ending_after_one_side_failed_is_not_an_error(state):
+    def generate(generation, side):
+        if side == 'a':
+            raise ConnectionError("Bedrock is unreachable")
+        generation.wait_for(side, Future())     # Streams until the round is over
+
+    generation = state.start_generation("prompt")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        both = executor.submit(state.generate_both, generation, generate, State.REVIEW_TXT)
+        wait_until(lambda: state.my_state == State.REVIEW_TXT)
+        # The guest picks B while it is still streaming, and the round moves on
+        state.my_state = State.SELECT_B_TXT
+        state.get_next_prompt()
+        with pytest.raises(GenerationCancelled):
+            both.result(timeout=5)
+    assert state.my_state == State.TRANSCRIBING
+
+def test_both_sides_failing_raises_the_error(state):
+    def generate(generation, side):
+        raise ConnectionError("Bedrock is unreachable")
+
+    with pytest.raises(ConnectionError):
+        state.generate_both(state.start_generation("prompt"), generate, State.REVIEW_TXT)
+
+def test_only_a_finished_side_can_be_picked(state):
+    state.my_model = "sdxl"
+    state.my_state = State.INFERENCE_IMG
+    state.my_state = State.REVIEW_IMG
+    state.my_progress_a = Progress.FAILED
+    state.my_progress_b = Progress.RUNNING
+    state.my_image_result_b = "preview"
+
+    state.select('a')
+    state.select('b')
+    assert state.my_state == State.REVIEW_IMG and state.selected_image == ""
+
+    state.my_progress_b = Progress.DONE
+    state.my_image_result_b = "final"
+    state.select('b')
+    assert state.my_state == State.SELECT_B_IMG and state.selected_image == "final"
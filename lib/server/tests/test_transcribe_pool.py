@@ -0,0 +1,60 @@
+import asyncio
+
+import transcribe_pool
+from states import State
+from transcribe_pool import TranscribeStreamPool
+
+class FlakyClient:
+    """Fails to open the first failures streams, then opens streams that accept audio."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.attempts = 0
+
+    async def start_stream_transcription(self, **kwargs):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise ConnectionError("Transcribe is unreachable")
+        return Stream()
+
+class Stream:
+    def __init__(self):
+        self.input_stream = self
+
+    async def send_audio_event(self, audio_chunk):
+        pass
+
+    async def end_stream(self):
+        pass
+
+class Machine:
+    async def next_change(self, timeout=None):
+        await asyncio.sleep(3600 if timeout is None else timeout)
+
+class Session:
+    my_state = State.REVIEW_TXT
+    machine = Machine()
+
+async def maintain_for(pool, seconds):
+    task = asyncio.create_task(pool.maintain(Session()))
+    await asyncio.sleep(seconds)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+def test_failing_opens_are_retried_at_a_bounded_rate(monkeypatch):
+    monkeypatch.setattr(transcribe_pool, "TRANSCRIBE_RETRY_MIN_S", 0.05)
+    monkeypatch.setattr(transcribe_pool, "TRANSCRIBE_RETRY_MAX_S", 0.2)
+    client = FlakyClient(failures=1000)
+    pool = TranscribeStreamPool("us-east-1", 16000, client=client)
+    asyncio.run(maintain_for(pool, 1.0))
+    # 0.05 + 0.1 + 0.2 + 0.2 ... covers 1 s in 6 or 7 attempts
+    assert 4 <= client.attempts <= 8
+    assert pool.retry_delay == 0.2
+
+def test_backoff_resets_once_a_stream_opens(monkeypatch):
+    monkeypatch.setattr(transcribe_pool, "TRANSCRIBE_RETRY_MIN_S", 0.05)
+    client = FlakyClient(failures=2)
+    pool = TranscribeStreamPool("us-east-1", 16000, client=client)
+    asyncio.run(maintain_for(pool, 0.5))
+    assert client.attempts == 3
+    assert pool.retry_delay == 0
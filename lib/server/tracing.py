@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import bisect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "true").lower() == "true"
+# Not under /results, which gets shipped to S3, nor the current directory, which may be the source tree
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(tempfile.gettempdir(), "karaoke-trace.jsonl"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(5 * 2**20)))
+TRACE_BACKUP_COUNT = int(os.getenv("TRACE_BACKUP_COUNT", "3"))
+
+METRICS_PATH = "/metrics"
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Tracer:
+    """Records timing spans for each stage of a round.
+
+    Every span updates an in-memory histogram, served in Prometheus text
+    format from /metrics. Spans are also appended to a rotating JSONL trace
+    file unless they are high-frequency (trace=False), such as per-token
+    broadcasts, to spare the SD card.
+    """
+
+    def __init__(self, path=TRACE_FILE, enabled=TRACE_ENABLED):
+        self.lock = threading.Lock()
+        self.histograms = {}        # (stage, labels) -> Histogram
+        self.logger = None
+        if enabled:
+            # Opened with the first span rather than at import
+            handler = RotatingFileHandler(path, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUP_COUNT, delay=True)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger = logging.getLogger("karaoke.trace")
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+            self.logger.addHandler(handler)
+
+    def record(self, stage, duration, labels=None, trace=True, **attrs):
+        """Record that stage took duration seconds. labels become Prometheus labels, attrs only go to the trace."""
+        labels = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            histogram = self.histograms.get((stage, labels))
+            if histogram is None:
+                histogram = self.histograms[(stage, labels)] = Histogram()
+            histogram.observe(duration)
+
+        if trace and self.logger:
+            span = {"ts": time.time(), "stage": stage, "duration": round(duration, 6), **dict(labels), **attrs}
+            self.logger.info(json.dumps(span, default=str))
+
+    @contextmanager
+    def span(self, stage, labels=None, trace=True, **attrs):
+        """Time the enclosed block as stage."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, time.monotonic() - start, labels, trace, **attrs)
+
+    def prometheus(self):
+        lines = [
+            "# HELP karaoke_stage_seconds Time spent in each stage of a kiosk round.",
+            "# TYPE karaoke_stage_seconds histogram",
+        ]
+        with self.lock:
+            for (stage, labels), histogram in sorted(self.histograms.items()):
+                label_text = ",".join([f'stage="{stage}"'] + [f'{k}="{v}"' for k, v in labels])
+                cumulative = 0
+                for bound, count in zip(HISTOGRAM_BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f'karaoke_stage_seconds_bucket{{{label_text},le="{bound}"}} {cumulative}')
+                lines.append(f"karaoke_stage_seconds_sum{{{label_text}}} {histogram.sum}")
+                lines.append(f"karaoke_stage_seconds_count{{{label_text}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def handle_request(self, path, headers):
+        """HttpServer handler for /metrics"""
+        return 200, {"Content-Type": "text/plain; version=0.0.4"}, self.prometheus().encode()
+
+tracer = Tracer()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import asyncio
+import functools
+import os
+import statistics
+import time
+from collections import deque
+
+from states import State
+from tracing import tracer
+
+TRANSCRIBE_PREWARM = os.getenv("TRANSCRIBE_PREWARM", "true").lower() == "true"
+TRANSCRIBE_STREAM_MAX_AGE_S = float(os.getenv("TRANSCRIBE_STREAM_MAX_AGE_S", "300"))  # Replace idle warm streams after this
+TRANSCRIBE_KEEPALIVE_S = 5          # Transcribe closes streams that get no audio for 15 seconds
+TRANSCRIBE_RETRY_MIN_S = float(os.getenv("TRANSCRIBE_RETRY_MIN_S", "0.5"))    # First wait after a warm stream fails to open
+TRANSCRIBE_RETRY_MAX_S = float(os.getenv("TRANSCRIBE_RETRY_MAX_S", "30"))     # Doubling up to this while it keeps failing
+
+# States where the next round is coming up, so a stream should be ready for it
+WARM_STATES = (
+    State.REVIEW_TXT, State.REVIEW_IMG,
+    State.SELECT_A_TXT, State.SELECT_A_IMG,
+    State.SELECT_B_TXT, State.SELECT_B_IMG,
+)
+
+@functools.lru_cache(maxsize=None)
+def shared_client(region):
+    """The process's TranscribeStreamingClient for region, shared by every session and created on first use."""
+    from amazon_transcribe.client import TranscribeStreamingClient
+    return TranscribeStreamingClient(region=region)
+
+class TranscribeStreamPool:
+    """Keeps one already-negotiated Transcribe stream ready for the next round.
+
+    A single TranscribeStreamingClient is reused across rounds. While the
+    guest is reviewing results, maintain() opens a stream and feeds it short
+    bursts of silence so it stays alive. take() hands it over as soon as
+    transcription starts, falling back to opening a stream on demand.
+    While streams fail to open, maintain() waits longer between attempts,
+    doubling from TRANSCRIBE_RETRY_MIN_S up to TRANSCRIBE_RETRY_MAX_S.
+    """
+
+    def __init__(self, region, sample_rate, client=None, **start_kwargs):
+        self.region = region
+        self.sample_rate = sample_rate
+        self.start_kwargs = {"media_sample_rate_hz": sample_rate, "media_encoding": "pcm", **start_kwargs}
+        self.client = client
+        self.pending = None         # Task resolving to the warm stream
+        self.opened_at = 0
+        self.last_keepalive = 0
+        self.retry_delay = 0        # Backoff before the next warm() after a failed one
+        self.handover_latencies = deque(maxlen=50)
+
+    def get_client(self):
+        if self.client is None:
+            self.client = shared_client(self.region)
+        return self.client
+
+    async def open_stream(self):
+        return await self.get_client().start_stream_transcription(**self.start_kwargs)
+
+    def warm(self):
+        """Start opening a stream in the background if one isn't ready or on its way."""
+        if self.pending is None:
+            self.pending = asyncio.create_task(self.open_stream())
+            self.opened_at = self.last_keepalive = time.monotonic()
+
+    async def discard(self):
+        """Close the warm stream, if any, so the next warm() replaces it."""
+        task, self.pending = self.pending, None
+        if task is None:
+            return
+        try:
+            stream = await task
+            await stream.input_stream.end_stream()
+        except Exception:
+            pass
+
+    async def take(self):
+        """Return a started stream for the round, preferring the warm one."""
+        start = time.monotonic()
+        task, self.pending = self.pending, None
+        if task is not None:
+            try:
+                stream = await task
+                if time.monotonic() - self.opened_at < TRANSCRIBE_STREAM_MAX_AGE_S:
+                    tracer.record("transcribe_stream_open", time.monotonic() - start, {"warm": "true"})
+                    return stream
+                await stream.input_stream.end_stream()
+            except Exception as e:
+                print(f"Warm transcription stream unusable, opening a new one: {e}")
+        stream = await self.open_stream()
+        tracer.record("transcribe_stream_open", time.monotonic() - start, {"warm": "false"})
+        return stream
+
+    def record_handover(self, latency):
+        """Record the time from entering TRANSCRIBING to the first audio event being accepted."""
+        self.handover_latencies.append(latency)
+        tracer.record("transcribe_first_audio", latency)
+        print(f"First audio accepted {latency * 1000:.0f} ms after transition "
+              f"(median {statistics.median(self.handover_latencies) * 1000:.0f} ms over {len(self.handover_latencies)} rounds)")
+
+    async def maintain(self, server_state):
+        """Keep a stream warm during review, replacing it when it expires or errors."""
+        silence = bytes(2 * self.sample_rate // 10)     # 100 ms of int16 silence
+        while True:
+            if server_state.my_state in WARM_STATES:
+                self.warm()
+
+            task = self.pending
+            timeout = None          # Nothing to do until the state changes
+            if task is not None and not task.done():
+                await asyncio.wait([task])
+                continue
+            if task is not None:
+                now = time.monotonic()
+                if task.exception():
+                    self.retry_delay = min(TRANSCRIBE_RETRY_MAX_S, max(TRANSCRIBE_RETRY_MIN_S, self.retry_delay * 2))
+                    print(f"Warming a transcription stream failed, retrying in {self.retry_delay:g}s: {task.exception()}")
+                    await self.discard()
+                    await asyncio.sleep(self.retry_delay)
+                    continue
+                self.retry_delay = 0
+                if now - self.opened_at > TRANSCRIBE_STREAM_MAX_AGE_S:
+                    await self.discard()
+                    continue
+                if now - self.last_keepalive >= TRANSCRIBE_KEEPALIVE_S:
+                    self.last_keepalive = now
+                    try:
+                        await task.result().input_stream.send_audio_event(audio_chunk=silence)
+                    except Exception as e:
+                        print(f"Warm transcription stream failed, replacing it: {e}")
+                        if self.pending is task:
+                            await self.discard()
+                        continue
+                timeout = self.last_keepalive + TRANSCRIBE_KEEPALIVE_S - time.monotonic()
+
+            await server_state.machine.next_change(timeout)
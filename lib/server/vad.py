@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import os
+import time
+from collections import deque
+
+import numpy as np
+
+# Local voice activity detection between the microphone and Amazon Transcribe
+VAD_ENABLED = os.getenv("VAD_ENABLED", "true").lower() == "true"
+VAD_FRAME_MS = int(os.getenv("VAD_FRAME_MS", "20"))                     # Analysis frame length
+VAD_ENERGY_THRESHOLD_DB = float(os.getenv("VAD_ENERGY_THRESHOLD_DB", "-45"))  # Minimum speech level in dBFS
+VAD_NOISE_MARGIN_DB = float(os.getenv("VAD_NOISE_MARGIN_DB", "10"))     # Speech must be this far above the noise floor
+VAD_ZCR_MAX = float(os.getenv("VAD_ZCR_MAX", "0.35"))                   # Higher zero-crossing rates are hiss, not voice
+VAD_PREROLL_MS = int(os.getenv("VAD_PREROLL_MS", "200"))                # Audio kept from just before speech starts
+VAD_HANGOVER_MS = int(os.getenv("VAD_HANGOVER_MS", "300"))              # Audio still sent after speech stops
+VAD_MIN_SPEECH_MS = int(os.getenv("VAD_MIN_SPEECH_MS", "200"))          # Speech needed before an end of utterance counts
+VAD_END_OF_UTTERANCE_MS = int(os.getenv("VAD_END_OF_UTTERANCE_MS", "900"))  # Silence that ends the utterance
+VAD_END_STREAM = os.getenv("VAD_END_STREAM", "true").lower() == "true"  # Close the Transcribe stream on end of utterance
+VAD_KEEPALIVE_S = float(os.getenv("VAD_KEEPALIVE_S", "5"))              # Transcribe times out after 15s without audio
+
+class VoiceActivityDetector:
+    """Energy and zero-crossing voice activity detector for int16 mono PCM.
+
+    process() takes raw audio chunks and returns only the audio worth sending
+    to Transcribe: speech plus a little pre-roll and hangover around it, and
+    an occasional silent frame to keep the stream alive. It also reports a
+    local end of utterance once enough silence follows some speech.
+    """
+
+    def __init__(self, sample_rate):
+        self.frame_len = sample_rate * VAD_FRAME_MS // 1000
+        self.remainder = np.zeros(0, dtype=np.int16)
+        self.noise_floor_db = VAD_ENERGY_THRESHOLD_DB - VAD_NOISE_MARGIN_DB
+        self.preroll = deque(maxlen=max(1, VAD_PREROLL_MS // VAD_FRAME_MS))
+        self.hangover_frames = VAD_HANGOVER_MS // VAD_FRAME_MS
+        self.min_speech_frames = VAD_MIN_SPEECH_MS // VAD_FRAME_MS
+        self.end_of_utterance_frames = VAD_END_OF_UTTERANCE_MS // VAD_FRAME_MS
+        self.speech_frames = 0
+        self.silent_run = self.hangover_frames + 1
+        self.end_of_utterance = False
+        self.last_sent = time.monotonic()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def classify(self, frames):
+        """Vectorized speech/non-speech decision for a (n, frame_len) int16 array."""
+        samples = frames.astype(np.float32) / 32768.0
+        energy_db = 10 * np.log10(np.mean(samples * samples, axis=1) + 1e-10)
+        signs = np.signbit(frames)
+        zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+        threshold = max(VAD_ENERGY_THRESHOLD_DB, self.noise_floor_db + VAD_NOISE_MARGIN_DB)
+        return (energy_db > threshold) & (zcr < VAD_ZCR_MAX), energy_db
+
+    def process(self, chunk):
+        """Return (audio bytes to send, True on end of utterance)."""
+        self.bytes_in += len(chunk)
+        samples = np.concatenate((self.remainder, np.frombuffer(chunk, dtype=np.int16)))
+        n_frames = len(samples) // self.frame_len
+        self.remainder = samples[n_frames * self.frame_len:]
+        if not n_frames:
+            return b"", False
+
+        frames = samples[:n_frames * self.frame_len].reshape(n_frames, self.frame_len)
+        is_speech, energy_db = self.classify(frames)
+
+        output = []
+        end_of_utterance = False
+        for frame, speech, level in zip(frames, is_speech, energy_db):
+            if speech:
+                if self.silent_run > self.hangover_frames:
+                    output.extend(self.preroll)
+                self.preroll.clear()
+                self.speech_frames += 1
+                self.silent_run = 0
+                output.append(frame)
+                continue
+
+            # Track the background level slowly so a noisy event floor raises the bar
+            self.noise_floor_db += 0.05 * (level - self.noise_floor_db)
+            self.silent_run += 1
+            if self.silent_run <= self.hangover_frames and self.speech_frames:
+                output.append(frame)
+            else:
+                self.preroll.append(frame)
+
+            if (not self.end_of_utterance and self.speech_frames >= self.min_speech_frames
+                    and self.silent_run >= self.end_of_utterance_frames):
+                self.end_of_utterance = end_of_utterance = True
+
+        now = time.monotonic()
+        if not output and now - self.last_sent > VAD_KEEPALIVE_S:
+            output.append(np.zeros(self.frame_len, dtype=np.int16))
+        if output:
+            self.last_sent = now
+
+        data = np.concatenate(output).tobytes() if output else b""
+        self.bytes_out += len(data)
+        return data, end_of_utterance
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""Warms the Bedrock and Transcribe connections in the background.
+
+The first request on a new client pays for DNS, the TLS handshake and
+resolving credentials, and so does the first request after an idle
+connection has been dropped. ConnectionWarmer does that at startup, and
+then pings any region that has been idle for BEDROCK_KEEPALIVE_S, so the
+guest's requests find a warm connection. Run directly to compare cold and
+warm request latency against Bedrock:
+
+    python3 warmup.py --region us-east-1 --pings 5 --idle 120
+"""
+
+import argparse
+import asyncio
+import importlib
+import os
+import time
+
+from tracing import tracer
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+BEDROCK_KEEPALIVE_S = float(os.getenv("BEDROCK_KEEPALIVE_S", "45"))    # Ping a region's connection after this long idle
+PING_MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+
+def ping(runtime, model_id=PING_MODEL_ID):
+    """Send a request Bedrock rejects before running the model, so it isn't
+    billed but still resolves credentials and opens the connection."""
+    try:
+        runtime.invoke_model(modelId=model_id, contentType="application/json", accept="application/json", body=b"{}")
+    except Exception as e:
+        # botocore's ClientError carries the service's response, so Bedrock was reached
+        if not getattr(e, "response", None):
+            raise
+
+class ConnectionWarmer:
+    def __init__(self, region_pool, transcribe_pools, model_id=PING_MODEL_ID):
+        self.region_pool = region_pool
+        self.transcribe_pools = transcribe_pools
+        self.model_id = model_id
+        self.failed = set()     # Regions whose last ping failed, so failures are only logged once
+
+    def ping_region(self, region, connection):
+        start = time.monotonic()
+        try:
+            ping(region.runtime, self.model_id)
+        except Exception as e:
+            if region.name not in self.failed:
+                print(f"Warming Bedrock in {region.name} failed: {e}")
+                self.failed.add(region.name)
+            return
+        self.failed.discard(region.name)
+        region.last_used = time.monotonic()
+        latency = region.last_used - start
+        tracer.record("bedrock_warmup", latency, {"region": region.name, "connection": connection}, trace=False)
+        if connection == "cold":
+            print(f"Warmed Bedrock in {region.name} in {latency * 1000:.0f} ms")
+
+    def warm_bedrock(self):
+        for region in self.region_pool.regions:
+            self.ping_region(region, "cold")
+
+    async def warm_transcribe(self):
+        start = time.monotonic()
+        # Import on a worker thread rather than hold up the event loop
+        await asyncio.to_thread(importlib.import_module, "amazon_transcribe.client")
+        for pool in self.transcribe_pools:
+            client = pool.get_client()
+            resolver = getattr(client, "_credential_resolver", None)
+            if resolver is not None:
+                try:
+                    await resolver.get_credentials()
+                except Exception as e:
+                    print(f"Resolving Transcribe credentials failed: {e}")
+        tracer.record("transcribe_warmup", time.monotonic() - start, trace=False)
+
+    def keepalive(self):
+        now = time.monotonic()
+        for region in self.region_pool.regions:
+            if now - region.last_used >= BEDROCK_KEEPALIVE_S:
+                self.ping_region(region, "keepalive")
+
+    async def run(self):
+        await asyncio.gather(asyncio.to_thread(self.warm_bedrock), self.warm_transcribe())
+        while True:
+            await asyncio.sleep(BEDROCK_KEEPALIVE_S / 3)
+            await asyncio.to_thread(self.keepalive)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--region", default=os.getenv("AWS_DEFAULT_REGION", "us-east-1"))
+    parser.add_argument("--model-id", default=PING_MODEL_ID)
+    parser.add_argument("--pings", type=int, default=5, help="Requests on the warm connection")
+    parser.add_argument("--idle", type=float, default=0, help="Idle time before one more request (s)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    from region_pool import bedrock_client
+    runtime = bedrock_client("bedrock-runtime", args.region)
+    print(f"Import and client creation: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    def timed(label):
+        start = time.perf_counter()
+        ping(runtime, args.model_id)
+        latency = (time.perf_counter() - start) * 1000
+        print(f"{label:<24}{latency:>8.0f} ms")
+        return latency
+
+    timed("cold request")
+    warm = sorted(timed(f"warm request {i + 1}") for i in range(args.pings))
+    if warm:
+        print(f"{'warm median':<24}{warm[len(warm) // 2]:>8.0f} ms")
+    if args.idle:
+        time.sleep(args.idle)
+        timed(f"after {args.idle:.0f}s idle")
+
+if __name__ == "__main__":
+    main()